@@ -0,0 +1,75 @@
+"""Time to import the package, and to make a client, in a fresh interpreter
+
+Startup matters for short-lived scripts (like one upload from a cron job). Every run
+is a new interpreter, so nothing is cached in sys.modules; the time of an interpreter
+that imports nothing is subtracted.
+
+Usage: python benchmarks/bench_import.py [runs]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CASES = [
+    ("import scoreganizer_client_lib", "import scoreganizer_client_lib"),
+    (
+        "import exceptions",
+        "from scoreganizer_client_lib.exceptions import ScoreganizerError",
+    ),
+    (
+        "Scoreganizer()",
+        "from scoreganizer_client_lib import Scoreganizer; Scoreganizer()",
+    ),
+    (
+        "first request",
+        "from scoreganizer_client_lib import Scoreganizer; "
+        "Scoreganizer(host='127.0.0.1', port=1, https=False).session",
+    ),
+    ("import requests (reference)", "import requests"),
+]
+
+
+def run(code, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def loaded_modules(code):
+    # the slow dependencies that code ends up importing
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"{code}\nimport sys\n"
+            "print(' '.join(sorted("
+            "{'requests', 'httpx', 'setuptools_scm'} & set(sys.modules))))",
+        ],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() or "-"
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    baseline = run("pass", runs)
+    print(f"{runs} runs each, interpreter startup {baseline * 1000:.1f} ms")
+    for name, code in CASES:
+        elapsed = run(code, runs) - baseline
+        print(f"{name:30} {elapsed * 1000:7.1f} ms   loads: {loaded_modules(code)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Time and memory to parse a list of archived tournaments
+
+Compares the current Tournament with the previous dataclass-based implementation.
+
+Usage: python benchmarks/bench_tournament_deserialize.py [count]
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scoreganizer_client_lib.tournament import Tournament, json_loads
+
+
+@dataclass
+class DataclassTournament:
+    id: int
+    mode: str
+    modeparams: str
+    name: str
+    location: str
+    start: datetime
+    end: datetime
+    open_entry: bool
+    hide_results: bool
+    status: str
+
+    @classmethod
+    def deserialize_many(cls, data):
+        return [cls.deserialize(entry) for entry in data]
+
+    @classmethod
+    def deserialize(cls, data):
+        initkwargs = {
+            **data,
+            "start": datetime.fromisoformat(data["start"]),
+            "end": datetime.fromisoformat(data["end"]),
+        }
+        return cls(**initkwargs)
+
+
+def make_body(count):
+    start = datetime(2020, 1, 1)
+    return json.dumps(
+        [
+            {
+                "id": pk,
+                "mode": "sum",
+                "modeparams": "1+1+1",
+                "name": f"Tournament {pk}",
+                "location": "here",
+                "start": (start + timedelta(hours=pk)).isoformat(),
+                "end": (start + timedelta(hours=pk + 2)).isoformat(),
+                "open_entry": True,
+                "hide_results": False,
+                "status": "not_logged_in",
+            }
+            for pk in range(count)
+        ]
+    ).encode()
+
+
+def measure(label, parse, use, body, repeat=3):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        tournaments = parse(body)
+        use(tournaments)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        del tournaments
+
+    gc.collect()
+    tracemalloc.start()
+    tournaments = parse(body)
+    use(tournaments)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tournaments
+    print(
+        f"{label:>36}: {best * 1000:8.1f} ms, "
+        f"retained {retained / 1024 / 1024:7.1f} MiB, peak {peak / 1024 / 1024:7.1f} MiB"
+    )
+
+
+def ids_only(tournaments):
+    for tournament in tournaments:
+        tournament.id
+
+
+def everything(tournaments):
+    for tournament in tournaments:
+        tournament.start
+        tournament.end
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    body = make_body(count)
+    print(f"{count} tournaments, {len(body) / 1024 / 1024:.1f} MiB of JSON")
+    print(f"JSON decoder: {json_loads.__module__}")
+
+    def old(data):
+        return DataclassTournament.deserialize_many(json.loads(data))
+
+    def new(data):
+        return Tournament.deserialize_many(json_loads(data))
+
+    measure("dataclass, ids only", old, ids_only, body)
+    measure("slots + lazy datetimes, ids only", new, ids_only, body)
+    measure("dataclass, start and end", old, everything, body)
+    measure("slots + lazy datetimes, start and end", new, everything, body)
+
+
+if __name__ == "__main__":
+    main()
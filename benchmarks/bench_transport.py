@@ -0,0 +1,162 @@
+"""Request rate and latency of the transports, against local stand-in servers
+
+Many small requests (token_status) from several threads, with requests (HTTP/1.1),
+httpx over HTTP/1.1, and httpx over HTTP/2 (h2c, needs the h2 package). Real servers
+are further away, which makes the handshakes HTTP/2 saves matter more than here.
+
+Usage: python benchmarks/bench_transport.py [requests] [threads]
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scoreganizer_client_lib import Scoreganizer
+from scoreganizer_client_lib.transport import HTTPXTransport
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+
+BODY = json.dumps({"status": "ok"}).encode()
+# connections each server accepted
+connections = {"http1": 0, "h2": 0}
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # otherwise, delayed ACKs make every request take 40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        connections["http1"] += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+
+class H2StatusProtocol(asyncio.Protocol):
+    # HTTP/2 with prior knowledge, answering every request with BODY
+
+    def connection_made(self, transport):
+        connections["h2"] += 1
+        self.transport = transport
+        self.conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False)
+        )
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                self.conn.send_headers(
+                    event.stream_id,
+                    [
+                        (":status", "200"),
+                        ("content-type", "application/json"),
+                        ("content-length", str(len(BODY))),
+                        ("date", formatdate(usegmt=True)),
+                    ],
+                )
+                self.conn.send_data(event.stream_id, BODY, end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+
+def start_http1_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def start_h2_server():
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_server(H2StatusProtocol, "127.0.0.1", 0)
+    )
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+def measure(sc, requests, threads):
+    def timed(_):
+        start = time.perf_counter()
+        sc.token_status()
+        return time.perf_counter() - start
+
+    # warm up, so that every thread has its session and connection
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(timed, range(threads)))
+        start = time.perf_counter()
+        latencies = list(executor.map(timed, range(requests)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (
+        requests / elapsed,
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99) - 1],
+    )
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    http1_port = start_http1_server()
+    configs = [
+        ("requests, HTTP/1.1", "http1", http1_port, lambda: None),
+        ("httpx, HTTP/1.1", "http1", http1_port, lambda: HTTPXTransport(http2=False)),
+    ]
+    if h2 is not None:
+        configs.append(
+            (
+                "httpx, HTTP/2",
+                "h2",
+                start_h2_server(),
+                lambda: HTTPXTransport(http1=False, http2=True),
+            )
+        )
+    else:
+        print("h2 isn't installed, skipping HTTP/2")
+
+    print(f"{requests} requests from {threads} threads")
+    for name, server, port, make_transport in configs:
+        connections[server] = 0
+        transport = make_transport()
+        kwargs = {} if transport is None else {"transport": transport}
+        if transport is None:
+            kwargs["pool_maxsize"] = threads
+        with Scoreganizer(
+            host="127.0.0.1", port=port, https=False, thread_safe=True, **kwargs
+        ) as sc:
+            rate, p50, p99 = measure(sc, requests, threads)
+        print(
+            f"{name:20} {rate:8.0f} requests/s"
+            f"   p50 {p50 * 1000:6.2f} ms   p99 {p99 * 1000:6.2f} ms"
+            f"   {connections[server]} connections"
+        )
+
+
+if __name__ == "__main__":
+    main()
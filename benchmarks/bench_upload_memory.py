@@ -0,0 +1,73 @@
+"""Peak memory of replay uploads, buffered (requests' multipart) vs streamed
+
+Usage: python benchmarks/bench_upload_memory.py [size_mb] [uploads]
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scoreganizer_client_lib import Scoreganizer
+
+
+class DiscardHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1 << 16)))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def measure(upload, uploads):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(uploads):
+        upload()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    uploads = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DiscardHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sc = Scoreganizer(host="127.0.0.1", port=server.server_address[1], https=False)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "replay.rmv")
+        with open(path, "wb") as replay:
+            replay.write(os.urandom(size_mb * 1024 * 1024))
+
+        print(f"{uploads} uploads of a {size_mb} MiB replay")
+        for name, stream in (("buffered", False), ("streamed", True)):
+            peak, elapsed = measure(
+                lambda stream=stream: sc.scores.upload_filename(path, stream=stream),
+                uploads,
+            )
+            print(
+                f"{name:>9}: peak {peak / 1024 / 1024:8.2f} MiB, "
+                f"{elapsed / uploads * 1000:8.2f} ms/upload"
+            )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,19 @@
-from .scoreganizer import Scoreganizer
-from .version import __version__
-
 __all__ = ["Scoreganizer", "__version__"]
+
+
+def __getattr__(name):
+    # imported on first use, so that importing just the parts of the package that are
+    # needed (like exceptions) stays fast
+    if name == "Scoreganizer":
+        from .scoreganizer import Scoreganizer
+
+        return Scoreganizer
+    if name == "__version__":
+        from .version import __version__
+
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
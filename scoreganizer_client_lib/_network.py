@@ -0,0 +1,10 @@
+# see exceptions.__getattr__
+from requests.exceptions import RequestException as NetworkException
+
+
+class CircuitOpenError(NetworkException):
+    # raised without sending the request, see circuit.CircuitBreaker
+    def __init__(self, state, retry_after):
+        super().__init__(f"circuit breaker is {state}, retry in {retry_after:.1f}s")
+        self.state = state
+        self.retry_after = retry_after
@@ -0,0 +1,128 @@
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+
+from .clock import ServerClock
+from .retry import RetryPolicy
+from .scoreganizer import DEFAULT_RETRY, Scoreganizer
+from .transport import RequestsTransport
+
+
+class AccountPool:
+    # Many accounts against the same server, with one connection pool: every account
+    # has its own Scoreganizer (and credentials), but they all use one session, which
+    # sends each account's credentials with its requests. Worker threads of accounts
+    # still get their own sessions, but those use the same adapter, and with it the
+    # same connections.
+
+    scoreganizer_cls = Scoreganizer
+
+    def __init__(
+        self,
+        host="scoreganizer.net",
+        port=443,
+        https=True,
+        digest_auth_username=None,
+        digest_auth_password=None,
+        pool_maxsize=32,
+        pool_block=False,
+        max_retries=DEFAULT_RETRY,
+        retry_policy=None,
+        circuit_breaker=None,
+        rate_limiter=None,
+        concurrency_limiter=None,
+        transport=None,
+        metrics=None,
+    ):
+        self.host = host
+        self.port = port
+        self.https = https
+        self._digest_auth_username = digest_auth_username
+        self._digest_auth_password = digest_auth_password
+        # one host, so one connection pool of up to pool_maxsize connections
+        self.http_adapter = None
+        if transport is None:
+            self.http_adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+                max_retries=max_retries,
+            )
+            transport = RequestsTransport(self.http_adapter)
+        self.transport = transport
+        # these are about the server, not the account, so all accounts share them
+        self.clock = ServerClock()
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.metrics = metrics
+        digest_auth = None
+        if digest_auth_username is not None and digest_auth_password is not None:
+            digest_auth = HTTPDigestAuth(digest_auth_username, digest_auth_password)
+        self.session = transport.open(self._observe_response, digest_auth)
+        # name -> Scoreganizer
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def _observe_response(self, response, *args, **kwargs):
+        self.clock.observe(response.headers.get("Date"), response.elapsed)
+
+    def add(self, name, auth_filename=None, **kwargs):
+        # kwargs are passed on to Scoreganizer - upload_index, list_cache, etc. Adding
+        # a name again returns the account we already have.
+        with self._lock:
+            account = self._accounts.get(name)
+            if account is not None:
+                return account
+        account = self.scoreganizer_cls(
+            host=self.host,
+            port=self.port,
+            https=self.https,
+            digest_auth_username=self._digest_auth_username,
+            digest_auth_password=self._digest_auth_password,
+            auth_filename=auth_filename,
+            retry_policy=self.retry_policy,
+            circuit_breaker=self.circuit_breaker,
+            rate_limiter=self.rate_limiter,
+            concurrency_limiter=self.concurrency_limiter,
+            metrics=self.metrics,
+            session=self.session,
+            transport=self.transport,
+            **kwargs,
+        )
+        account.clock = self.clock
+        with self._lock:
+            return self._accounts.setdefault(name, account)
+
+    def remove(self, name):
+        with self._lock:
+            return self._accounts.pop(name)
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._accounts[name]
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._accounts
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._accounts))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._accounts)
+
+    def close(self):
+        # closes the connections of all accounts
+        self.session.close()
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,653 @@
+import asyncio
+from datetime import timedelta
+import os
+import random
+import time
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+from .api_token import TokenManager, TokenRefresher
+from .exceptions import (
+    ScoreganizerError,
+    ScoreganizerKeyExists,
+    ScoreganizerTokenTooRecent,
+    ScoreganizerTooEarly,
+    ScoreganizerWait,
+)
+from .jsonstream import JsonArrayParser
+from .multipart import MultipartEncoder
+from .ratelimit import THROTTLE_STATUSES, AdaptiveConcurrency
+from .score import BUFFER_TYPES, BulkUploadReport, Scores, UploadResult
+from .scheduler import KeyScheduler
+from .scoreganizer import Scoreganizer
+from .tournament import Tournament, Tournaments, TournamentSnapshot, json_loads
+from .transport import _translate_error
+
+
+DEFAULT_CONNECT_RETRIES = 5
+DEFAULT_LIMITS = None if httpx is None else httpx.Limits(max_connections=100)
+
+
+class AsyncTournaments(Tournaments):
+    async def participate(self, tournament):
+        pk = int(tournament)
+        await self._sc._request("POST", self._url(f"participate/{pk}"))
+        self._invalidate_lists()
+
+    async def gen_key(self, tournament):
+        pk = int(tournament)
+        response = await self._sc._request("POST", self._url(f"gen_key/{pk}"))
+        key = response.json().get("key")
+        self._store_key(tournament, key)
+        return key
+
+    async def get_key(self, tournament):
+        pk = int(tournament)
+        key = self._cached_key(tournament)
+        if key is not None:
+            return key
+        response = await self._sc._request("GET", self._url(f"get_key/{pk}"))
+        key = response.json().get("key")
+        self._store_key(tournament, key)
+        return key
+
+    async def player_confirm(self, tournament):
+        pk = int(tournament)
+        await self._sc._request("POST", self._url(f"player_confirm/{pk}"))
+        self._invalidate_lists()
+
+    async def wait_key(self, tournament, jitter=0):
+        key = self._cached_key(tournament)
+        if key is not None:
+            return key
+        delay = self._seconds_until_start(tournament)
+        if delay > 0:
+            await asyncio.sleep(delay + random.uniform(0, jitter))
+        while True:
+            try:
+                return await self.gen_key(tournament)
+            except ScoreganizerTooEarly as ex:
+                await ex.do_wait_async(jitter, self._sc.metrics)
+            except ScoreganizerKeyExists:
+                return await self.get_key(tournament)
+
+    async def wait_keys(self, tournaments, jitter=0):
+        tournaments = list(tournaments)
+        pks = [int(tournament) for tournament in tournaments]
+        scheduler = AsyncKeyScheduler(self, jitter=jitter)
+        futures = scheduler.schedule_many(tournaments)
+        await scheduler.run()
+        return {pk: future.result() for pk, future in zip(pks, futures)}
+
+    async def snapshot(self, mine=False, now=None):
+        if mine:
+            all_tournaments, my_active = await asyncio.gather(
+                self._list("all"), self._list("my_active")
+            )
+        else:
+            all_tournaments, my_active = await self._list("all"), None
+        if now is None:
+            now = self._sc.clock.now()
+        return TournamentSnapshot.classify(
+            all_tournaments,
+            now,
+            my_active=my_active,
+            server_tz=self._sc.clock.server_tz,
+        )
+
+    async def _iter_list(self, name, chunk_size):
+        # yields lists of entries, as they come in
+        url = self._url(name)
+        metrics = self._sc.metrics
+        start = None if metrics is None else time.perf_counter()
+        try:
+            async with self.session.stream("GET", url) as response:
+                if start is not None:
+                    # until the headers came in - the body is read while it's parsed
+                    metrics.record_request(
+                        "GET", url, time.perf_counter() - start, response, stream=True
+                    )
+                if response.status_code >= 400:
+                    await response.aread()
+                    self._sc._raise_if_error(response)
+                parser = JsonArrayParser()
+                async for chunk in response.aiter_bytes(chunk_size):
+                    yield parser.feed(chunk)
+                yield parser.close()
+        except httpx.TransportError as ex:
+            raise _translate_error(ex) from ex
+
+    async def iter_archive(self, chunk_size=64 * 1024):
+        async for entries in self._iter_list("archive", chunk_size):
+            for tournament in Tournament.deserialize_iter(entries):
+                yield tournament
+
+    async def sync_archive(self, store, chunk_size=64 * 1024):
+        new_entries = []
+        async for entries in self._iter_list("archive", chunk_size):
+            new_entries.extend(entry for entry in entries if entry["id"] not in store)
+        store.add_many(new_entries)
+        return Tournament.deserialize_many(new_entries)
+
+    async def _list(self, name):
+        tournaments = self._mirrored_list(name)
+        if tournaments is None:
+            tournaments = await self._fetch_list(name)
+        return tournaments
+
+    async def _fetch_list(self, name):
+        tournaments = await self._fetch_list_cached(name)
+        self._list_fetched(name, tournaments)
+        return tournaments
+
+    async def _fetch_list_cached(self, name):
+        cache = self._sc.list_cache
+        if cache is None:
+            response = await self._sc._request("GET", self._url(name))
+            return Tournament.deserialize_many(json_loads(response.content))
+
+        tournaments = cache.get_fresh(name)
+        if tournaments is not None:
+            return tournaments
+        entry = cache.get(name)
+        headers = {} if entry is None else entry.conditional_headers()
+        response = await self._sc._request("GET", self._url(name), headers=headers)
+        if response.status_code == 304 and entry is not None:
+            return cache.refresh(name, entry)
+        tournaments = Tournament.deserialize_many(json_loads(response.content))
+        cache.store(name, tournaments, response.headers)
+        return tournaments
+
+
+class _AsyncBody:
+    # httpx needs an async iterable to stream a request body with an AsyncClient.
+    # Every iteration continues from where the encoder is, so that a retry can send it
+    # again after rewinding it.
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+
+    async def __aiter__(self):
+        while True:
+            chunk = self.encoder.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        # httpx responses are in a reference cycle with their request, which would
+        # keep a mapped file open until the garbage collector gets to it
+        self.encoder = None
+
+
+class AsyncScores(Scores):
+    async def upload_filename(
+        self, filename, ext=None, mime_type=None, tries=10, stream=False
+    ):
+        # support pathlib.Path
+        filename = str(filename)
+        index = self._sc.upload_index
+        if index is not None:
+            digest, tournament = index.hash(filename)
+            if index.contains_hash(digest):
+                return False
+        with open(filename, "rb") as file:
+            if not stream:
+                await self.upload_file(
+                    file, filename, ext=ext, mime_type=mime_type, tries=tries
+                )
+            else:
+                with self._open_mmap(file) as source:
+                    await self.upload_file(
+                        source,
+                        filename,
+                        ext=ext,
+                        mime_type=mime_type,
+                        tries=tries,
+                        stream=True,
+                    )
+        if index is not None:
+            index.add_hash(digest, os.path.getsize(filename), tournament)
+        return True
+
+    async def _upload_result(self, filename, **kwargs):
+        filename = str(filename)
+        result = UploadResult(filename, 0)
+        try:
+            result.size = os.path.getsize(filename)
+            result.skipped = not await self.upload_filename(filename, **kwargs)
+        except (ScoreganizerError, Exception) as ex:
+            result.error = ex
+        return result
+
+    async def upload_many(self, filenames, concurrency=4, tries=10, stream=False):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(filename):
+            async with semaphore:
+                return await self._upload_result(filename, tries=tries, stream=stream)
+
+        start = time.monotonic()
+        results = await asyncio.gather(*(upload(filename) for filename in filenames))
+        return BulkUploadReport(list(results), time.monotonic() - start)
+
+    async def drain_queue(self, upload_queue, concurrency=4, tries=10, stream=False):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(queued):
+            async with semaphore:
+                if not upload_queue.claim(queued.id):
+                    # another process sharing the queue is uploading it
+                    return None
+                result = await self._upload_result(
+                    queued.filename,
+                    ext=queued.ext,
+                    mime_type=queued.mime_type,
+                    tries=tries,
+                    stream=stream,
+                )
+                upload_queue.finish(queued.id, result.error)
+                return result
+
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *(upload(queued) for queued in upload_queue.pending())
+        )
+        return BulkUploadReport(
+            [result for result in results if result is not None],
+            time.monotonic() - start,
+        )
+
+    async def upload_file(
+        self, file, filename, ext=None, mime_type=None, tries=10, stream=False
+    ):
+        # support pathlib.Path
+        filename = str(filename)
+        is_buffer = isinstance(file, BUFFER_TYPES)
+        upload = self._upload_stream if stream or is_buffer else self._upload_file
+        return await upload(file, filename, ext=ext, mime_type=mime_type, tries=tries)
+
+    async def _upload_file(self, file, filename, ext=None, mime_type=None, tries=None):
+        filename, mime_type = self._upload_args(filename, ext=ext, mime_type=mime_type)
+        await self._sc._request(
+            "POST",
+            self._url("upload"),
+            tries=tries,
+            before_retry=self._rewinder(file),
+            files={"video": (filename, file)},
+            data={"mime_type": mime_type},
+        )
+
+    async def _upload_stream(
+        self, source, filename, ext=None, mime_type=None, tries=None
+    ):
+        filename, mime_type = self._upload_args(filename, ext=ext, mime_type=mime_type)
+        encoder = MultipartEncoder(
+            {"mime_type": mime_type},
+            {"video": (filename, source, "application/octet-stream")},
+        )
+        headers = {"Content-Type": encoder.content_type}
+        if encoder.len is not None:
+            headers["Content-Length"] = str(encoder.len)
+        body = _AsyncBody(encoder)
+        try:
+            await self._sc._request(
+                "POST",
+                self._url("upload"),
+                tries=tries,
+                before_retry=lambda: encoder.seek(0),
+                content=body,
+                headers=headers,
+            )
+        finally:
+            body.close()
+
+
+class AsyncKeyScheduler(KeyScheduler):
+    # The same, but on an event loop - schedule() has to be called from it, and keys
+    # that are due at the same time are fetched concurrently.
+
+    def __init__(
+        self,
+        tournaments,
+        on_key=None,
+        on_error=None,
+        jitter=0,
+        clock=time.monotonic,
+    ):
+        super().__init__(
+            tournaments, on_key=on_key, on_error=on_error, jitter=jitter, clock=clock
+        )
+        self._wakeup = asyncio.Event()
+
+    def _new_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    def _wake(self):
+        self._wakeup.set()
+
+    async def _fire(self, tournament):
+        try:
+            try:
+                key = await self.tournaments.gen_key(tournament)
+            except ScoreganizerKeyExists:
+                key = await self.tournaments.get_key(tournament)
+        except ScoreganizerWait as ex:
+            self._retry_later(tournament, ex)
+        except (ScoreganizerError, Exception) as ex:
+            self._resolve(int(tournament), error=ex)
+        else:
+            self._resolve(int(tournament), key)
+
+    async def run_pending(self):
+        with self._cond:
+            due = self._pop_due()
+        await asyncio.gather(*(self._fire(tournament) for tournament in due))
+        with self._cond:
+            return self._timeout()
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = await self.run_pending()
+            if not self._futures or self._stopping:
+                return
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:  # noqa: UP041  not TimeoutError before 3.11
+                    pass
+
+    def start(self):
+        raise TypeError("there is no thread to start, use run() as a task instead")
+
+    def stop(self):
+        # cancels the futures of keys we don't have yet, run() returns
+        with self._cond:
+            self._stopping = True
+            futures = list(self._futures.values())
+            self._futures.clear()
+            self._heap.clear()
+        self._wake()
+        for future in futures:
+            future.cancel()
+
+
+class AsyncTokenManager(TokenManager):
+    async def status(self, max_age=None):
+        status = self.cached_status(max_age)
+        if status is None:
+            status = await self._sc.token_status()
+        return status
+
+    async def refresh_if_stale(self, refresh_after=None):
+        if not self._is_stale(await self.status(), refresh_after):
+            return None
+        try:
+            return await self._sc.refresh_login()
+        except ScoreganizerTokenTooRecent:
+            self._too_recent()
+            return None
+
+
+class AsyncTokenRefresher(TokenRefresher):
+    # The same, but on an event loop
+    _wakeup = None
+
+    async def refresh_once(self):
+        tokens = self.scoreganizer.tokens
+        try:
+            auth_str = await tokens.refresh_if_stale(self.refresh_after)
+        except (ScoreganizerError, Exception) as ex:
+            self._report(error=ex)
+        else:
+            self._report(auth_str)
+
+    async def run(self):
+        # until stop() is called, or the task is cancelled
+        self._stop.clear()
+        self._wakeup = asyncio.Event()
+        while not self._stop.is_set():
+            await self.refresh_once()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_check())
+            except asyncio.TimeoutError:  # noqa: UP041  not TimeoutError before 3.11
+                pass
+
+    def start(self):
+        raise TypeError("there is no thread to start, use run() as a task instead")
+
+    def stop(self):
+        self._stop.set()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+
+class AsyncAdaptiveConcurrency(AdaptiveConcurrency):
+    # The same, but waits on the event loop instead of blocking it
+
+    def __init__(
+        self,
+        initial=4,
+        minimum=1,
+        maximum=32,
+        backoff=0.5,
+        throttle_statuses=THROTTLE_STATUSES,
+    ):
+        super().__init__(
+            initial=initial,
+            minimum=minimum,
+            maximum=maximum,
+            backoff=backoff,
+            throttle_statuses=throttle_statuses,
+        )
+        self._waiters = []
+
+    async def acquire(self):
+        while True:
+            with self._cond:
+                if self._has_room():
+                    return self._take()
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+            await waiter
+
+    def _notify(self):
+        # everyone checks again whether there is room now
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class AsyncScoreganizer(Scoreganizer):
+    tournaments_cls = AsyncTournaments
+    scores_cls = AsyncScores
+    tokens_cls = AsyncTokenManager
+    retry_exceptions = () if httpx is None else (httpx.TransportError,)
+
+    def __init__(
+        self,
+        host="scoreganizer.net",
+        port=443,
+        https=True,
+        digest_auth_username=None,
+        digest_auth_password=None,
+        transport=None,
+        limits=None,
+        auth_filename=None,
+        upload_index=None,
+        list_cache=None,
+        mirror=None,
+        key_cache=None,
+        retry_policy=None,
+        circuit_breaker=None,
+        rate_limiter=None,
+        concurrency_limiter=None,
+        metrics=None,
+    ):
+        if httpx is None:
+            raise ImportError(
+                "AsyncScoreganizer requires httpx - "
+                "install scoreganizer-client-lib[async]"
+            )
+        self._transport = transport
+        self._limits = limits
+        super().__init__(
+            host=host,
+            port=port,
+            https=https,
+            digest_auth_username=digest_auth_username,
+            digest_auth_password=digest_auth_password,
+            auth_filename=auth_filename,
+            upload_index=upload_index,
+            list_cache=list_cache,
+            mirror=mirror,
+            key_cache=key_cache,
+            retry_policy=retry_policy,
+            circuit_breaker=circuit_breaker,
+            rate_limiter=rate_limiter,
+            concurrency_limiter=concurrency_limiter,
+            metrics=metrics,
+        )
+
+    def _make_session(self, http_adapter, digest_auth):
+        transport = self._transport
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(
+                retries=DEFAULT_CONNECT_RETRIES,
+                limits=self._limits or DEFAULT_LIMITS,
+            )
+        return httpx.AsyncClient(
+            auth=digest_auth,
+            transport=transport,
+            event_hooks={
+                "request": [self._stamp_request_async],
+                "response": [self._observe_response_async],
+            },
+        )
+
+    async def _stamp_request_async(self, request):
+        request.extensions["sent"] = time.monotonic()
+
+    async def _observe_response_async(self, response):
+        # response.elapsed isn't known until the response was read
+        sent = response.request.extensions.get("sent")
+        elapsed = None
+        if sent is not None:
+            elapsed = timedelta(seconds=time.monotonic() - sent)
+        self.clock.observe(response.headers.get("Date"), elapsed)
+
+    def _get_digest_auth(self, username, password):
+        if username is None or password is None:
+            return None
+        return httpx.DigestAuth(username, password)
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.aclose()
+
+    def close(self):
+        raise TypeError("AsyncScoreganizer has to be closed with await sc.aclose()")
+
+    def __enter__(self):
+        raise TypeError("use async with AsyncScoreganizer(...) instead")
+
+    def __exit__(self, *exc_info):
+        raise TypeError("use async with AsyncScoreganizer(...) instead")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def _request(self, method, url, tries=None, before_retry=None, **kwargs):
+        self._reload_auth_file()
+        retry = self.retry_policy.start(tries)
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_request()
+            if self.rate_limiter is not None:
+                delay = self.rate_limiter.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            slot = None
+            if self.concurrency_limiter is not None:
+                slot = await self.concurrency_limiter.acquire()
+            response = error = None
+            start = None if self.metrics is None else time.perf_counter()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+                self._raise_if_error(response)
+            except ScoreganizerError as ex:
+                error = ex
+            except self.retry_exceptions as ex:
+                # the same exceptions as with requests, see NetworkException
+                error = _translate_error(ex)
+                error.__cause__ = ex
+            finally:
+                self._record_outcome(response, slot)
+                if start is not None:
+                    self.metrics.record_request(
+                        method,
+                        url,
+                        time.perf_counter() - start,
+                        response,
+                        error,
+                        kwargs.get("stream", False),
+                    )
+            if error is None:
+                return response
+            if not self._should_retry(method, response, error):
+                raise error
+            delay = retry.next_delay(response, error)
+            if delay is None or self._circuit_open_after(delay):
+                raise error
+            if self.metrics is not None:
+                self.metrics.record_retry(method, url, delay)
+            if response is not None:
+                await response.aclose()
+            if before_retry is not None:
+                try:
+                    before_retry()
+                except OSError:
+                    raise error from None
+            await asyncio.sleep(delay)
+
+    async def token_status(self):
+        response = await self._request("GET", self._url("token_status"))
+        status = response.json().get("status")
+        self.tokens.observe_status(status)
+        return status
+
+    async def token_status_ok(self):
+        return (await self.token_status()).startswith("ok")
+
+    async def login(self, username, password):
+        response = await self._request(
+            "POST",
+            self._url("obtain_token"),
+            data={
+                "username": username,
+                "password": password,
+            },
+        )
+        api_token = response.json().get("token", None)
+        self.username = username
+        return self._set_token(api_token)
+
+    async def refresh_login(self):
+        # the auth file isn't locked while we wait for the server, since that would
+        # block the event loop - but if another process just refreshed the token, we
+        # use theirs
+        if self._reload_auth_file():
+            return self._auth_str
+        response = await self._request("POST", self._url("refresh_token"))
+        return self._set_token(response.json().get("token"))
+
+    async def refresh_login_if_stale(self):
+        return await self.tokens.refresh_if_stale()
@@ -0,0 +1,174 @@
+import threading
+import time
+
+from .exceptions import ScoreganizerError, ScoreganizerTokenTooRecent
+
+
+# seconds - how long we believe what token_status said
+DEFAULT_STATUS_TTL = 60
+
+
+class TokenManager:
+    # Keeps track of when our token was issued and what the server last said about it,
+    # so that we don't have to ask before every bit of work.
+
+    def __init__(self, scoreganizer, status_ttl=DEFAULT_STATUS_TTL, clock=time.time):
+        self._sc = scoreganizer
+        self.status_ttl = status_ttl
+        # wall clock time, since tokens from the auth file were issued by another
+        # process
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._issued = None
+        self._status = None
+        self._checked = None
+
+    @property
+    def issued(self):
+        # when the current token was issued, None if we don't know
+        with self._lock:
+            return self._issued
+
+    @property
+    def age(self):
+        issued = self.issued
+        return None if issued is None else max(0.0, self._clock() - issued)
+
+    def token_changed(self, issued=None):
+        # issued is None if we don't know when the new token was issued
+        with self._lock:
+            self._issued = issued
+            self._status = self._checked = None
+
+    def token_issued(self):
+        # we just got a new token from the server
+        self.token_changed(self._clock())
+
+    def observe_status(self, status):
+        with self._lock:
+            self._status = status
+            self._checked = self._clock()
+
+    def invalidate(self):
+        # the next status() asks the server again
+        with self._lock:
+            self._status = self._checked = None
+
+    def cached_status(self, max_age=None):
+        # None if we don't know, or what we know is older than max_age seconds
+        if max_age is None:
+            max_age = self.status_ttl
+        with self._lock:
+            if self._checked is None or self._clock() - self._checked >= max_age:
+                return None
+            return self._status
+
+    def status(self, max_age=None):
+        status = self.cached_status(max_age)
+        if status is None:
+            status = self._sc.token_status()
+        return status
+
+    def _is_stale(self, status, refresh_after):
+        if status == "ok_stale":
+            return True
+        age = self.age
+        return (
+            status == "ok"
+            and refresh_after is not None
+            and age is not None
+            and age >= refresh_after
+        )
+
+    def _too_recent(self):
+        # the server won't refresh it yet, so it isn't stale after all
+        with self._lock:
+            self._issued = self._clock()
+            self._status = "ok"
+            self._checked = self._issued
+
+    def refresh_if_stale(self, refresh_after=None):
+        # refreshes the token if the server says it's stale, or it's older than
+        # refresh_after seconds. Returns the new credentials, or None.
+        if not self._is_stale(self.status(), refresh_after):
+            return None
+        try:
+            return self._sc.refresh_login()
+        except ScoreganizerTokenTooRecent:
+            self._too_recent()
+            return None
+
+
+class TokenRefresher:
+    # Refreshes the token from a background thread before it goes stale, so that work
+    # never has to wait for it: refresh_after seconds after it was issued if set, and
+    # whenever the server says it's stale otherwise (which we ask every interval
+    # seconds).
+
+    def __init__(
+        self,
+        scoreganizer,
+        refresh_after=None,
+        interval=DEFAULT_STATUS_TTL,
+        on_refresh=None,
+        on_error=None,
+    ):
+        self.scoreganizer = scoreganizer
+        self.refresh_after = refresh_after
+        self.interval = interval
+        self.on_refresh = on_refresh
+        self.on_error = on_error
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _report(self, auth_str=None, error=None):
+        if error is not None:
+            if self.on_error is not None:
+                self.on_error(error)
+        elif auth_str is not None and self.on_refresh is not None:
+            self.on_refresh(auth_str)
+
+    def refresh_once(self):
+        tokens = self.scoreganizer.tokens
+        try:
+            auth_str = tokens.refresh_if_stale(self.refresh_after)
+        except (ScoreganizerError, Exception) as ex:
+            self._report(error=ex)
+        else:
+            self._report(auth_str)
+
+    def _next_check(self):
+        # seconds until we need to check again
+        age = self.scoreganizer.tokens.age
+        if self.refresh_after is None or age is None:
+            return self.interval
+        due = self.refresh_after - age
+        # if it's already due, refreshing just failed - try again later
+        return self.interval if due <= 0 else min(self.interval, due)
+
+    def _refresh(self):
+        session = self.scoreganizer._init_worker_session()
+        try:
+            while not self._stop.is_set():
+                self.refresh_once()
+                self._stop.wait(self._next_check())
+        finally:
+            session.close()
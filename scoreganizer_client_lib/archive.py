@@ -0,0 +1,69 @@
+import json
+import os
+import threading
+
+from .tournament import Tournament
+
+
+class ArchiveStore:
+    # The tournaments in the archive we've already seen, as an append-only file with
+    # one JSON object per line - the archive only ever grows.
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self._ids = set()
+        self._lock = threading.Lock()
+        for entry in self._iter_entries():
+            self._ids.add(entry["id"])
+
+    def _iter_entries(self):
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    # a line that is cut off if we crashed while writing it
+                    if not line.endswith("\n"):
+                        break
+                    yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+    def __contains__(self, tournament):
+        return int(tournament) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return Tournament.deserialize_iter(self._iter_entries())
+
+    def add_many(self, entries):
+        lines = []
+        with self._lock:
+            for entry in entries:
+                if entry["id"] not in self._ids:
+                    self._ids.add(entry["id"])
+                    lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+            if not lines:
+                return
+            with open(self.path, "a", encoding="utf-8") as file:
+                self._truncate_partial_line(file)
+                file.writelines(lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+    def _truncate_partial_line(self, file):
+        # throw away a line that was cut off when we crashed while writing it
+        end = file.seek(0, os.SEEK_END)
+        with open(self.path, "rb") as reader:
+            pos = end
+            while pos > 0:
+                block_start = max(0, pos - 4096)
+                reader.seek(block_start)
+                block = reader.read(pos - block_start)
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    pos = block_start + newline + 1
+                    break
+                pos = block_start
+        if pos != end:
+            file.truncate(pos)
@@ -0,0 +1,200 @@
+from copy import copy
+from dataclasses import dataclass
+import os
+import sqlite3
+import threading
+import time
+
+
+# seconds - the archive only changes when a tournament ends, the others whenever one
+# starts, or someone participates
+DEFAULT_TTLS = {
+    "all": 30,
+    "archive": 300,
+    "active": 10,
+    "upcoming": 30,
+    "in_progress": 10,
+    "my_active": 10,
+}
+DEFAULT_TTL = 10
+
+
+@dataclass
+class ListCacheEntry:
+    tournaments: list
+    expires: float
+    etag: str = None
+    last_modified: str = None
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ListCache:
+    # Lists are copied when they're stored and handed out, so that callers can change
+    # the tournaments in them.
+
+    def __init__(self, ttls=None, default_ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.default_ttl = default_ttl
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _ttl(self, name):
+        return self.ttls.get(name, self.default_ttl)
+
+    def get(self, name):
+        with self._lock:
+            return self._entries.get(name)
+
+    def get_fresh(self, name):
+        entry = self.get(name)
+        if entry is None or entry.expires <= self._clock():
+            return None
+        return [copy(tournament) for tournament in entry.tournaments]
+
+    def store(self, name, tournaments, headers):
+        entry = ListCacheEntry(
+            [copy(tournament) for tournament in tournaments],
+            self._clock() + self._ttl(name),
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+        )
+        with self._lock:
+            self._entries[name] = entry
+
+    def refresh(self, name, entry):
+        # the server says that what we have (entry, from get()) is still up to date.
+        # If it was invalidated or replaced while we asked, that stays that way.
+        with self._lock:
+            if self._entries.get(name) is entry:
+                entry.expires = self._clock() + self._ttl(name)
+        return [copy(tournament) for tournament in entry.tournaments]
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+KEY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    username TEXT NOT NULL,
+    tournament INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    end_ts REAL,
+    PRIMARY KEY (username, tournament)
+);
+CREATE INDEX IF NOT EXISTS keys_end ON keys (end_ts);
+"""
+
+
+class KeyCache:
+    # Tournament keys never change once they're generated, so we only need to fetch
+    # them once - until the tournament ends, then they're of no use anymore.
+
+    def __init__(self, path=None, clock=time.time):
+        self.path = None if path is None else os.fspath(path)
+        # wall clock time, since it's compared with the end of tournaments
+        self._clock = clock
+        # (username, tournament id) -> (key, end timestamp or None if unknown)
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if self.path is not None:
+            self._db = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None, timeout=30
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(KEY_SCHEMA)
+        self.evict_expired()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            if self._db is not None:
+                return self._db.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+            return len(self._keys)
+
+    def _expired(self, end_ts):
+        return end_ts is not None and end_ts <= self._clock()
+
+    def get(self, username, tournament):
+        cache_key = (username, int(tournament))
+        with self._lock:
+            entry = self._keys.get(cache_key)
+            if entry is None and self._db is not None:
+                # maybe another process fetched it
+                entry = self._db.execute(
+                    "SELECT key, end_ts FROM keys WHERE username = ? AND tournament = ?",
+                    cache_key,
+                ).fetchone()
+                if entry is not None:
+                    self._keys[cache_key] = entry
+        if entry is None:
+            return None
+        key, end_ts = entry
+        if self._expired(end_ts):
+            self.evict_expired()
+            return None
+        return key
+
+    def store(self, username, tournament, key):
+        # tournament can be a Tournament instance, so we know when to evict the key
+        if key is None:
+            return
+        end_ts = tournament.end.timestamp() if hasattr(tournament, "end") else None
+        cache_key = (username, int(tournament))
+        with self._lock:
+            if end_ts is None:
+                end_ts = self._keys.get(cache_key, (None, None))[1]
+            self._keys[cache_key] = (key, end_ts)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)",
+                    (*cache_key, key, end_ts),
+                )
+
+    def set_ends(self, tournaments):
+        # learns when tournaments end, for keys we got by tournament id only
+        ends = {tournament.id: tournament.end.timestamp() for tournament in tournaments}
+        with self._lock:
+            for (username, pk), (key, end_ts) in list(self._keys.items()):
+                if end_ts is None and pk in ends:
+                    self._keys[username, pk] = (key, ends[pk])
+            if self._db is not None:
+                unknown = self._db.execute(
+                    "SELECT DISTINCT tournament FROM keys WHERE end_ts IS NULL"
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE keys SET end_ts = ? WHERE tournament = ? AND end_ts IS NULL",
+                    ((ends[pk], pk) for (pk,) in unknown if pk in ends),
+                )
+        self.evict_expired()
+
+    def evict_expired(self):
+        now = self._clock()
+        with self._lock:
+            for cache_key, (_, end_ts) in list(self._keys.items()):
+                if end_ts is not None and end_ts <= now:
+                    del self._keys[cache_key]
+            if self._db is not None:
+                self._db.execute("DELETE FROM keys WHERE end_ts <= ?", (now,))
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from .exceptions import CircuitOpenError
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# responses that mean that the server is in trouble - anything else means it's up
+FAILURE_STATUSES = frozenset((500, 502, 503, 504))
+
+
+class CircuitBreaker:
+    # Stops sending requests after failure_threshold requests in a row failed because
+    # the server is unreachable or in trouble, so that callers fail fast instead of
+    # waiting for retries. After reset_timeout seconds, up to half_open_max requests
+    # are let through to probe whether the server is back.
+
+    def __init__(
+        self,
+        failure_threshold=5,
+        reset_timeout=30,
+        half_open_max=1,
+        failure_statuses=FAILURE_STATUSES,
+        on_state_change=None,
+        clock=time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+        self.failure_statuses = frozenset(failure_statuses)
+        self.on_state_change = on_state_change
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+
+    def _set_state(self, state):
+        # with the lock held, returns the callback to call without it
+        old, self._state = self._state, state
+        if old == state or self.on_state_change is None:
+            return None
+        return lambda: self.on_state_change(old, state)
+
+    def _update(self):
+        if (
+            self._state == OPEN
+            and self._clock() - self._opened_at >= self.reset_timeout
+        ):
+            self._probes = 0
+            return self._set_state(HALF_OPEN)
+        return None
+
+    @property
+    def state(self):
+        with self._lock:
+            callback = self._update()
+            state = self._state
+        if callback is not None:
+            callback()
+        return state
+
+    @property
+    def failures(self):
+        # failed requests in a row
+        with self._lock:
+            return self._failures
+
+    def _retry_after(self):
+        if self._state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - self._clock())
+
+    def retry_after(self):
+        # seconds until requests are let through again, 0 if they are
+        with self._lock:
+            self._update()
+            return self._retry_after()
+
+    def _allows_request(self):
+        if self._state == HALF_OPEN:
+            return self._probes < self.half_open_max
+        return self._state == CLOSED
+
+    def allows_request(self):
+        # whether a request would be let through right now, to shed load early
+        with self._lock:
+            self._update()
+            return self._allows_request()
+
+    def before_request(self):
+        with self._lock:
+            callback = self._update()
+            allowed = self._allows_request()
+            if allowed and self._state == HALF_OPEN:
+                self._probes += 1
+            state = self._state
+            retry_after = self._retry_after()
+        if callback is not None:
+            callback()
+        if not allowed:
+            raise CircuitOpenError(state, retry_after)
+
+    def record(self, status_code):
+        # status_code is None if we didn't get a response
+        if status_code is None or status_code in self.failure_statuses:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            callback = self._set_state(CLOSED)
+        if callback is not None:
+            callback()
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            callback = None
+            if self._state == HALF_OPEN or (
+                self._state == CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._opened_at = self._clock()
+                callback = self._set_state(OPEN)
+        if callback is not None:
+            callback()
+
+    def reset(self):
+        self.record_success()
@@ -0,0 +1,85 @@
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import statistics
+import threading
+
+
+UTC = timezone.utc  # noqa: UP017  datetime.UTC is new in 3.11
+
+# Date headers are truncated to the second, so on average the server's clock was half
+# a second ahead of what the header says
+DATE_RESOLUTION_CORRECTION = timedelta(seconds=0.5)
+
+
+class ServerClock:
+    # Estimates how far the server's clock is ahead of ours, from the Date headers of
+    # its responses.
+    #
+    # The server sends tournament times without time zone. Date headers are always in
+    # GMT, so they don't tell us which one it means - that's server_tz (a tzinfo),
+    # and our local time zone if it's None.
+
+    def __init__(self, max_samples=15, server_tz=None):
+        self.server_tz = server_tz
+        self._samples = deque(maxlen=max_samples)
+        self._rtts = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def observe(self, date, elapsed=None, received=None):
+        if elapsed is not None:
+            with self._lock:
+                self._rtts.append(elapsed.total_seconds())
+        if not date:
+            return
+        try:
+            server_time = parsedate_to_datetime(date)
+        except (TypeError, ValueError):
+            return
+        if server_time.tzinfo is None:
+            server_time = server_time.replace(tzinfo=UTC)
+        if received is None:
+            received = datetime.now(UTC)
+        if elapsed is None:
+            elapsed = timedelta(0)
+        # the response was generated about halfway through the round trip
+        local_time = received - elapsed / 2
+        with self._lock:
+            self._samples.append(
+                (server_time + DATE_RESOLUTION_CORRECTION - local_time).total_seconds()
+            )
+
+    @property
+    def offset(self):
+        with self._lock:
+            if not self._samples:
+                return timedelta(0)
+            # the median, since single responses can be delayed a lot
+            return timedelta(seconds=statistics.median(self._samples))
+
+    @property
+    def rtt(self):
+        # round trip time, None if we haven't seen a response yet
+        with self._lock:
+            if not self._rtts:
+                return None
+            return timedelta(seconds=statistics.median(self._rtts))
+
+    def localize(self, server_time):
+        # naive datetimes are in server_tz
+        if server_time.tzinfo is not None:
+            return server_time
+        if self.server_tz is None:
+            return server_time.astimezone()
+        return server_time.replace(tzinfo=self.server_tz)
+
+    def seconds_until(self, server_time):
+        now = self.now(aware=True)
+        return (self.localize(server_time) - now).total_seconds()
+
+    def now(self, aware=False):
+        # naive datetimes are in server_tz, like the ones the server sends
+        now = datetime.now(UTC) + self.offset
+        if aware:
+            return now
+        return now.astimezone(self.server_tz).replace(tzinfo=None)
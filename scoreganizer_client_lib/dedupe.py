@@ -0,0 +1,179 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+CHUNK_SIZE = 1024 * 1024
+# tournament keys look like <user id>_<tournament id>_<32 hex digits>, and are embedded
+# in the replay header, so they're in the first chunk
+KEY_RE = re.compile(rb"\d+_(\d+)_[0-9a-f]{32}")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploaded (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    tournament INTEGER,
+    uploaded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploaded_uploaded ON uploaded (uploaded);
+CREATE INDEX IF NOT EXISTS uploaded_tournament ON uploaded (tournament);
+CREATE TABLE IF NOT EXISTS paths (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    tournament INTEGER
+);
+CREATE INDEX IF NOT EXISTS paths_hash ON paths (hash);
+"""
+
+
+def hash_file(path):
+    # module level so that it can be used with a process pool
+    digest = hashlib.sha256()
+    tournament = None
+    with open(path, "rb") as file:
+        chunk = file.read(CHUNK_SIZE)
+        match = KEY_RE.search(chunk)
+        if match is not None:
+            tournament = int(match.group(1))
+        while chunk:
+            digest.update(chunk)
+            chunk = file.read(CHUNK_SIZE)
+    return digest.hexdigest(), tournament
+
+
+class UploadIndex:
+    def __init__(self, path=":memory:", max_entries=None):
+        self.path = os.fspath(path)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        if self.path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM uploaded").fetchone()[0]
+
+    def _cached_hash(self, path, stat):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT hash, tournament FROM paths "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        return row
+
+    def _store_hash(self, path, stat, digest, tournament):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest, tournament),
+            )
+
+    def hash(self, path):
+        # (hash, tournament id or None) - only reads the file if the path's size or
+        # mtime changed since we last hashed it
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        cached = self._cached_hash(path, stat)
+        if cached is not None:
+            return cached
+        digest, tournament = hash_file(path)
+        self._store_hash(path, stat, digest, tournament)
+        return digest, tournament
+
+    def hash_many(self, paths, processes=None):
+        results = {}
+        to_hash = []
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            cached = self._cached_hash(path, stat)
+            if cached is not None:
+                results[path] = cached
+            else:
+                to_hash.append((path, stat))
+        if to_hash:
+            with ProcessPoolExecutor(processes) as executor:
+                hashes = executor.map(
+                    hash_file, [path for path, _ in to_hash], chunksize=16
+                )
+                for (path, stat), (digest, tournament) in zip(to_hash, hashes):
+                    self._store_hash(path, stat, digest, tournament)
+                    results[path] = (digest, tournament)
+        return results
+
+    def contains_hash(self, digest):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM uploaded WHERE hash = ?", (digest,)
+            ).fetchone()
+        return row is not None
+
+    def contains(self, path):
+        return self.contains_hash(self.hash(path)[0])
+
+    def add(self, path):
+        digest, tournament = self.hash(path)
+        self.add_hash(digest, os.path.getsize(path), tournament)
+        return digest
+
+    def add_hash(self, digest, size, tournament=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploaded VALUES (?, ?, ?, ?)",
+                (digest, size, tournament, time.time()),
+            )
+        if self.max_entries is not None:
+            self.evict(self.max_entries)
+
+    def evict(self, max_entries):
+        # forget the replays that were uploaded longest ago
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT hash FROM uploaded ORDER BY uploaded DESC LIMIT -1 OFFSET ?",
+                (max_entries,),
+            ).fetchall()
+            self._forget(rows)
+
+    def evict_tournaments(self, tournaments):
+        # replays for tournaments that are over can't be uploaded again anyway
+        ids = [int(tournament) for tournament in tournaments]
+        with self._lock:
+            rows = []
+            for tournament in ids:
+                rows += self._db.execute(
+                    "SELECT hash FROM uploaded WHERE tournament = ?", (tournament,)
+                ).fetchall()
+            self._forget(rows)
+
+    def _forget(self, rows):
+        # with the lock held. Only the cached hashes of the evicted replays go - the
+        # ones of files that weren't uploaded yet are still good.
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany("DELETE FROM uploaded WHERE hash = ?", rows)
+            self._db.executemany("DELETE FROM paths WHERE hash = ?", rows)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
@@ -1,21 +1,48 @@
 from datetime import timedelta
+import random
 import time
 
-from requests.exceptions import RequestException as NetworkException
-
 
 class ScoreganizerError(BaseException):
+    # the HTTP status of the response, if there was one
+    status_code = None
+
     def __init__(self, error):
         self.error = error
 
 
 class ScoreganizerWait(ScoreganizerError):
-    def __init__(self, error, wait_time):
+    def __init__(self, error, wait_time, deadline=None):
         super().__init__(error)
         self.wait_time = wait_time
-
-    def do_wait(self):
-        time.sleep(self.wait_time.total_seconds())
+        # time.monotonic() when the wait is over, so that time spent between getting
+        # the response and waiting doesn't count twice
+        if deadline is None:
+            deadline = time.monotonic() + wait_time.total_seconds()
+        self.deadline = deadline
+
+    def remaining(self, jitter=0):
+        # seconds left to wait, plus up to jitter seconds to avoid everyone retrying
+        # at the same moment
+        return max(0.0, self.deadline - time.monotonic()) + random.uniform(0, jitter)
+
+    def do_wait(self, jitter=0, metrics=None):
+        # returns the seconds waited, which are recorded in metrics if set
+        wait = self.remaining(jitter)
+        time.sleep(wait)
+        if metrics is not None:
+            metrics.record_wait(wait)
+        return wait
+
+    async def do_wait_async(self, jitter=0, metrics=None):
+        # imported here to keep asyncio out of the import path of sync clients
+        import asyncio
+
+        wait = self.remaining(jitter)
+        await asyncio.sleep(wait)
+        if metrics is not None:
+            metrics.record_wait(wait)
+        return wait
 
 
 class ScoreganizerKeyExists(ScoreganizerError):
@@ -39,7 +66,9 @@ class ScoreganizerNotLoggedIn(ScoreganizerError):
 
 
 class ScoreganizerRetry(ScoreganizerError):
-    pass
+    def __init__(self, error, wait_time=None):
+        super().__init__(error)
+        self.wait_time = wait_time
 
 
 class ScoreganizerNotGenerated(ScoreganizerError):
@@ -72,9 +101,13 @@ EXCEPTION_CLS_MAP = {
 }
 
 
-def build_exception(response):
-    if response.content:
-        response_json = response.json()
+def build_exception(response, rtt=None):
+    try:
+        response_json = response.json() if response.content else None
+    except ValueError:
+        # for example, an error page from a proxy
+        response_json = None
+    if isinstance(response_json, dict):
         error = response_json.get("error")
         wait = response_json.get("wait", None)
     else:
@@ -83,12 +116,30 @@ def build_exception(response):
 
     default_cls = ScoreganizerWait if wait is not None else ScoreganizerError
     cls = EXCEPTION_CLS_MAP.get(error, default_cls)
-    if wait is not None:
+    if wait is not None and issubclass(cls, (ScoreganizerWait, ScoreganizerRetry)):
+        # the wait started when the server sent the response, which took half a round
+        # trip to get here, and our next request takes the other half to get there.
+        # response.elapsed also includes retries, so use the typical rtt if we know it
+        if rtt is None:
+            rtt = response.elapsed
         wait_time = timedelta(seconds=float(wait))
-        wait_time -= response.elapsed
+        wait_time -= rtt
         wait_time = max(wait_time, timedelta(seconds=0))
-        return cls(error, wait_time)
-    return cls(error)
+        exception = cls(error, wait_time)
+    else:
+        exception = cls(error)
+    exception.status_code = response.status_code
+    return exception
+
+
+def __getattr__(name):
+    # NetworkException is requests' RequestException, so these are only defined when
+    # they're first used, to keep requests out of our import time
+    if name in ("NetworkException", "CircuitOpenError"):
+        from . import _network
+
+        return getattr(_network, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 __all__ = [
@@ -105,5 +156,6 @@ __all__ = [
     "ScoreganizerNeverGenerated",
     "ScoreganizerTokenTooRecent",
     "build_exception",
-    "NetworkException",
+    "NetworkException",  # noqa: F822  see __getattr__
+    "CircuitOpenError",  # noqa: F822
 ]
@@ -0,0 +1,92 @@
+import codecs
+import json
+
+
+WHITESPACE = " \t\n\r"
+
+# states
+START = 0
+FIRST_VALUE = 1
+VALUE = 2
+SEPARATOR = 3
+END = 4
+
+
+class JsonArrayParser:
+    # Incrementally parses a JSON array, returning its elements as soon as they're
+    # complete. Feed it the response body in chunks as they come in.
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._state = START
+
+    def _skip_whitespace(self):
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return pos < len(buffer)
+
+    def _expect(self, chars):
+        char = self._buffer[self._pos]
+        if char not in chars:
+            raise json.JSONDecodeError(
+                f"Expecting one of {chars!r}", self._buffer, self._pos
+            )
+        self._pos += 1
+        return char
+
+    def feed(self, chunk):
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk = self._text_decoder.decode(chunk)
+        # drop what we've already parsed
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        elements = []
+        while self._skip_whitespace():
+            if self._state == START:
+                self._expect("[")
+                self._state = FIRST_VALUE
+            elif self._state == FIRST_VALUE and self._buffer[self._pos] == "]":
+                # the array is empty
+                self._pos += 1
+                self._state = END
+            elif self._state in (FIRST_VALUE, VALUE):
+                try:
+                    element, end = self._decoder.raw_decode(self._buffer, self._pos)
+                except json.JSONDecodeError:
+                    # incomplete, wait for more
+                    break
+                # a number might continue in the next chunk, so its end is only
+                # certain once we see what comes after it
+                if not isinstance(element, (dict, list, str)) and (
+                    end == len(self._buffer)
+                    or self._buffer[end] not in ",]" + WHITESPACE
+                ):
+                    break
+                elements.append(element)
+                self._pos = end
+                self._state = SEPARATOR
+            elif self._state == SEPARATOR:
+                char = self._expect(",]")
+                self._state = VALUE if char == "," else END
+            else:
+                raise json.JSONDecodeError("Extra data", self._buffer, self._pos)
+        return elements
+
+    def close(self):
+        elements = self.feed(self._text_decoder.decode(b"", final=True))
+        if self._state != END:
+            raise json.JSONDecodeError("Unterminated array", self._buffer, self._pos)
+        return elements
+
+
+def iter_json_array(chunks):
+    parser = JsonArrayParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
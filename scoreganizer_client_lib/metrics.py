@@ -0,0 +1,212 @@
+from bisect import bisect_left
+from functools import lru_cache
+import threading
+from urllib.parse import urlsplit
+
+from .exceptions import ScoreganizerError
+
+
+# seconds - upper bounds of the latency histogram buckets, the last one is unbounded
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@lru_cache(maxsize=1024)
+def endpoint_name(method, url):
+    # "GET get_key/{pk}" for .../api/get_key/123, so that all tournaments (and
+    # players) share one endpoint
+    path = urlsplit(url).path
+    if path.startswith("/api/"):
+        path = path[len("/api/") :]
+    parts = ["{pk}" if part.isdigit() else part for part in path.split("/")]
+    return f"{method} {'/'.join(parts)}"
+
+
+def error_name(error):
+    # the error the server sent (see EXCEPTION_CLS_MAP), or what went wrong getting
+    # there
+    if isinstance(error, ScoreganizerError):
+        return str(error.error)
+    return type(error).__name__
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # the upper bound of the bucket the quantile falls into - the largest value
+        # seen for the unbounded one
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            # (upper bound, count), None for the unbounded bucket
+            "buckets": list(zip((*self.buckets, None), self.counts)),
+        }
+
+
+class EndpointStats:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.latency = Histogram(buckets)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = 0
+        # retries of the whole request (see retry_policy), and the seconds we waited
+        # before them
+        self.retries = 0
+        self.backoff = 0.0
+        # retries of connection problems by urllib3, within one request
+        self.connection_retries = 0
+
+    def snapshot(self):
+        return {
+            "latency": self.latency.snapshot(),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "errors": self.errors,
+            "retries": self.retries,
+            "backoff": self.backoff,
+            "connection_retries": self.connection_retries,
+        }
+
+
+def _content_length(headers):
+    try:
+        return int(headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+class Metrics:
+    # Where the time goes: latency, bytes and retries per endpoint, errors by name, and
+    # the time spent waiting for the server (like for a tournament to start).
+    # Everything is kept here for Scoreganizer.stats(), and also passed to sinks as it
+    # happens - callables taking (name, value, tags), to forward it to statsd,
+    # Prometheus or similar.
+
+    def __init__(self, sinks=(), buckets=DEFAULT_BUCKETS):
+        self.sinks = list(sinks)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # endpoint name -> EndpointStats
+            self._endpoints = {}
+            # error name -> count
+            self._errors = {}
+            self._waits = 0
+            self._wait_time = 0.0
+
+    def _emit(self, name, value, tags):
+        for sink in self.sinks:
+            sink(name, value, tags)
+
+    def _endpoint(self, endpoint):
+        # with the lock held
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = EndpointStats(self.buckets)
+        return stats
+
+    def record_request(
+        self, method, url, seconds, response=None, error=None, stream=False
+    ):
+        # one attempt - response is None if we didn't get one. The body of a streamed
+        # response isn't counted unless it has a Content-Length, since it wasn't read
+        # yet.
+        endpoint = endpoint_name(method, url)
+        sent = received = connection_retries = 0
+        status = None
+        if response is not None:
+            status = response.status_code
+            sent = _content_length(response.request.headers) or 0
+            received = _content_length(response.headers)
+            if received is None:
+                received = 0 if stream else len(response.content)
+            # only requests tells us about urllib3's retries
+            retries = getattr(getattr(response, "raw", None), "retries", None)
+            if retries is not None:
+                connection_retries = len(retries.history)
+        name = None if error is None else error_name(error)
+        with self._lock:
+            stats = self._endpoint(endpoint)
+            stats.latency.observe(seconds)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            stats.connection_retries += connection_retries
+            if name is not None:
+                stats.errors += 1
+                self._errors[name] = self._errors.get(name, 0) + 1
+        if self.sinks:
+            tags = {"endpoint": endpoint, "status": status}
+            self._emit("request.seconds", seconds, tags)
+            self._emit("request.bytes_sent", sent, tags)
+            self._emit("request.bytes_received", received, tags)
+            if connection_retries:
+                self._emit("request.connection_retries", connection_retries, tags)
+            if name is not None:
+                self._emit("error", 1, {**tags, "error": name})
+
+    def record_retry(self, method, url, delay):
+        endpoint = endpoint_name(method, url)
+        with self._lock:
+            stats = self._endpoint(endpoint)
+            stats.retries += 1
+            stats.backoff += delay
+        if self.sinks:
+            self._emit("retry.backoff", delay, {"endpoint": endpoint})
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self._waits += 1
+            self._wait_time += seconds
+        if self.sinks:
+            self._emit("wait.seconds", seconds, {})
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {
+                endpoint: stats.snapshot()
+                for endpoint, stats in sorted(self._endpoints.items())
+            }
+            return {
+                "endpoints": endpoints,
+                "requests": sum(e["latency"]["count"] for e in endpoints.values()),
+                "bytes_sent": sum(e["bytes_sent"] for e in endpoints.values()),
+                "bytes_received": sum(e["bytes_received"] for e in endpoints.values()),
+                "errors": dict(self._errors),
+                "retries": sum(e["retries"] for e in endpoints.values()),
+                "backoff": sum(e["backoff"] for e in endpoints.values()),
+                "connection_retries": sum(
+                    e["connection_retries"] for e in endpoints.values()
+                ),
+                "waits": self._waits,
+                "wait_time": self._wait_time,
+            }
@@ -0,0 +1,400 @@
+from inspect import iscoroutinefunction
+import os
+import sqlite3
+import threading
+import time
+
+from .exceptions import ScoreganizerError
+from .tournament import Tournament
+
+
+# seconds - lists fetched longer ago than this are fetched again
+DEFAULT_MAX_AGE = 60
+
+# PRAGMA user_version - files with an older one are only a copy, so we start over
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tournaments (
+    id INTEGER PRIMARY KEY,
+    mode TEXT,
+    modeparams TEXT,
+    name TEXT,
+    location TEXT,
+    start TEXT NOT NULL,
+    "end" TEXT NOT NULL,
+    open_entry INTEGER NOT NULL,
+    hide_results INTEGER NOT NULL,
+    status TEXT,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tournaments_status ON tournaments (status);
+CREATE INDEX IF NOT EXISTS tournaments_mode ON tournaments (mode);
+CREATE INDEX IF NOT EXISTS tournaments_start ON tournaments (start_ts);
+CREATE INDEX IF NOT EXISTS tournaments_end ON tournaments (end_ts);
+CREATE TABLE IF NOT EXISTS lists (
+    username TEXT NOT NULL,
+    name TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (username, name)
+);
+CREATE TABLE IF NOT EXISTS list_members (
+    username TEXT NOT NULL,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    tournament INTEGER NOT NULL,
+    PRIMARY KEY (username, name, position)
+);
+CREATE TABLE IF NOT EXISTS keys (
+    username TEXT NOT NULL,
+    tournament INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (username, tournament)
+);
+CREATE TABLE IF NOT EXISTS account (
+    username TEXT NOT NULL
+);
+"""
+
+DROP_OLD = """
+DROP TABLE IF EXISTS tournaments;
+DROP TABLE IF EXISTS lists;
+DROP TABLE IF EXISTS list_members;
+DROP TABLE IF EXISTS keys;
+DROP TABLE IF EXISTS account;
+"""
+
+# "end" is quoted, since it's a keyword
+COLUMNS = ", ".join('"end"' if field == "end" else field for field in Tournament.FIELDS)
+LIST_COLUMNS = ", ".join(f"t.{column}" for column in COLUMNS.split(", "))
+
+
+def _isoformat(value):
+    return value if isinstance(value, str) else value.isoformat()
+
+
+def _timestamp(value):
+    # naive datetimes are local time, like in TournamentSnapshot
+    return value.timestamp()
+
+
+def _row(tournament):
+    return (
+        tournament.id,
+        tournament.mode,
+        tournament.modeparams,
+        tournament.name,
+        tournament.location,
+        _isoformat(tournament._start),
+        _isoformat(tournament._end),
+        tournament.open_entry,
+        tournament.hide_results,
+        tournament.status,
+        _timestamp(tournament.start),
+        _timestamp(tournament.end),
+    )
+
+
+def _deserialize_rows(rows):
+    return Tournament.deserialize_many(
+        {
+            "id": pk,
+            "mode": mode,
+            "modeparams": modeparams,
+            "name": name,
+            "location": location,
+            "start": start,
+            "end": end,
+            "open_entry": bool(open_entry),
+            "hide_results": bool(hide_results),
+            "status": status,
+        }
+        for (
+            pk,
+            mode,
+            modeparams,
+            name,
+            location,
+            start,
+            end,
+            open_entry,
+            hide_results,
+            status,
+        ) in rows
+    )
+
+
+class TournamentMirror:
+    # A local copy of the tournament lists and keys we've fetched, in a SQLite file
+    # that can be shared by several processes. Lists include the status of every
+    # tournament for the user that fetched them, so a file belongs to the first user
+    # that stores a list in it, and others are refused.
+
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE, clock=time.time):
+        self.path = os.fspath(path)
+        self.max_age = max_age
+        # wall clock time, since it's compared across processes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        if self.path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._db.executescript(DROP_OLD)
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM tournaments").fetchone()[0]
+
+    def _check_account(self, username):
+        # with the lock held - the user whose statuses we have, None if there are none
+        row = self._db.execute("SELECT username FROM account").fetchone()
+        if row is not None and row[0] != username:
+            raise ValueError(
+                f"{self.path} is used by {row[0]!r}, not {username!r} - "
+                "use one mirror per account"
+            )
+        return row
+
+    @staticmethod
+    def _list_owner(name, username):
+        # only the my_* lists differ between users by more than the status
+        return username if name.startswith("my_") else ""
+
+    @property
+    def account(self):
+        # the username the lists were fetched for, None if there are none yet
+        with self._lock:
+            row = self._db.execute("SELECT username FROM account").fetchone()
+        return None if row is None else row[0]
+
+    def store_list(self, name, tournaments, username=""):
+        # username is who the list was fetched for
+        rows = [_row(tournament) for tournament in tournaments]
+        now = self._clock()
+        owner = self._list_owner(name, username)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if self._check_account(username) is None:
+                    self._db.execute("INSERT INTO account VALUES (?)", (username,))
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO tournaments "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._db.execute(
+                    "DELETE FROM list_members WHERE username = ? AND name = ?",
+                    (owner, name),
+                )
+                self._db.executemany(
+                    "INSERT INTO list_members VALUES (?, ?, ?, ?)",
+                    (
+                        (owner, name, position, row[0])
+                        for position, row in enumerate(rows)
+                    ),
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO lists VALUES (?, ?, ?)",
+                    (owner, name, now),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def list_age(self, name, username=""):
+        # seconds since the list was last stored, None if it never was
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fetched FROM lists WHERE username = ? AND name = ?",
+                (self._list_owner(name, username), name),
+            ).fetchone()
+        if row is None:
+            return None
+        return max(0.0, self._clock() - row[0])
+
+    def get_list(self, name, max_age=None, username=""):
+        # None if we don't have the list, or it's older than max_age
+        if max_age is None:
+            max_age = self.max_age
+        owner = self._list_owner(name, username)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._check_account(username)
+                row = self._db.execute(
+                    "SELECT fetched FROM lists WHERE username = ? AND name = ?",
+                    (owner, name),
+                ).fetchone()
+                if row is None or self._clock() - row[0] >= max_age:
+                    return None
+                rows = self._db.execute(
+                    f"SELECT {LIST_COLUMNS} FROM list_members m "
+                    "JOIN tournaments t ON t.id = m.tournament "
+                    "WHERE m.username = ? AND m.name = ? ORDER BY m.position",
+                    (owner, name),
+                ).fetchall()
+            finally:
+                self._db.execute("COMMIT")
+        return _deserialize_rows(rows)
+
+    def invalidate_lists(self, name=None):
+        # the lists will be fetched again (for all users), the tournaments in them are
+        # kept
+        with self._lock:
+            if name is None:
+                self._db.execute("DELETE FROM lists")
+            else:
+                self._db.execute("DELETE FROM lists WHERE name = ?", (name,))
+
+    def get_key(self, username, tournament):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT key FROM keys WHERE username = ? AND tournament = ?",
+                (username, int(tournament)),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def store_key(self, username, tournament, key):
+        if key is None:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)",
+                (username, int(tournament), key, self._clock()),
+            )
+
+    def _select(self, where="", params=(), order="start_ts, id"):
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {COLUMNS} FROM tournaments {where} ORDER BY {order}", params
+            ).fetchall()
+        return _deserialize_rows(rows)
+
+    def get(self, tournament, default=None):
+        tournaments = self._select("WHERE id = ?", (int(tournament),))
+        return tournaments[0] if tournaments else default
+
+    def __contains__(self, tournament):
+        return self.get(tournament) is not None
+
+    def all(self):
+        return self._select()
+
+    def by_status(self, status):
+        return self._select("WHERE status = ?", (status,))
+
+    def by_mode(self, mode):
+        return self._select("WHERE mode = ?", (mode,))
+
+    def _between(self, column, lower, upper):
+        conditions = []
+        params = []
+        if lower is not None:
+            conditions.append(f"{column} >= ?")
+            params.append(_timestamp(lower))
+        if upper is not None:
+            conditions.append(f"{column} < ?")
+            params.append(_timestamp(upper))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._select(where, params, order=f"{column}, id")
+
+    def starting_between(self, lower=None, upper=None):
+        return self._between("start_ts", lower, upper)
+
+    def ending_between(self, lower=None, upper=None):
+        return self._between("end_ts", lower, upper)
+
+    def upcoming_at(self, time):
+        return self._select("WHERE ? < start_ts", (_timestamp(time),))
+
+    def ended_at(self, time):
+        return self._select("WHERE end_ts <= ?", (_timestamp(time),), "end_ts, id")
+
+    def active_at(self, time):
+        timestamp = _timestamp(time)
+        return self._select(
+            "WHERE start_ts <= ? AND ? < end_ts", (timestamp, timestamp)
+        )
+
+
+class MirrorRefresher:
+    # Keeps lists in the mirror up to date from a background thread, so reads don't
+    # have to wait for the network. Several processes can each run one for the same
+    # mirror - lists that someone else just refreshed are skipped.
+
+    def __init__(
+        self,
+        scoreganizer,
+        lists=("all", "my_active"),
+        interval=30,
+        on_error=None,
+    ):
+        if scoreganizer.mirror is None:
+            raise ValueError("MirrorRefresher needs a Scoreganizer with a mirror")
+        if iscoroutinefunction(scoreganizer.tournaments._fetch_list):
+            raise ValueError("MirrorRefresher doesn't work with AsyncScoreganizer")
+        self.scoreganizer = scoreganizer
+        self.lists = list(lists)
+        self.interval = interval
+        self.on_error = on_error
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def refresh_once(self):
+        mirror = self.scoreganizer.mirror
+        tournaments = self.scoreganizer.tournaments
+        for name in self.lists:
+            age = mirror.list_age(name, tournaments._username())
+            if age is not None and age < self.interval:
+                continue
+            try:
+                tournaments._fetch_list(name)
+            except (ScoreganizerError, Exception) as ex:
+                if self.on_error is not None:
+                    self.on_error(name, ex)
+
+    def _refresh(self):
+        session = self.scoreganizer._init_worker_session()
+        try:
+            while not self._stop.is_set():
+                self.refresh_once()
+                self._stop.wait(self.interval)
+        finally:
+            session.close()
@@ -0,0 +1,126 @@
+import mmap
+import os
+import uuid
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+def _quote(value):
+    # what browsers do, see the HTML spec on multipart/form-data
+    return value.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+
+class _FilePart:
+    def __init__(self, file):
+        self.file = file
+        self.start = None
+        self.length = None
+        if getattr(file, "seekable", lambda: False)():
+            self.start = file.tell()
+            self.length = file.seek(0, os.SEEK_END) - self.start
+            file.seek(self.start)
+
+    def seek(self, offset):
+        if self.start is None:
+            raise OSError("can't rewind a file that isn't seekable")
+        self.file.seek(self.start + offset)
+
+    def read(self, offset, size):
+        # offset is tracked by the file position, see MultipartEncoder.seek
+        return self.file.read(size)
+
+
+class _BufferPart:
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast("B")
+        self.length = len(self.view)
+
+    def seek(self, offset):
+        pass
+
+    def read(self, offset, size):
+        # slicing a memoryview doesn't copy
+        return self.view[offset : offset + size]
+
+
+class MultipartEncoder:
+    # A multipart/form-data body that is generated while it's being sent.
+    #
+    # `files` maps field names to `(filename, source, content_type)`, where `source`
+    # is either a binary filelike object (read in chunks from its current position)
+    # or anything supporting the buffer protocol, which is sent without copying it.
+
+    def __init__(self, fields, files, boundary=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self._parts = []
+        for name, value in fields.items():
+            self._add_header(f'Content-Disposition: form-data; name="{_quote(name)}"')
+            self._add_buffer(f"{value}\r\n".encode())
+        for name, (filename, source, content_type) in files.items():
+            self._add_header(
+                f'Content-Disposition: form-data; name="{_quote(name)}"; '
+                f'filename="{_quote(filename)}"\r\n'
+                f"Content-Type: {content_type}"
+            )
+            if isinstance(source, BUFFER_TYPES):
+                self._parts.append(_BufferPart(source))
+            else:
+                self._parts.append(_FilePart(source))
+            self._add_buffer(b"\r\n")
+        self._add_buffer(f"--{self.boundary}--\r\n".encode())
+
+        lengths = [part.length for part in self._parts]
+        # requests uses this for Content-Length - if it's None, it'll send the body
+        # chunked instead
+        self.len = None if None in lengths else sum(lengths)
+        self._part_index = 0
+        self._part_offset = 0
+        self._position = 0
+
+    def _add_buffer(self, buffer):
+        self._parts.append(_BufferPart(buffer))
+
+    def _add_header(self, header):
+        self._add_buffer(f"--{self.boundary}\r\n{header}\r\n\r\n".encode())
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        # only needed so that requests can rewind the body (digest auth, redirects)
+        if whence != os.SEEK_SET or position != 0:
+            raise OSError("MultipartEncoder can only be rewound")
+        for part in self._parts:
+            part.seek(0)
+        self._part_index = 0
+        self._part_offset = 0
+        self._position = 0
+        return 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(bytes(chunk) for chunk in self)
+        while self._part_index < len(self._parts):
+            part = self._parts[self._part_index]
+            chunk = part.read(self._part_offset, size)
+            if chunk:
+                self._part_offset += len(chunk)
+                self._position += len(chunk)
+                return chunk
+            self._part_index += 1
+            self._part_offset = 0
+        return b""
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
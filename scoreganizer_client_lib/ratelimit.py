@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+BUCKET_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# responses that mean that we're sending too much
+THROTTLE_STATUSES = frozenset((429, 503))
+
+
+class RateLimiter:
+    # A token bucket: on average rate requests per second, with bursts of up to burst
+    # requests. If path is set, the bucket is kept in a SQLite file instead, so that
+    # several processes (say, one per account) can share it.
+
+    def __init__(self, rate=10, burst=None, path=None, name="default", clock=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.path = None if path is None else os.fspath(path)
+        self.name = name
+        if clock is None:
+            # wall clock time if the bucket is shared, since it's compared across
+            # processes
+            clock = time.monotonic if self.path is None else time.time
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._db = None
+        if self.path is not None:
+            self._db = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None, timeout=30
+            )
+            if self.path != ":memory:":
+                self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(BUCKET_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _take(self, tokens, updated, now):
+        # refills the bucket, and takes a token from it - if there is none, it goes
+        # into debt, so that everyone waiting gets their turn in order
+        tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate) - 1
+        return tokens, max(0.0, -tokens / self.rate)
+
+    def reserve(self):
+        # takes a token, returns the seconds to wait before sending the request
+        now = self._clock()
+        with self._lock:
+            if self._db is None:
+                self._tokens, delay = self._take(self._tokens, self._updated, now)
+                self._updated = now
+                return delay
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT tokens, updated FROM buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                tokens, updated = (self.burst, now) if row is None else row
+                tokens, delay = self._take(tokens, updated, now)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                    (self.name, tokens, now),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveConcurrency:
+    # Limits how many requests are in flight at once. The limit grows by about one
+    # for every limit requests that succeed, and is cut to backoff times itself when
+    # the server says that we're sending too much (additive increase, multiplicative
+    # decrease, like TCP does). Only one cut per round of requests counts, so that a
+    # burst of 429s doesn't send the limit straight down to minimum.
+
+    def __init__(
+        self,
+        initial=4,
+        minimum=1,
+        maximum=32,
+        backoff=0.5,
+        throttle_statuses=THROTTLE_STATUSES,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.throttle_statuses = frozenset(throttle_statuses)
+        self._limit = float(initial)
+        self._in_flight = 0
+        # bumped on every cut - requests sent before that don't cut again
+        self._generation = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        with self._cond:
+            return self._current_limit()
+
+    @property
+    def in_flight(self):
+        with self._cond:
+            return self._in_flight
+
+    def _current_limit(self):
+        return max(self.minimum, int(self._limit))
+
+    def _has_room(self):
+        return self._in_flight < self._current_limit()
+
+    def _take(self):
+        self._in_flight += 1
+        return self._generation
+
+    def acquire(self):
+        # blocks until the request may be sent, returns the slot to release
+        with self._cond:
+            while not self._has_room():
+                self._cond.wait()
+            return self._take()
+
+    def _notify(self):
+        self._cond.notify_all()
+
+    def release(self, slot, status_code=None):
+        # status_code is None if we didn't get a response, which doesn't change the
+        # limit
+        with self._cond:
+            self._in_flight -= 1
+            if status_code in self.throttle_statuses:
+                if slot == self._generation:
+                    self._generation += 1
+                    self._limit = max(self.minimum, self._limit * self.backoff)
+            elif status_code is not None:
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+            self._notify()
@@ -0,0 +1,149 @@
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+from .clock import UTC
+from .exceptions import ScoreganizerError, ScoreganizerRetry, ScoreganizerWait
+
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+# methods that can be sent again, whatever happened to the first try
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+# responses that mean that the server didn't handle the request, so that even a POST
+# can be sent again - after a 502 or 504 from a proxy, the upload may have gone through
+UNHANDLED_STATUSES = frozenset((429, 503))
+
+
+def parse_retry_after(value, now=None):
+    # seconds, from either form of the Retry-After header
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=UTC)
+    if now is None:
+        now = datetime.now(UTC)
+    return max(0.0, (when - now).total_seconds())
+
+
+class RetryBudget:
+    # Allows retries for only a fraction of requests, so that when the server is
+    # struggling, we don't make it worse by sending every request several times.
+    # Every request adds ratio tokens, every retry takes one.
+
+    def __init__(self, ratio=0.2, initial=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(initial)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        with self._lock:
+            return self._tokens
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    # Exponential backoff with decorrelated jitter: every delay is random between
+    # base_delay and three times the previous one, capped at max_delay. Waits the
+    # server asks for (Retry-After, or the wait field) are used instead, and no call
+    # keeps retrying for longer than max_elapsed seconds.
+
+    def __init__(
+        self,
+        tries=5,
+        base_delay=0.3,
+        max_delay=30,
+        max_elapsed=120,
+        statuses=RETRY_STATUSES,
+        budget=None,
+        clock=time.monotonic,
+    ):
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.statuses = frozenset(statuses)
+        self.budget = RetryBudget() if budget is None else budget
+        self._clock = clock
+
+    def start(self, tries=None):
+        # call once per call, before its first request
+        self.budget.deposit()
+        return RetryState(self, self.tries if tries is None else tries)
+
+    def is_retryable(self, response=None, error=None, method="GET"):
+        if isinstance(error, ScoreganizerRetry):
+            return True
+        # errors the server told us about specifically (like token_too_recent, which
+        # comes with a 429) won't go away by trying again
+        if type(error) not in (ScoreganizerError, ScoreganizerWait):
+            return False
+        if response is None or response.status_code not in self.statuses:
+            return False
+        return (
+            method in IDEMPOTENT_METHODS or response.status_code in UNHANDLED_STATUSES
+        )
+
+    def backoff(self, previous):
+        upper = max(self.base_delay, previous * 3)
+        return min(self.max_delay, random.uniform(self.base_delay, upper))
+
+
+class RetryState:
+    # the retries of a single call
+
+    def __init__(self, policy, tries):
+        self.policy = policy
+        self.tries = tries
+        self.attempts = 1
+        self._started = policy._clock()
+        self._previous = policy.base_delay
+
+    def _server_delay(self, response, error):
+        wait_time = getattr(error, "wait_time", None)
+        if wait_time is not None:
+            return wait_time.total_seconds()
+        if response is not None:
+            return parse_retry_after(response.headers.get("Retry-After"))
+        return None
+
+    def next_delay(self, response=None, error=None):
+        # seconds to wait before trying again, or None to give up
+        policy = self.policy
+        if self.attempts >= self.tries:
+            return None
+        delay = self._server_delay(response, error)
+        if delay is None:
+            delay = self._previous = policy.backoff(self._previous)
+        if policy._clock() - self._started + delay > policy.max_elapsed:
+            return None
+        # retries the server asked for don't count - the budget is for when it's
+        # struggling, and then it doesn't tell us to retry
+        requested = isinstance(error, ScoreganizerRetry) or (
+            getattr(error, "wait_time", None) is not None
+        )
+        if not requested and not policy.budget.withdraw():
+            return None
+        self.attempts += 1
+        return delay
@@ -0,0 +1,182 @@
+from concurrent.futures import Future
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from .exceptions import ScoreganizerError, ScoreganizerKeyExists, ScoreganizerWait
+
+
+class KeyScheduler:
+    # Waits for the keys of many tournaments with a single thread: one heap of
+    # (when to try gen_key next, tournament id), ordered by the wait times the server
+    # tells us.
+
+    def __init__(
+        self,
+        tournaments,
+        on_key=None,
+        on_error=None,
+        jitter=0,
+        clock=time.monotonic,
+    ):
+        self.tournaments = tournaments
+        self.jitter = jitter
+        self.on_key = on_key
+        self.on_error = on_error
+        self._clock = clock
+        # (due, seq, tournament) - seq so that ties are in scheduling order, and
+        # tournaments are never compared
+        self._heap = []
+        self._seq = itertools.count()
+        # tournament id -> future, for tournaments we don't have the key of yet
+        self._futures = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._futures)
+
+    def _new_future(self):
+        return Future()
+
+    def _wake(self):
+        self._cond.notify_all()
+
+    def schedule(self, tournament):
+        # scheduling a tournament again returns the same future
+        pk = int(tournament)
+        key = self.tournaments._cached_key(tournament)
+        delay = self.tournaments._seconds_until_start(tournament)
+        if delay > 0:
+            delay += random.uniform(0, self.jitter)
+        with self._cond:
+            future = self._futures.get(pk)
+            if future is not None:
+                return future
+            future = self._futures[pk] = self._new_future()
+            if key is None:
+                self._push(tournament, self._clock() + delay)
+                self._wake()
+        if key is not None:
+            self._resolve(pk, key)
+        return future
+
+    def schedule_many(self, tournaments):
+        return [self.schedule(tournament) for tournament in tournaments]
+
+    def _push(self, tournament, due):
+        heapq.heappush(self._heap, (due, next(self._seq), tournament))
+
+    def _pop_due(self):
+        now = self._clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def _timeout(self):
+        # seconds until the next key is due, None if nothing is scheduled
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self._clock())
+
+    def _retry_later(self, tournament, ex):
+        with self._cond:
+            if self._stopping:
+                return
+            self._push(tournament, self._clock() + ex.remaining(self.jitter))
+
+    def _resolve(self, pk, key=None, error=None):
+        # the future is gone (and cancelled) if we were stopped during the request
+        with self._cond:
+            if self._stopping:
+                return
+            future = self._futures.pop(pk, None)
+        if future is None:
+            return
+        if error is None:
+            future.set_result(key)
+            if self.on_key is not None:
+                self.on_key(pk, key)
+        else:
+            future.set_exception(error)
+            if self.on_error is not None:
+                self.on_error(pk, error)
+
+    def _fire(self, tournament):
+        # tournament, not just the id, so that key caches know when it ends
+        try:
+            try:
+                key = self.tournaments.gen_key(tournament)
+            except ScoreganizerKeyExists:
+                key = self.tournaments.get_key(tournament)
+        except ScoreganizerWait as ex:
+            self._retry_later(tournament, ex)
+        except (ScoreganizerError, Exception) as ex:
+            self._resolve(int(tournament), error=ex)
+        else:
+            self._resolve(int(tournament), key)
+
+    def run_pending(self):
+        # fires everything that's due, returns the seconds until the next key is due
+        with self._cond:
+            due = self._pop_due()
+        for tournament in due:
+            self._fire(tournament)
+        with self._cond:
+            return self._timeout()
+
+    def run(self):
+        # blocks until we have all keys (or errors)
+        while True:
+            timeout = self.run_pending()
+            with self._cond:
+                if not self._futures or self._stopping:
+                    return
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run_in_worker, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run_in_worker(self):
+        session = self.tournaments._sc._init_worker_session()
+        try:
+            while True:
+                self.run()
+                with self._cond:
+                    # wait for more tournaments to be scheduled
+                    while not self._futures and not self._stopping:
+                        self._cond.wait()
+                    if self._stopping:
+                        return
+        finally:
+            session.close()
+
+    def stop(self):
+        # futures for keys we don't have yet are cancelled
+        with self._cond:
+            self._stopping = True
+            self._wake()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._cond:
+            futures = list(self._futures.values())
+            self._futures.clear()
+            self._heap.clear()
+        for future in futures:
+            future.cancel()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,7 +1,61 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+import mmap
 import os
 import time
 
-from .exceptions import ScoreganizerRetry
+from .exceptions import ScoreganizerError
+from .multipart import BUFFER_TYPES, MultipartEncoder
+
+
+@dataclass
+class UploadResult:
+    filename: str
+    size: int
+    error: BaseException = None
+    skipped: bool = False
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+@dataclass
+class BulkUploadReport:
+    results: list
+    elapsed: float
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def skipped(self):
+        return [result for result in self.results if result.skipped]
+
+    @property
+    def bytes_sent(self):
+        return sum(result.size for result in self.succeeded if not result.skipped)
+
+    @property
+    def files_per_second(self):
+        return len(self.succeeded) / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f"uploaded {len(self.succeeded) - len(self.skipped)}/{len(self.results)} "
+            f"files ({len(self.skipped)} skipped, {self.bytes_sent} bytes) "
+            f"in {self.elapsed:.2f}s: "
+            f"{self.files_per_second:.2f} files/s, {self.bytes_per_second:.0f} bytes/s"
+        )
 
 
 class Scores:
@@ -21,36 +75,132 @@ class Scores:
             "avf": "application/x-minesweeper-arbiter",
         }.get(ext, "application/x-viennasweeper")
 
-    def upload_filename(self, filename, ext=None, mime_type=None, tries=10):
+    @contextmanager
+    def _open_mmap(self, file):
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # can't map empty files
+            yield file
+            return
+        with mapped:
+            yield mapped
+
+    def upload_filename(
+        self, filename, ext=None, mime_type=None, tries=10, stream=False
+    ):
         # support pathlib.Path
         filename = str(filename)
+        index = self._sc.upload_index
+        if index is not None:
+            digest, tournament = index.hash(filename)
+            if index.contains_hash(digest):
+                return False
         with open(filename, "rb") as file:
-            return self.upload_file(
-                file, filename, ext=ext, mime_type=mime_type, tries=tries
+            if not stream:
+                self.upload_file(
+                    file, filename, ext=ext, mime_type=mime_type, tries=tries
+                )
+            else:
+                with self._open_mmap(file) as source:
+                    self.upload_file(
+                        source,
+                        filename,
+                        ext=ext,
+                        mime_type=mime_type,
+                        tries=tries,
+                        stream=True,
+                    )
+        if index is not None:
+            index.add_hash(digest, os.path.getsize(filename), tournament)
+        return True
+
+    def _upload_result(self, filename, **kwargs):
+        filename = str(filename)
+        result = UploadResult(filename, 0)
+        try:
+            result.size = os.path.getsize(filename)
+            result.skipped = not self.upload_filename(filename, **kwargs)
+        except (ScoreganizerError, Exception) as ex:
+            result.error = ex
+        return result
+
+    def _bulk_upload(self, upload, items, concurrency):
+        start = time.monotonic()
+        results = self._sc._map_in_workers(upload, items, concurrency)
+        return BulkUploadReport(results, time.monotonic() - start)
+
+    def upload_many(self, filenames, concurrency=4, tries=10, stream=False):
+        def upload(filename):
+            return self._upload_result(filename, tries=tries, stream=stream)
+
+        return self._bulk_upload(upload, filenames, concurrency)
+
+    def drain_queue(self, upload_queue, concurrency=4, tries=10, stream=False):
+        def upload(queued):
+            if not upload_queue.claim(queued.id):
+                # another process sharing the queue is uploading it
+                return None
+            result = self._upload_result(
+                queued.filename,
+                ext=queued.ext,
+                mime_type=queued.mime_type,
+                tries=tries,
+                stream=stream,
             )
+            upload_queue.finish(queued.id, result.error)
+            return result
 
-    def upload_file(self, file, filename, ext=None, mime_type=None, tries=10):
+        report = self._bulk_upload(upload, upload_queue.pending(), concurrency)
+        report.results = [result for result in report.results if result is not None]
+        return report
+
+    def upload_file(
+        self, file, filename, ext=None, mime_type=None, tries=10, stream=False
+    ):
         # support pathlib.Path
         filename = str(filename)
-        done_tries = 0
-        while True:
-            try:
-                done_tries += 1
-                return self._upload_file(file, filename, ext=ext, mime_type=mime_type)
-            except ScoreganizerRetry as ex:
-                if done_tries >= tries:
-                    raise ex
-                time.sleep(0.3)
-
-    def _upload_file(self, file, filename, ext=None, mime_type=None):
+        is_buffer = isinstance(file, BUFFER_TYPES)
+        upload = self._upload_stream if stream or is_buffer else self._upload_file
+        return upload(file, filename, ext=ext, mime_type=mime_type, tries=tries)
+
+    def _upload_args(self, filename, ext=None, mime_type=None):
         filename = os.path.split(filename)[-1]
         if mime_type is None:
             if ext is None:
                 ext = filename.rsplit(".", 1)[-1]
             mime_type = self._mime_type_from_ext(ext)
-        response = self.session.post(
+        return filename, mime_type
+
+    def _rewinder(self, file):
+        # so that retries send the whole file again
+        if not getattr(file, "seekable", lambda: False)():
+            return None
+        start = file.tell()
+        return lambda: file.seek(start)
+
+    def _upload_file(self, file, filename, ext=None, mime_type=None, tries=None):
+        filename, mime_type = self._upload_args(filename, ext=ext, mime_type=mime_type)
+        self._sc._request(
+            "POST",
             self._url("upload"),
+            tries=tries,
+            before_retry=self._rewinder(file),
             files={"video": (filename, file)},
             data={"mime_type": mime_type},
         )
-        self._sc._raise_if_error(response)
+
+    def _upload_stream(self, source, filename, ext=None, mime_type=None, tries=None):
+        filename, mime_type = self._upload_args(filename, ext=ext, mime_type=mime_type)
+        encoder = MultipartEncoder(
+            {"mime_type": mime_type},
+            {"video": (filename, source, "application/octet-stream")},
+        )
+        self._sc._request(
+            "POST",
+            self._url("upload"),
+            tries=tries,
+            before_retry=lambda: encoder.seek(0),
+            data=encoder,
+            headers={"Content-Type": encoder.content_type},
+        )
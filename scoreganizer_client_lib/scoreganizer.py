@@ -1,24 +1,42 @@
-import requests
-from requests.auth import HTTPDigestAuth
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+import time
+import weakref
 
-from .exceptions import build_exception
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not on Windows - the auth file is still replaced atomically, but not locked
+    fcntl = None
+
+from .api_token import TokenManager
+from .clock import ServerClock
+from .exceptions import ScoreganizerError, ScoreganizerNotLoggedIn, build_exception
+from .retry import IDEMPOTENT_METHODS, RetryPolicy
 from .score import Scores
 from .tournament import Tournaments
+from .transport import RequestsTransport, requests_defaults
+
+
+AUTH_HEADER = "X-Scoreganizer-Authorization"
 
 
-DEFAULT_RETRY = Retry(
-    total=5,
-    read=5,
-    connect=5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    backoff_factor=8,
-)
-DEFAULT_ADAPTER = HTTPAdapter(max_retries=DEFAULT_RETRY)
+def __getattr__(name):
+    # DEFAULT_RETRY and DEFAULT_ADAPTER are only made (and requests imported) when
+    # they're first used
+    if name in ("DEFAULT_RETRY", "DEFAULT_ADAPTER"):
+        return requests_defaults()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class Scoreganizer:
+    tournaments_cls = Tournaments
+    scores_cls = Scores
+    tokens_cls = TokenManager
+
     def __init__(
         self,
         host="scoreganizer.net",
@@ -28,30 +46,178 @@ class Scoreganizer:
         digest_auth_password=None,
         http_adapter=None,
         auth_filename=None,
+        upload_index=None,
+        list_cache=None,
+        mirror=None,
+        key_cache=None,
+        retry_policy=None,
+        circuit_breaker=None,
+        rate_limiter=None,
+        concurrency_limiter=None,
+        session=None,
+        thread_safe=False,
+        pool_maxsize=None,
+        transport=None,
+        metrics=None,
     ):
         self.host = host
         self.port = port
         self.https = https
+        self.upload_index = upload_index
+        self.list_cache = list_cache
+        self.mirror = mirror
+        self.key_cache = key_cache
+        # the retry budget is per client
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter
+        self.concurrency_limiter = concurrency_limiter
+        self.metrics = metrics
+        self.clock = ServerClock()
+        self._local = threading.local()
+        # if set, every thread but the one we were created in gets its own session
+        self.thread_safe = thread_safe
+        self._owner = threading.get_ident()
+        self._thread_sessions = weakref.WeakSet()
+        self._thread_sessions_lock = threading.Lock()
+
+        if pool_maxsize is not None:
+            if http_adapter is not None:
+                raise ValueError("pass either http_adapter or pool_maxsize, not both")
+            from requests.adapters import HTTPAdapter
 
-        if http_adapter is None:
-            http_adapter = DEFAULT_ADAPTER
+            http_adapter = HTTPAdapter(
+                max_retries=requests_defaults()["DEFAULT_RETRY"],
+                pool_maxsize=pool_maxsize,
+            )
+        if transport is None:
+            # DEFAULT_ADAPTER if http_adapter is None
+            transport = RequestsTransport(http_adapter)
+        elif http_adapter is not None:
+            raise ValueError("http_adapter and pool_maxsize only work with requests")
+        self.transport = transport
 
         digest_auth = self._get_digest_auth(digest_auth_username, digest_auth_password)
-        self.session = requests.Session()
-        if digest_auth is not None:
-            self.session.auth = digest_auth
-        self.session.mount("http://", http_adapter)
-        self.session.mount("https://", http_adapter)
-        self.tournaments = Tournaments(self)
-        self.scores = Scores(self)
+        self._http_adapter = http_adapter
+        self._digest_auth = digest_auth
+        # a session shared with other instances (see AccountPool) doesn't have our
+        # credentials, we send them with every request instead
+        self._shared_session = session is not None
+        self._auth = None
+        # our own session is made when it's first used, see _main_session
+        self._session = session
+        self._session_lock = threading.Lock()
+        self.tournaments = self.tournaments_cls(self)
+        self.scores = self.scores_cls(self)
+        self.tokens = self.tokens_cls(self)
         self.auth_filename = auth_filename
         self.username = None
+        # (inode, mtime, size) of the auth file when we last read or wrote it
+        self._auth_file_stat = None
+        self._auth_file_lock = threading.Lock()
+        # for refreshing the token, which can take a while, and the same thread
+        # writes the auth file while holding it
+        self._auth_refresh_lock = threading.RLock()
+        self._auth_refresh_depth = 0
+        self._auth_lock_file = None
         if self.auth_filename is not None:
             self._read_auth_file()
 
+    @property
+    def session(self):
+        # worker threads (see _map_in_workers) use their own session
+        session = getattr(self._local, "session", None)
+        if session is None:
+            if not self.thread_safe or threading.get_ident() == self._owner:
+                return self._main_session()
+            session = self._init_thread_session()
+        # the credentials may have changed since the session was made
+        auth_str = None if self._shared_session else self._auth
+        if session.headers.get(AUTH_HEADER) != auth_str:
+            if auth_str is None:
+                session.headers.pop(AUTH_HEADER, None)
+            else:
+                session.headers[AUTH_HEADER] = auth_str
+        return session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    def _main_session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = self._make_session(self._http_adapter, self._digest_auth)
+                    if self._auth is not None:
+                        session.headers[AUTH_HEADER] = self._auth
+                    self._session = session
+        return self._session
+
+    def _make_session(self, http_adapter, digest_auth):
+        return self.transport.open(self._observe_response, digest_auth)
+
+    def _observe_response(self, response, *args, **kwargs):
+        self.clock.observe(response.headers.get("Date"), response.elapsed)
+
+    def _clone_session(self):
+        # for use by worker threads, since sessions aren't thread-safe
+        session = self._make_session(self._http_adapter, self._digest_auth)
+        session.headers.update(self._main_session().headers)
+        return session
+
+    def _init_worker_session(self):
+        # gives the calling thread its own session, the caller has to close it
+        session = self._clone_session()
+        self._local.session = session
+        return session
+
+    def _init_thread_session(self):
+        # for thread safe mode - kept until the thread is gone, or we're closed
+        session = self._init_worker_session()
+        with self._thread_sessions_lock:
+            self._thread_sessions.add(session)
+        return session
+
+    def close(self):
+        with self._thread_sessions_lock:
+            sessions = list(self._thread_sessions)
+            self._thread_sessions.clear()
+        for session in sessions:
+            session.close()
+        # a shared session is closed by whoever shared it
+        if not self._shared_session:
+            if self._session is not None:
+                self._session.close()
+            self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _map_in_workers(self, fn, items, concurrency):
+        sessions = []
+        lock = threading.Lock()
+
+        def init_worker():
+            session = self._init_worker_session()
+            with lock:
+                sessions.append(session)
+
+        try:
+            with ThreadPoolExecutor(concurrency, initializer=init_worker) as executor:
+                return list(executor.map(fn, items))
+        finally:
+            for session in sessions:
+                session.close()
+
     def _get_digest_auth(self, username, password):
         if username is None or password is None:
             return None
+        from requests.auth import HTTPDigestAuth
+
         return HTTPDigestAuth(username, password)
 
     @property
@@ -63,28 +229,129 @@ class Scoreganizer:
         return f"{self._base_url}{path}"
 
     def _raise_if_error(self, response):
-        if not response.ok:
-            raise build_exception(response)
+        # not response.ok, so that httpx responses work here too
+        if response.status_code >= 400:
+            error = build_exception(response, rtt=self.clock.rtt)
+            if isinstance(error, ScoreganizerNotLoggedIn):
+                self.tokens.invalidate()
+            try:
+                raise error
+            finally:
+                # the traceback would keep this frame alive, and with it the response
+                # (and the buffers of uploads that are still being retried)
+                del error
+
+    @property
+    def retry_exceptions(self):
+        # connection problems that are worth retrying for requests without side
+        # effects. requests was imported with the session, so this is cheap.
+        import requests
+
+        return (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    idempotent_methods = IDEMPOTENT_METHODS
+
+    def _should_retry(self, method, response, error):
+        if isinstance(error, ScoreganizerError):
+            return self.retry_policy.is_retryable(response, error, method)
+        return method in self.idempotent_methods
+
+    def _record_outcome(self, response, slot=None):
+        status_code = None if response is None else response.status_code
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(status_code)
+        if slot is not None:
+            self.concurrency_limiter.release(slot, status_code)
+
+    def _circuit_open_after(self, delay):
+        # no use waiting for a retry that the circuit breaker won't let through
+        breaker = self.circuit_breaker
+        return breaker is not None and breaker.retry_after() > delay
+
+    def _with_auth(self, kwargs):
+        if not self._shared_session or self._auth is None:
+            return kwargs
+        headers = {AUTH_HEADER: self._auth, **(kwargs.get("headers") or {})}
+        return {**kwargs, "headers": headers}
+
+    def _request(self, method, url, tries=None, before_retry=None, **kwargs):
+        # sends a request, retrying according to the retry policy, and raises if the
+        # response is an error. before_retry is called before every retry, for
+        # example to rewind files that are being uploaded.
+        self._reload_auth_file()
+        kwargs = self._with_auth(kwargs)
+        retry = self.retry_policy.start(tries)
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_request()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            slot = None
+            if self.concurrency_limiter is not None:
+                slot = self.concurrency_limiter.acquire()
+            response = error = None
+            start = None if self.metrics is None else time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                self._raise_if_error(response)
+            except ScoreganizerError as ex:
+                error = ex
+            except self.retry_exceptions as ex:
+                error = ex
+            finally:
+                self._record_outcome(response, slot)
+                if start is not None:
+                    self.metrics.record_request(
+                        method,
+                        url,
+                        time.perf_counter() - start,
+                        response,
+                        error,
+                        kwargs.get("stream", False),
+                    )
+            if error is None:
+                return response
+            if not self._should_retry(method, response, error):
+                raise error
+            delay = retry.next_delay(response, error)
+            if delay is None or self._circuit_open_after(delay):
+                raise error
+            if self.metrics is not None:
+                self.metrics.record_retry(method, url, delay)
+            if response is not None:
+                response.close()
+            if before_retry is not None:
+                try:
+                    before_retry()
+                except OSError:
+                    # we can't send the same request again
+                    raise error from None
+            time.sleep(delay)
+
+    def stats(self):
+        # what metrics recorded so far, None without metrics
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot()
 
     def token_status(self):
-        response = self.session.get(
-            self._url("token_status"),
-        )
-        self._raise_if_error(response)
-        return response.json().get("status")
+        response = self._request("GET", self._url("token_status"))
+        status = response.json().get("status")
+        self.tokens.observe_status(status)
+        return status
 
     def token_status_ok(self):
         return self.token_status().startswith("ok")
 
     def login(self, username, password):
-        response = self.session.post(
+        response = self._request(
+            "POST",
             self._url("obtain_token"),
             data={
                 "username": username,
                 "password": password,
             },
         )
-        self._raise_if_error(response)
         api_token = response.json().get("token", None)
         self.username = username
         return self._set_token(api_token)
@@ -92,34 +359,129 @@ class Scoreganizer:
     def _set_token(self, api_token):
         auth_str = f"{self.username}:{api_token}"
         self.set_auth_str(auth_str)
+        self.tokens.token_issued()
         return auth_str
 
     def refresh_login(self):
-        response = self.session.post(self._url("refresh_token"))
-        self._raise_if_error(response)
-        return self._set_token(response.json().get("token"))
+        with self._locked_auth_file():
+            # if another process sharing the auth file just refreshed the token, we
+            # use theirs instead
+            if self._reload_auth_file():
+                return self._auth_str
+            response = self._request("POST", self._url("refresh_token"))
+            return self._set_token(response.json().get("token"))
 
     def refresh_login_if_stale(self):
-        if self.token_status() == "ok_stale":
-            return self.refresh_login()
-        return None
+        return self.tokens.refresh_if_stale()
+
+    @property
+    def _auth_str(self):
+        return self._auth
 
     def set_auth_str(self, auth_str):
-        self.session.headers.update(
-            {
-                "X-Scoreganizer-Authorization": auth_str,
-            }
-        )
+        self._use_auth_str(auth_str)
         if self.auth_filename is not None:
             self._write_auth_file(auth_str)
 
+    def _use_auth_str(self, auth_str, issued=None):
+        self._auth = auth_str
+        # a shared session gets it with every request, and other sessions of ours pick
+        # it up when they're next used (or made)
+        if not self._shared_session:
+            with self._session_lock:
+                if self._session is not None:
+                    self._session.headers.update(
+                        {
+                            AUTH_HEADER: auth_str,
+                        }
+                    )
+        self.tokens.token_changed(issued)
+        # lists include the status for the current user
+        if self.list_cache is not None:
+            self.list_cache.invalidate()
+
+    @staticmethod
+    def _stat_key(stat):
+        # the file is replaced to change it, so the inode changes, too
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @contextmanager
+    def _locked_auth_file(self):
+        # keeps other processes (and threads) from writing the auth file, or
+        # refreshing the token, until we're done
+        if self.auth_filename is None:
+            yield
+            return
+        with self._auth_refresh_lock:
+            if self._auth_refresh_depth == 0 and fcntl is not None:
+                # a separate file, since the auth file itself is replaced
+                self._auth_lock_file = open(
+                    f"{os.fspath(self.auth_filename)}.lock", "a"
+                )
+                fcntl.flock(self._auth_lock_file, fcntl.LOCK_EX)
+            self._auth_refresh_depth += 1
+            try:
+                yield
+            finally:
+                self._auth_refresh_depth -= 1
+                if self._auth_refresh_depth == 0 and self._auth_lock_file is not None:
+                    # closing it releases the lock
+                    self._auth_lock_file.close()
+                    self._auth_lock_file = None
+
+    def _reload_auth_file(self):
+        # reads the auth file again if someone else changed it, returns whether we did.
+        # Cheap enough to do before every request.
+        if self.auth_filename is None:
+            return False
+        try:
+            stat_key = self._stat_key(os.stat(self.auth_filename))
+        except OSError:
+            return False
+        if stat_key == self._auth_file_stat:
+            return False
+        with self._auth_file_lock:
+            if stat_key == self._auth_file_stat:
+                return False
+            self._read_auth_file()
+        return True
+
     def _read_auth_file(self):
-        # a+ and seek(0) to create the file if it doesn't exist yet
+        # a+ and seek(0) to create the file if it doesn't exist yet. It's replaced
+        # atomically, so we never read half of it.
         with open(self.auth_filename, "a+") as auth_file:
             auth_file.seek(0)
+            stat = os.fstat(auth_file.fileno())
             # rstrip in case someone edits the file and saves with trailing newline
-            self.set_auth_str(auth_file.read().rstrip())
+            auth_str = auth_file.read().rstrip()
+        self._auth_file_stat = self._stat_key(stat)
+        if auth_str:
+            self.username = auth_str.split(":", 1)[0]
+        # the token was issued when the file was last written, at the latest
+        self._use_auth_str(auth_str, issued=stat.st_mtime if auth_str else None)
 
     def _write_auth_file(self, auth_str):
-        with open(self.auth_filename, "w") as auth_file:
-            auth_file.write(auth_str)
+        # to a temporary file that then replaces the auth file, so that other
+        # processes never see a half-written one
+        filename = os.fspath(self.auth_filename)
+        directory, basename = os.path.split(os.path.abspath(filename))
+        with self._locked_auth_file():
+            fd, tmp_filename = tempfile.mkstemp(
+                prefix=f".{basename}.", suffix=".tmp", dir=directory
+            )
+            try:
+                with os.fdopen(fd, "w") as auth_file:
+                    auth_file.write(auth_str)
+                    auth_file.flush()
+                    os.fsync(auth_file.fileno())
+                    # the same after the rename, so we don't read our own write again
+                    stat = os.fstat(auth_file.fileno())
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                try:
+                    os.unlink(tmp_filename)
+                except OSError:
+                    pass
+                raise
+            with self._auth_file_lock:
+                self._auth_file_stat = self._stat_key(stat)
@@ -1,39 +1,206 @@
 from datetime import datetime
-from dataclasses import dataclass
+import random
+from sys import intern
+import time
+from dataclasses import dataclass, field
 
 from .exceptions import ScoreganizerKeyExists, ScoreganizerTooEarly
+from .jsonstream import iter_json_array
+from .scheduler import KeyScheduler
+
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _intern(value):
+    # the server may send null
+    return intern(value) if isinstance(value, str) else value
 
 
-@dataclass
 class Tournament:
-    id: int
-    mode: str
-    modeparams: str
-    name: str
-    location: str
-    start: datetime
-    end: datetime
-    open_entry: bool
-    hide_results: bool
-    status: str
+    # Not a dataclass, to save memory (__slots__, which dataclasses only support from
+    # python 3.10) and time (start and end are only parsed when they're used). Lists
+    # of thousands of archived tournaments are common.
+
+    FIELDS = (
+        "id",
+        "mode",
+        "modeparams",
+        "name",
+        "location",
+        "start",
+        "end",
+        "open_entry",
+        "hide_results",
+        "status",
+    )
+
+    __slots__ = (
+        "_end",
+        "_start",
+        "hide_results",
+        "id",
+        "location",
+        "mode",
+        "modeparams",
+        "name",
+        "open_entry",
+        "status",
+    )
+
+    def __init__(
+        self,
+        id,
+        mode,
+        modeparams,
+        name,
+        location,
+        start,
+        end,
+        open_entry,
+        hide_results,
+        status,
+    ):
+        self.id = id
+        self.mode = mode
+        self.modeparams = modeparams
+        self.name = name
+        self.location = location
+        # datetime, or ISO 8601 string that will be parsed on first access
+        self._start = start
+        self._end = end
+        self.open_entry = open_entry
+        self.hide_results = hide_results
+        self.status = status
+
+    @property
+    def start(self):
+        start = self._start = _parse_datetime(self._start)
+        return start
+
+    @start.setter
+    def start(self, value):
+        self._start = value
+
+    @property
+    def end(self):
+        end = self._end = _parse_datetime(self._end)
+        return end
+
+    @end.setter
+    def end(self, value):
+        self._end = value
 
     @classmethod
     def deserialize_many(cls, data):
-        return [cls.deserialize(entry) for entry in data]
+        return list(cls.deserialize_iter(data))
+
+    @classmethod
+    def deserialize_iter(cls, data):
+        # the same as deserialize, minus the keyword argument dicts and method lookups,
+        # and with the few distinct values of some fields shared between instances
+        new = cls.__new__
+        for entry in data:
+            tournament = new(cls)
+            tournament.id = entry["id"]
+            tournament.mode = _intern(entry["mode"])
+            tournament.modeparams = _intern(entry["modeparams"])
+            tournament.name = entry["name"]
+            tournament.location = _intern(entry["location"])
+            tournament._start = entry["start"]
+            tournament._end = entry["end"]
+            tournament.open_entry = entry["open_entry"]
+            tournament.hide_results = entry["hide_results"]
+            tournament.status = _intern(entry["status"])
+            yield tournament
 
     @classmethod
     def deserialize(cls, data):
-        initkwargs = {
-            **data,
-            "start": datetime.fromisoformat(data["start"]),
-            "end": datetime.fromisoformat(data["end"]),
-        }
-        return cls(**initkwargs)
+        return cls(**data)
+
+    def _astuple(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+    # instead of dataclasses.asdict and dataclasses.replace, which only work on
+    # dataclasses
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def replace(self, **changes):
+        return self.__class__(**{**self._asdict(), **changes})
+
+    # copy.replace, from python 3.13
+    __replace__ = replace
+
+    def __copy__(self):
+        # much faster than copy's default for classes with __slots__
+        new = self.__class__.__new__(self.__class__)
+        for name in Tournament.__slots__:
+            setattr(new, name, getattr(self, name))
+        return new
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    # like an unfrozen dataclass
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.FIELDS)
+        return f"{self.__class__.__qualname__}({fields})"
 
     def __int__(self):
         return self.id
 
 
+@dataclass
+class TournamentSnapshot:
+    now: datetime
+    all: list
+    upcoming: list = field(default_factory=list)
+    in_progress: list = field(default_factory=list)
+    archive: list = field(default_factory=list)
+    my_active: list = None
+
+    @classmethod
+    def classify(cls, tournaments, now, my_active=None, server_tz=None):
+        snapshot = cls(now, list(tournaments), my_active=my_active)
+        # naive datetimes are in server_tz, or local time if that's None (see
+        # ServerClock)
+        if now.tzinfo is None:
+            naive_now = now
+            if server_tz is None:
+                aware_now = now.astimezone()
+            else:
+                aware_now = now.replace(tzinfo=server_tz)
+        else:
+            naive_now, aware_now = now.astimezone(server_tz).replace(tzinfo=None), now
+        for tournament in snapshot.all:
+            start = tournament.start
+            t_now = naive_now if start.tzinfo is None else aware_now
+            if t_now < start:
+                snapshot.upcoming.append(tournament)
+            elif t_now < tournament.end:
+                snapshot.in_progress.append(tournament)
+            else:
+                snapshot.archive.append(tournament)
+        return snapshot
+
+    @property
+    def active(self):
+        return self.upcoming + self.in_progress
+
+
 class Tournaments:
     def __init__(self, scoreganizer):
         self._sc = scoreganizer
@@ -45,54 +212,159 @@ class Tournaments:
     def _url(self, path):
         return self._sc._url(f"tournaments/{path}")
 
+    def _invalidate_lists(self):
+        # the status of tournaments changed
+        if self._sc.list_cache is not None:
+            self._sc.list_cache.invalidate()
+        if self._sc.mirror is not None:
+            self._sc.mirror.invalidate_lists()
+
     def participate(self, tournament):
         pk = int(tournament)
-        response = self.session.post(
-            self._url(f"participate/{pk}"),
-        )
-        self._sc._raise_if_error(response)
+        self._sc._request("POST", self._url(f"participate/{pk}"))
+        self._invalidate_lists()
+
+    def _username(self):
+        # the auth string is <username>:<token>
+        auth_str = self._sc._auth_str or ""
+        return auth_str.partition(":")[0]
+
+    def _cached_key(self, tournament):
+        # keys don't change once they're generated
+        key = None
+        if self._sc.key_cache is not None:
+            key = self._sc.key_cache.get(self._username(), tournament)
+        if key is None and self._sc.mirror is not None:
+            key = self._sc.mirror.get_key(self._username(), tournament)
+        return key
+
+    def _store_key(self, tournament, key):
+        if self._sc.key_cache is not None:
+            self._sc.key_cache.store(self._username(), tournament, key)
+        if self._sc.mirror is not None:
+            self._sc.mirror.store_key(self._username(), tournament, key)
 
     def gen_key(self, tournament):
         pk = int(tournament)
-        response = self.session.post(
-            self._url(f"gen_key/{pk}"),
-        )
-        self._sc._raise_if_error(response)
-        return response.json().get("key")
+        response = self._sc._request("POST", self._url(f"gen_key/{pk}"))
+        key = response.json().get("key")
+        self._store_key(tournament, key)
+        return key
 
     def get_key(self, tournament):
         pk = int(tournament)
-        response = self.session.get(
-            self._url(f"get_key/{pk}"),
-        )
-        self._sc._raise_if_error(response)
-        return response.json().get("key")
+        key = self._cached_key(tournament)
+        if key is not None:
+            return key
+        response = self._sc._request("GET", self._url(f"get_key/{pk}"))
+        key = response.json().get("key")
+        self._store_key(tournament, key)
+        return key
 
     def player_confirm(self, tournament):
         pk = int(tournament)
-        response = self.session.post(
-            self._url(f"player_confirm/{pk}"),
-        )
-        self._sc._raise_if_error(response)
+        self._sc._request("POST", self._url(f"player_confirm/{pk}"))
+        self._invalidate_lists()
 
-    def wait_key(self, tournament):
-        pk = int(tournament)
+    def _seconds_until_start(self, tournament):
+        # only Tournament instances know when they start
+        if not isinstance(tournament, Tournament):
+            return 0.0
+        clock = self._sc.clock
+        # neither do naive ones, unless we know the server's time zone - then we ask
+        # right away, and wait as long as the server tells us to
+        if tournament.start.tzinfo is None and clock.server_tz is None:
+            return 0.0
+        rtt = clock.rtt
+        # so that our request gets there right when the tournament starts
+        half_rtt = 0.0 if rtt is None else rtt.total_seconds() / 2
+        return max(0.0, clock.seconds_until(tournament.start) - half_rtt)
+
+    def wait_key(self, tournament, jitter=0):
+        key = self._cached_key(tournament)
+        if key is not None:
+            return key
+        delay = self._seconds_until_start(tournament)
+        if delay > 0:
+            time.sleep(delay + random.uniform(0, jitter))
         while True:
             try:
-                return self.gen_key(pk)
+                return self.gen_key(tournament)
             except ScoreganizerTooEarly as ex:
-                ex.do_wait()
+                ex.do_wait(jitter, self._sc.metrics)
             except ScoreganizerKeyExists:
-                return self.get_key(pk)
+                return self.get_key(tournament)
+
+    def wait_keys(self, tournaments, jitter=0):
+        # like wait_key, for many tournaments at once, but with a single thread
+        tournaments = list(tournaments)
+        pks = [int(tournament) for tournament in tournaments]
+        scheduler = KeyScheduler(self, jitter=jitter)
+        futures = scheduler.schedule_many(tournaments)
+        scheduler.run()
+        return {pk: future.result() for pk, future in zip(pks, futures)}
+
+    def _mirrored_list(self, name):
+        # None if there is no mirror, or the list in it is too old
+        if self._sc.mirror is None:
+            return None
+        return self._sc.mirror.get_list(name, username=self._username())
+
+    def _list_fetched(self, name, tournaments):
+        if self._sc.mirror is not None:
+            self._sc.mirror.store_list(name, tournaments, username=self._username())
+        if self._sc.key_cache is not None:
+            self._sc.key_cache.set_ends(tournaments)
 
     def _list(self, name):
-        response = self.session.get(self._url(name))
-        self._sc._raise_if_error(response)
-        return Tournament.deserialize_many(response.json())
+        tournaments = self._mirrored_list(name)
+        if tournaments is None:
+            tournaments = self._fetch_list(name)
+        return tournaments
+
+    def _fetch_list(self, name):
+        tournaments = self._fetch_list_cached(name)
+        self._list_fetched(name, tournaments)
+        return tournaments
+
+    def _fetch_list_cached(self, name):
+        cache = self._sc.list_cache
+        if cache is None:
+            response = self._sc._request("GET", self._url(name))
+            return Tournament.deserialize_many(json_loads(response.content))
+
+        tournaments = cache.get_fresh(name)
+        if tournaments is not None:
+            return tournaments
+        entry = cache.get(name)
+        headers = {} if entry is None else entry.conditional_headers()
+        response = self._sc._request("GET", self._url(name), headers=headers)
+        if response.status_code == 304 and entry is not None:
+            return cache.refresh(name, entry)
+        tournaments = Tournament.deserialize_many(json_loads(response.content))
+        cache.store(name, tournaments, response.headers)
+        return list(tournaments)
 
     def all(self):
         return self._list("all")
 
+    def snapshot(self, mine=False, now=None):
+        if mine:
+            # fetched concurrently, since only the server knows which are ours
+            all_tournaments, my_active = self._sc._map_in_workers(
+                self._list, ["all", "my_active"], 2
+            )
+        else:
+            all_tournaments, my_active = self._list("all"), None
+        if now is None:
+            now = self._sc.clock.now()
+        return TournamentSnapshot.classify(
+            all_tournaments,
+            now,
+            my_active=my_active,
+            server_tz=self._sc.clock.server_tz,
+        )
+
     def my_active(self):
         return self._list("my_active")
 
@@ -102,6 +374,21 @@ class Tournaments:
     def archive(self):
         return self._list("archive")
 
+    def _iter_list(self, name, chunk_size):
+        response = self._sc._request("GET", self._url(name), stream=True)
+        with response:
+            yield from iter_json_array(response.iter_content(chunk_size))
+
+    def iter_archive(self, chunk_size=64 * 1024):
+        return Tournament.deserialize_iter(self._iter_list("archive", chunk_size))
+
+    def sync_archive(self, store, chunk_size=64 * 1024):
+        # only deserializes and stores the tournaments that aren't in store yet
+        entries = self._iter_list("archive", chunk_size)
+        new_entries = [entry for entry in entries if entry["id"] not in store]
+        store.add_many(new_entries)
+        return Tournament.deserialize_many(new_entries)
+
     def upcoming(self):
         return self._list("upcoming")
 
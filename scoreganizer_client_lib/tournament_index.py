@@ -0,0 +1,138 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+
+# batches bigger than this are merged by sorting again instead of inserting one by one
+INSORT_MAX_BATCH = 64
+
+# sorts before/after every tournament with the same start/end
+LOWEST = float("-inf")
+HIGHEST = float("inf")
+
+
+class TournamentIndex:
+    def __init__(self, tournaments=()):
+        self._by_id = {}
+        # id -> (status, mode, start, end) as they were when the tournament was indexed,
+        # in case the instance was changed since
+        self._keys = {}
+        self._by_status = defaultdict(set)
+        self._by_mode = defaultdict(set)
+        # sorted lists of (start, id)/(end, id)
+        self._starts = []
+        self._ends = []
+        # sorted end - start of all tournaments, for active_at
+        self._durations = []
+        self.update(tournaments)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __contains__(self, tournament):
+        return int(tournament) in self._by_id
+
+    def get(self, tournament, default=None):
+        return self._by_id.get(int(tournament), default)
+
+    def _remove_sorted(self, sorted_list, key):
+        index = bisect_left(sorted_list, key)
+        if index == len(sorted_list) or sorted_list[index] != key:
+            raise ValueError(f"{key!r} isn't in the index")
+        del sorted_list[index]
+
+    def _unindex(self, pk):
+        status, mode, start, end = self._keys.pop(pk)
+        del self._by_id[pk]
+        self._by_status[status].discard(pk)
+        self._by_mode[mode].discard(pk)
+        self._remove_sorted(self._starts, (start, pk))
+        self._remove_sorted(self._ends, (end, pk))
+        self._remove_sorted(self._durations, end - start)
+
+    def update(self, tournaments):
+        # adds new tournaments, and replaces ones we already have with the same id
+        batch = {tournament.id: tournament for tournament in tournaments}
+        for pk in batch:
+            if pk in self._by_id:
+                self._unindex(pk)
+        keys = []
+        for pk, tournament in batch.items():
+            status, mode = tournament.status, tournament.mode
+            start, end = tournament.start, tournament.end
+            self._by_id[pk] = tournament
+            self._keys[pk] = (status, mode, start, end)
+            self._by_status[status].add(pk)
+            self._by_mode[mode].add(pk)
+            keys.append((pk, start, end))
+        if len(batch) > INSORT_MAX_BATCH:
+            self._starts.extend((start, pk) for pk, start, _ in keys)
+            self._ends.extend((end, pk) for pk, _, end in keys)
+            self._durations.extend(end - start for _, start, end in keys)
+            self._starts.sort()
+            self._ends.sort()
+            self._durations.sort()
+        else:
+            for pk, start, end in keys:
+                insort(self._starts, (start, pk))
+                insort(self._ends, (end, pk))
+                insort(self._durations, end - start)
+
+    def remove(self, tournament):
+        pk = int(tournament)
+        if pk in self._by_id:
+            self._unindex(pk)
+
+    def _get_many(self, pks):
+        return sorted((self._by_id[pk] for pk in pks), key=lambda t: (t.start, t.id))
+
+    def by_status(self, status):
+        return self._get_many(self._by_status.get(status, ()))
+
+    def by_mode(self, mode):
+        return self._get_many(self._by_mode.get(mode, ()))
+
+    def _slice(self, sorted_list, lower=None, upper=None):
+        # pks with lower <= key < upper
+        start = 0 if lower is None else bisect_left(sorted_list, (lower, LOWEST))
+        stop = len(sorted_list)
+        if upper is not None:
+            stop = bisect_left(sorted_list, (upper, LOWEST))
+        return [pk for _, pk in sorted_list[start:stop]]
+
+    def starting_between(self, lower=None, upper=None):
+        return [self._by_id[pk] for pk in self._slice(self._starts, lower, upper)]
+
+    def ending_between(self, lower=None, upper=None):
+        return [self._by_id[pk] for pk in self._slice(self._ends, lower, upper)]
+
+    def upcoming_at(self, time):
+        # time < start
+        index = bisect_right(self._starts, (time, HIGHEST))
+        return [self._by_id[pk] for _, pk in self._starts[index:]]
+
+    def ended_at(self, time):
+        # end <= time
+        index = bisect_right(self._ends, (time, HIGHEST))
+        return [self._by_id[pk] for _, pk in self._ends[:index]]
+
+    def active_at(self, time):
+        # start <= time < end. Tournaments that started longer ago than the longest one
+        # lasts are over, so the candidates are the ones that started since then, or
+        # the ones that haven't ended yet - whichever are fewer. That's
+        # O(log n + min(those two)), not O(log n + k): a single very long tournament
+        # makes the first group big.
+        started = bisect_right(self._starts, (time, HIGHEST))
+        first = 0
+        if self._durations:
+            first = bisect_left(self._starts, (time - self._durations[-1], LOWEST))
+        not_ended = bisect_right(self._ends, (time, HIGHEST))
+        if started - first <= len(self._ends) - not_ended:
+            candidates = (self._by_id[pk] for _, pk in self._starts[first:started])
+            return [t for t in candidates if t.end > time]
+        candidates = (self._by_id[pk] for _, pk in self._ends[not_ended:])
+        return sorted(
+            (t for t in candidates if t.start <= time), key=lambda t: (t.start, t.id)
+        )
@@ -0,0 +1,180 @@
+from datetime import timedelta
+import threading
+import time
+
+# requests and httpx are imported when they're first needed, since importing them
+# takes longer than everything else we do at startup (see benchmarks/bench_import.py)
+
+DEFAULT_CONNECT_RETRIES = 5
+DEFAULT_MAX_CONNECTIONS = 100
+
+_defaults = {}
+_defaults_lock = threading.Lock()
+
+
+def requests_defaults():
+    # DEFAULT_RETRY and DEFAULT_ADAPTER (see scoreganizer.py), made on first use
+    with _defaults_lock:
+        if not _defaults:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util import Retry
+
+            # only for connection problems - everything else is up to the retry
+            # policy, which also knows about the server's error responses
+            retry = Retry(total=5, read=2, connect=5, status=0, backoff_factor=0.2)
+            _defaults["DEFAULT_RETRY"] = retry
+            _defaults["DEFAULT_ADAPTER"] = HTTPAdapter(max_retries=retry)
+        return _defaults
+
+
+class RequestsTransport:
+    # The default: a requests.Session for every thread, which all use the same
+    # HTTPAdapter, and with it the same connections.
+
+    def __init__(self, http_adapter=None):
+        # None for DEFAULT_ADAPTER
+        self._http_adapter = http_adapter
+
+    @property
+    def http_adapter(self):
+        if self._http_adapter is None:
+            self._http_adapter = requests_defaults()["DEFAULT_ADAPTER"]
+        return self._http_adapter
+
+    def open(self, on_response, digest_auth=None):
+        import requests
+
+        session = requests.Session()
+        if digest_auth is not None:
+            session.auth = digest_auth
+        session.mount("http://", self.http_adapter)
+        session.mount("https://", self.http_adapter)
+        session.hooks["response"].append(on_response)
+        return session
+
+    def close(self):
+        # the adapter is closed with the sessions
+        pass
+
+
+class HTTPXTransport:
+    # Sends requests with one httpx.Client, over HTTP/2 if the server supports it, so
+    # that many small requests (keys, lists) share a single connection instead of
+    # each needing its own. The client is thread-safe, so every thread's session uses
+    # it.
+
+    def __init__(
+        self,
+        http2=True,
+        http1=True,
+        limits=None,
+        retries=DEFAULT_CONNECT_RETRIES,
+        timeout=None,
+        verify=True,
+    ):
+        try:
+            import httpx
+        except ImportError:  # pragma: no cover
+            raise ImportError(
+                "HTTPXTransport requires httpx - install scoreganizer-client-lib[http2]"
+            ) from None
+        # http1=False talks HTTP/2 to servers without TLS, if they support that
+        transport = httpx.HTTPTransport(
+            http1=http1,
+            http2=http2,
+            retries=retries,
+            verify=verify,
+            limits=limits or httpx.Limits(max_connections=DEFAULT_MAX_CONNECTIONS),
+        )
+        # no timeout by default, like requests
+        self.client = httpx.Client(transport=transport, timeout=timeout)
+
+    def open(self, on_response, digest_auth=None):
+        import httpx
+
+        auth = None
+        if digest_auth is not None:
+            auth = httpx.DigestAuth(digest_auth.username, digest_auth.password)
+        return HTTPXSession(self.client, on_response, auth)
+
+    def close(self):
+        self.client.close()
+
+
+class HTTPXResponse:
+    # what we use of requests.Response, on top of an httpx.Response
+
+    def __init__(self, response, elapsed):
+        self._response = response
+        self.elapsed = elapsed
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_content(self, chunk_size=1):
+        return self._response.iter_bytes(chunk_size)
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _translate_error(ex):
+    # so that errors are the same as with requests (see NetworkException)
+    import httpx
+    import requests
+
+    if isinstance(ex, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(ex))
+    return requests.exceptions.ConnectionError(str(ex))
+
+
+class HTTPXSession:
+    # what Scoreganizer uses of requests.Session: request() with its arguments,
+    # headers and close()
+
+    def __init__(self, client, on_response, auth=None):
+        import httpx
+
+        self._client = client
+        self._on_response = on_response
+        self.auth = auth
+        self.headers = httpx.Headers()
+
+    def _body(self, data):
+        # filelike bodies (like MultipartEncoder) are sent while they're being read
+        if data is None or not hasattr(data, "read"):
+            return {"data": data}, {}
+        headers = {}
+        length = getattr(data, "len", None)
+        if length is not None:
+            headers["Content-Length"] = str(length)
+        return {"content": iter(lambda: data.read(64 * 1024), b"")}, headers
+
+    def request(self, method, url, headers=None, data=None, files=None, stream=False):
+        import httpx
+
+        body, body_headers = self._body(data)
+        request_headers = httpx.Headers(self.headers)
+        request_headers.update(body_headers)
+        request_headers.update(headers or {})
+        request = self._client.build_request(
+            method, url, headers=request_headers, files=files, **body
+        )
+        start = time.monotonic()
+        try:
+            response = self._client.send(request, auth=self.auth, stream=stream)
+        except httpx.TransportError as ex:
+            raise _translate_error(ex) from ex
+        response = HTTPXResponse(response, timedelta(seconds=time.monotonic() - start))
+        self._on_response(response)
+        return response
+
+    def close(self):
+        # the client is closed with the transport
+        pass
@@ -0,0 +1,232 @@
+from dataclasses import dataclass
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from .exceptions import NetworkException, ScoreganizerError, ScoreganizerRetry
+
+
+PENDING = "pending"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+
+# seconds - an upload claimed longer ago than this is taken over, even if whoever
+# claimed it might still be alive
+DEFAULT_LEASE = 3600
+
+# errors that go away with time: our token expiring, or the server having trouble
+TRANSIENT_ERRORS = frozenset(("not_logged_in", "token_stale"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    ext TEXT,
+    mime_type TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    added REAL NOT NULL,
+    finished REAL,
+    claimed_by TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS uploads_state ON uploads (state, id);
+"""
+
+
+@dataclass
+class QueuedUpload:
+    id: int
+    filename: str
+    ext: str
+    mime_type: str
+    state: str
+    attempts: int
+    error: str
+
+
+def is_permanent_error(ex):
+    # errors that will happen again if we retry later
+    if isinstance(ex, (NetworkException, ScoreganizerRetry)):
+        return False
+    if isinstance(ex, ScoreganizerError):
+        status_code = ex.status_code
+        return not (
+            ex.error in TRANSIENT_ERRORS
+            or (status_code is not None and status_code >= 500)
+        )
+    return isinstance(ex, OSError)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # it exists, but isn't ours
+        return True
+    return True
+
+
+class UploadQueue:
+    # Several processes can share the database. Every queue claims uploads under its
+    # own owner (host, pid and a random part), and only takes over uploads claimed by
+    # processes on this host that are gone, or claimed more than lease seconds ago.
+
+    def __init__(self, path, lease=DEFAULT_LEASE):
+        self.path = os.fspath(path)
+        self.lease = lease
+        self.host = socket.gethostname()
+        self.owner = f"{self.host}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        # autocommit - every statement is its own transaction, unless we BEGIN one
+        self._db = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(uploads)")}
+        for column, type_ in (("claimed_by", "TEXT"), ("claimed_at", "REAL")):
+            # databases from before claims had owners
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE uploads ADD COLUMN {column} {type_}")
+        self.reclaim()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, filename, ext=None, mime_type=None):
+        return self.add_many([filename], ext=ext, mime_type=mime_type)[0]
+
+    def add_many(self, filenames, ext=None, mime_type=None):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                ids = [
+                    self._db.execute(
+                        "INSERT INTO uploads (filename, ext, mime_type, state, added) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (str(filename), ext, mime_type, PENDING, now),
+                    ).lastrowid
+                    for filename in filenames
+                ]
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return ids
+
+    def _select(self, where, params=()):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, filename, ext, mime_type, state, attempts, error "
+                f"FROM uploads WHERE {where} ORDER BY id",
+                params,
+            ).fetchall()
+        return [QueuedUpload(*row) for row in rows]
+
+    def pending(self):
+        return self._select("state = ?", (PENDING,))
+
+    def failed(self):
+        return self._select("state = ?", (FAILED,))
+
+    def get(self, upload_id):
+        uploads = self._select("id = ?", (upload_id,))
+        return uploads[0] if uploads else None
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT state, COUNT(*) FROM uploads GROUP BY state"
+            ).fetchall()
+        return dict(rows)
+
+    def _claim_abandoned(self, claimed_by, claimed_at, now):
+        if claimed_by is None or claimed_at is None:
+            # claimed by an older version, which didn't say by whom
+            return True
+        if now - claimed_at >= self.lease:
+            return True
+        host, pid, _ = claimed_by.rsplit(":", 2)
+        return host == self.host and not _process_alive(int(pid))
+
+    def reclaim(self):
+        # makes uploads pending again that were in progress when their process died,
+        # returns their ids
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, claimed_by, claimed_at FROM uploads WHERE state = ?",
+                    (UPLOADING,),
+                ).fetchall()
+                ids = [
+                    upload_id
+                    for upload_id, claimed_by, claimed_at in rows
+                    if self._claim_abandoned(claimed_by, claimed_at, now)
+                ]
+                self._db.executemany(
+                    "UPDATE uploads SET state = ?, claimed_by = NULL, "
+                    "claimed_at = NULL WHERE id = ? AND state = ?",
+                    [(PENDING, upload_id, UPLOADING) for upload_id in ids],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return ids
+
+    def claim(self, upload_id):
+        # returns whether we got it - False if another queue claimed it first
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE uploads SET state = ?, attempts = attempts + 1, "
+                "claimed_by = ?, claimed_at = ? WHERE id = ? AND state = ?",
+                (UPLOADING, self.owner, time.time(), upload_id, PENDING),
+            )
+        return cursor.rowcount == 1
+
+    def finish(self, upload_id, error=None):
+        if error is None:
+            state = DONE
+        elif is_permanent_error(error):
+            state = FAILED
+        else:
+            state = PENDING
+        error_str = None if error is None else repr(error)
+        with self._lock:
+            self._db.execute(
+                "UPDATE uploads SET state = ?, error = ?, finished = ?, "
+                "claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+                (state, error_str, time.time(), upload_id),
+            )
+        return state
+
+    def retry_failed(self):
+        with self._lock:
+            self._db.execute(
+                "UPDATE uploads SET state = ? WHERE state = ?", (PENDING, FAILED)
+            )
+
+    def purge_done(self, older_than=0):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM uploads WHERE state = ? AND finished <= ?",
+                (DONE, time.time() - older_than),
+            )
@@ -1,5 +1,6 @@
 """ """
 
+from functools import lru_cache
 import re
 
 SEMVER_RE = re.compile(
@@ -7,25 +8,47 @@ SEMVER_RE = re.compile(
     # ignore everything after that
 )
 
-try:
-    # prefer setuptools_scm version since it might generate _version.py in our
-    # working copy
-    from setuptools_scm import get_version
+# the released version, which doesn't need anything looked up
+VERSION_TUPLE = (0, 9, 0)
 
-    __version__ = get_version(
-        root="..",
-        relative_to=__file__,
-        local_scheme="node-and-timestamp",
-    )
-except (ImportError, LookupError):
-    __version__ = None
 
-if __version__ is None:
-    from ._version import version as __version__
+@lru_cache(maxsize=None)  # noqa: UP033  not functools.cache before 3.9
+def _find_version():
+    # _version.py is written by setuptools_scm when the package is built
+    try:
+        from ._version import version
+
+        return version
+    except ImportError:
+        pass
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+
+        return version("scoreganizer-client-lib")
+    except PackageNotFoundError:
+        pass
+    # a working copy that was never built - ask git, which takes a while
+    try:
+        from setuptools_scm import get_version
+
+        return get_version(
+            root="..",
+            relative_to=__file__,
+            local_scheme="node-and-timestamp",
+        )
+    except (ImportError, LookupError):
+        return ".".join(map(str, VERSION_TUPLE))
+
+
+def __getattr__(name):
+    # looked up on first use, not at import time
+    if name == "__version__":
+        return _find_version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_version_tuple():
-    match = SEMVER_RE.match(__version__)
+    match = SEMVER_RE.match(_find_version())
 
     groupdict = match.groupdict()
 
@@ -34,7 +57,3 @@ def get_version_tuple():
         int(groupdict["minor"]),
         int(groupdict["patch"] or 0),
     )
-
-
-VERSION_TUPLE = get_version_tuple()
-VERSION_TUPLE = (0, 9, 0)
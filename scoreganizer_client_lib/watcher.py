@@ -0,0 +1,304 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+from .exceptions import ScoreganizerError
+
+
+REPLAY_EXTENSIONS = (".rmv", ".avf")
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def is_replay(filename):
+    return filename.lower().endswith(REPLAY_EXTENSIONS)
+
+
+class PollingBackend:
+    # Only lists a directory when its mtime changed, which is when files were added,
+    # removed or renamed. Otherwise, only the replays we know of are stat()ed, since
+    # overwriting one doesn't change the mtime of the directory. Files that are still
+    # being written are stat()ed by the watcher itself.
+
+    def __init__(self, directories, interval=1.0):
+        self.interval = interval
+        self._mtimes = {}
+        self._entries = {}
+        for directory in directories:
+            self._mtimes[directory] = self._mtime(directory)
+            self._entries[directory] = self._list(directory)
+
+    def _mtime(self, directory):
+        try:
+            return os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _state(stat):
+        return stat.st_mtime_ns, stat.st_size
+
+    def _list(self, directory):
+        # name -> (mtime_ns, size) of the replays in directory
+        entries = {}
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not is_replay(entry.name):
+                        continue
+                    try:
+                        entries[entry.name] = self._state(entry.stat())
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _restat(self, directory, names):
+        entries = {}
+        for name in names:
+            try:
+                entries[name] = self._state(os.stat(os.path.join(directory, name)))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def poll(self, stop_event):
+        if stop_event.wait(self.interval):
+            return []
+        changed = []
+        for directory, mtime in self._mtimes.items():
+            old_entries = self._entries[directory]
+            new_mtime = self._mtime(directory)
+            if new_mtime == mtime:
+                entries = self._restat(directory, old_entries)
+            else:
+                self._mtimes[directory] = new_mtime
+                entries = self._list(directory)
+            for name, state in entries.items():
+                if old_entries.get(name) != state:
+                    changed.append(os.path.join(directory, name))
+            self._entries[directory] = entries
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyBackend:
+    def __init__(self, directories, interval=1.0):
+        self.interval = interval
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), INOTIFY_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(err, os.strerror(err), directory)
+            self._directories[wd] = directory
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith("linux"):
+            return False
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        try:
+            return hasattr(ctypes.CDLL(libc_name), "inotify_init1")
+        except OSError:
+            return False
+
+    def poll(self, stop_event):
+        # wake up regularly anyway, so that stop_event and debouncing are handled
+        readable, _, _ = select.select([self._fd], [], [], self.interval)
+        if stop_event.is_set() or not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN:
+                return []
+            raise
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if wd in self._directories and is_replay(name):
+                changed.append(os.path.join(self._directories[wd], name))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class ReplayWatcher:
+    def __init__(
+        self,
+        scores,
+        directories,
+        settle_time=1.0,
+        interval=0.25,
+        queue_size=100,
+        backend=None,
+        on_upload=None,
+        on_error=None,
+        upload_kwargs=None,
+        upload_queue=None,
+    ):
+        self.scores = scores
+        self.directories = [os.fspath(directory) for directory in directories]
+        self.settle_time = settle_time
+        self.interval = interval
+        self.on_upload = on_upload
+        self.on_error = on_error
+        self.upload_kwargs = upload_kwargs or {}
+        self.upload_queue = upload_queue
+        if backend is None:
+            backend = InotifyBackend if InotifyBackend.available() else PollingBackend
+        self._backend_cls = backend
+        self._backend = None
+        self._queue = queue.Queue(queue_size)
+        # path -> (size, mtime_ns, monotonic time it was first seen like that)
+        self._pending = {}
+        # (path, upload id) of settled replays that didn't fit in _queue before stop()
+        self._unqueued = []
+        # what the last stop() returned
+        self.not_uploaded = []
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop.clear()
+        self._backend = self._backend_cls(self.directories, interval=self.interval)
+        self._threads = [
+            threading.Thread(target=self._watch, daemon=True),
+            threading.Thread(target=self._upload, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        # returns the paths of the replays that were found, but not uploaded yet (also
+        # kept in not_uploaded). If there's an upload_queue, they're all in it.
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+        self.not_uploaded = self._drain()
+        return self.not_uploaded
+
+    def _drain(self):
+        paths = [path for path, _ in self._unqueued]
+        self._unqueued = []
+        while True:
+            try:
+                path, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            paths.append(path)
+        # not settled yet, so not in the upload queue yet either
+        for path in self._pending:
+            if self.upload_queue is not None:
+                self.upload_queue.add(path)
+            paths.append(path)
+        self._pending.clear()
+        return paths
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _watch(self):
+        while not self._stop.is_set():
+            for path in self._backend.poll(self._stop):
+                self._pending.setdefault(path, None)
+            self._settle()
+
+    def _settle(self):
+        now = time.monotonic()
+        for path, state in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # temporary file that was renamed or deleted
+                del self._pending[path]
+                continue
+            if state is None or state[:2] != (stat.st_size, stat.st_mtime_ns):
+                self._pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - state[2] >= self.settle_time:
+                del self._pending[path]
+                upload_id = None
+                if self.upload_queue is not None:
+                    upload_id = self.upload_queue.add(path)
+                # blocks if the uploader can't keep up
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put((path, upload_id), timeout=self.interval)
+                        break
+                    except queue.Full:
+                        pass
+                else:
+                    self._unqueued.append((path, upload_id))
+
+    def _upload(self):
+        session = self.scores._sc._init_worker_session()
+        try:
+            while not self._stop.is_set():
+                try:
+                    path, upload_id = self._queue.get(timeout=self.interval)
+                except queue.Empty:
+                    continue
+                if upload_id is not None:
+                    self.upload_queue.claim(upload_id)
+                try:
+                    self.scores.upload_filename(path, **self.upload_kwargs)
+                except (ScoreganizerError, Exception) as ex:
+                    if upload_id is not None:
+                        self.upload_queue.finish(upload_id, ex)
+                    self._report_error(path, ex)
+                else:
+                    if upload_id is not None:
+                        self.upload_queue.finish(upload_id)
+                    if self.on_upload is not None:
+                        try:
+                            self.on_upload(path)
+                        except Exception as ex:
+                            self._report_error(path, ex)
+        finally:
+            session.close()
+
+    def _report_error(self, path, ex):
+        # a broken callback mustn't stop the uploader - if on_error fails, too, it's
+        # reported like an uncaught exception
+        if self.on_error is None:
+            return
+        try:
+            self.on_error(path, ex)
+        except Exception as callback_ex:
+            sys.excepthook(type(callback_ex), callback_ex, callback_ex.__traceback__)
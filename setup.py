@@ -38,4 +38,9 @@ setup(
     install_requires=[
         "requests>=2.32.0",
     ],
+    extras_require={
+        "async": ["httpx>=0.24"],
+        "http2": ["httpx[http2]>=0.24"],
+        "speedups": ["orjson"],
+    },
 )
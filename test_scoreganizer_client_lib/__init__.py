@@ -1,18 +1,32 @@
+import asyncio
 from contextlib import nullcontext
+from copy import copy
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
-import time  # noqa: F401  We need to import this to patch time.sleep
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
 from unittest import mock
 import pytest
+import requests
 
 from scoreganizer_client_lib.exceptions import (
     ScoreganizerError,
     ScoreganizerInvalidData,
     ScoreganizerInvalidLoginData,
+    ScoreganizerKeyExists,
     ScoreganizerNotLoggedIn,
     ScoreganizerRetry,
     ScoreganizerTokenTooRecent,
+    ScoreganizerWait,
 )
-from scoreganizer_client_lib.scoreganizer import Scoreganizer
+from scoreganizer_client_lib.scoreganizer import AUTH_HEADER, Scoreganizer
 from scoreganizer_client_lib.tournament import Tournament
 
 
@@ -429,3 +443,1750 @@ def test_authfile(requests_mock, tmp_path):
     assert not requests_mock.called
     sc2.token_status()
     assert requests_mock.called
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        self.server.requests.append((self.command, self.path, self.headers, body))
+        responses = self.server.routes.get((self.command, self.path))
+        if responses is None:
+            status, payload = 404, None
+        elif len(responses) > 1:
+            status, payload = responses.pop(0)
+        else:
+            status, payload = responses[0]
+        content = b"" if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+@pytest.fixture
+def stand_in_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.routes = {}
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stand_in_kwargs(server):
+    return {"host": "127.0.0.1", "port": server.server_address[1], "https": False}
+
+
+def test_async_client(stand_in_server, tournaments_json, tmp_path):
+    pytest.importorskip("httpx")
+    from scoreganizer_client_lib.aio import AsyncScoreganizer
+    from scoreganizer_client_lib.cache import ListCache
+    from scoreganizer_client_lib.metrics import Metrics
+    from scoreganizer_client_lib.mirror import MirrorRefresher, TournamentMirror
+    from scoreganizer_client_lib.upload_queue import UploadQueue
+
+    stand_in_server.routes.update(
+        {
+            ("POST", "/api/obtain_token"): [(200, {"token": "asdf"})],
+            ("GET", "/api/tournaments/active"): [(200, tournaments_json)],
+            ("GET", "/api/tournaments/archive"): [(200, tournaments_json)],
+            ("GET", "/api/tournaments/all"): [(200, tournaments_json)],
+            ("POST", "/api/tournaments/participate/1"): [(200, None)],
+            ("POST", "/api/tournaments/gen_key/1"): [
+                (403, {"error": "too_early", "wait": "0.001"}),
+                (403, {"error": "key_exists"}),
+            ],
+            ("GET", "/api/tournaments/get_key/1"): [(200, {"key": "k1"})],
+            ("GET", "/api/tournaments/get_key/2"): [(200, {"key": "k2"})],
+            ("POST", "/api/scores/upload"): [(403, {"error": "retry"}), (201, None)],
+        }
+    )
+    replay_path = tmp_path / "test.avf"
+    replay_path.write_bytes(b"sus amogus")
+
+    metrics = Metrics()
+
+    def fetched(path):
+        return sum(request[1] == path for request in stand_in_server.requests)
+
+    with pytest.raises(TypeError):
+        with AsyncScoreganizer(**stand_in_kwargs(stand_in_server)):
+            pass
+
+    async def run():
+        async with AsyncScoreganizer(
+            list_cache=ListCache(),
+            mirror=TournamentMirror(":memory:"),
+            metrics=metrics,
+            **stand_in_kwargs(stand_in_server),
+        ) as sc:
+            assert await sc.login("user", "pass") == "user:asdf"
+            tournaments = await sc.tournaments.active()
+            assert [t.id for t in tournaments] == [1, 2]
+            # from the mirror and the cache, until participating invalidates them
+            assert await sc.tournaments.active() == tournaments
+            assert [t.id for t in await sc.tournaments.all()] == [1, 2]
+            await sc.tournaments.all()
+            assert fetched("/api/tournaments/active") == 1
+            await sc.tournaments.participate(1)
+            await sc.tournaments.active()
+            assert fetched("/api/tournaments/active") == 2
+            with pytest.raises(ValueError):
+                MirrorRefresher(sc)
+            archive = [t.id async for t in sc.tournaments.iter_archive(chunk_size=16)]
+            assert archive == [1, 2]
+            keys = await asyncio.gather(
+                sc.tournaments.wait_key(tournaments[0]),
+                sc.tournaments.get_key(2),
+            )
+            assert keys == ["k1", "k2"]
+            stand_in_server.routes[("POST", "/api/tournaments/gen_key/2")] = [
+                (403, {"error": "key_exists"})
+            ]
+            stand_in_server.routes[("POST", "/api/tournaments/gen_key/3")] = [
+                (403, {"error": "too_early", "wait": "0.02"}),
+                (200, {"key": "k3"}),
+            ]
+            assert await sc.tournaments.wait_keys([2, 3]) == {2: "k2", 3: "k3"}
+            with mock.patch("asyncio.sleep", return_value=None) as sleep:
+                await sc.scores.upload_filename(replay_path, stream=True)
+            assert sleep.call_count == 1
+            # streamed again from the start after the retry
+            _, path, _, body = stand_in_server.requests[-1]
+            assert path == "/api/scores/upload"
+            assert body.count(b"sus amogus") == 1
+            assert b"application/x-minesweeper-arbiter" in body
+            with UploadQueue(tmp_path / "uploads.sqlite3") as upload_queue:
+                upload_queue.add_many([replay_path, tmp_path / "missing.avf"])
+                report = await sc.scores.drain_queue(upload_queue)
+                assert [r.ok for r in report.results] == [True, False]
+                assert upload_queue.counts() == {"done": 1, "failed": 1}
+            with pytest.raises(ScoreganizerNotLoggedIn):
+                stand_in_server.routes[("GET", "/api/token_status")] = [
+                    (403, {"error": "not_logged_in"})
+                ]
+                await sc.token_status()
+
+    asyncio.run(run())
+    stats = metrics.snapshot()
+    assert stats["requests"] == len(stand_in_server.requests)
+    assert stats["endpoints"]["GET tournaments/archive"]["bytes_received"] > 0
+    assert stats["errors"]["not_logged_in"] == 1
+    assert stats["retries"] == 1
+    assert stats["waits"] == 1
+    _, path, headers, body = stand_in_server.requests[-2]
+    assert path == "/api/scores/upload"
+    assert headers["X-Scoreganizer-Authorization"] == "user:asdf"
+    assert b"sus amogus" in body
+    assert b"application/x-minesweeper-arbiter" in body
+
+
+def test_async_network_errors(tmp_path):
+    httpx = pytest.importorskip("httpx")
+    from scoreganizer_client_lib.aio import AsyncScoreganizer
+    from scoreganizer_client_lib.exceptions import NetworkException
+    from scoreganizer_client_lib.retry import RetryPolicy
+
+    def handler(request):
+        if request.url.path.endswith("archive"):
+            raise httpx.ReadTimeout("too slow", request=request)
+        raise httpx.ConnectError("offline", request=request)
+
+    replay_path = tmp_path / "test.avf"
+    replay_path.write_bytes(b"sus amogus")
+    transport = httpx.MockTransport(handler)
+
+    async def run():
+        async with AsyncScoreganizer(
+            transport=transport, retry_policy=RetryPolicy(tries=3)
+        ) as sc:
+            with mock.patch("asyncio.sleep", return_value=None) as sleep:
+                with pytest.raises(requests.exceptions.ConnectionError) as exc_info:
+                    await sc.tournaments.active()
+                assert isinstance(exc_info.value.__cause__, httpx.ConnectError)
+                assert sleep.call_count == 2
+                # uploads aren't retried
+                with pytest.raises(NetworkException):
+                    await sc.scores.upload_filename(replay_path)
+                assert sleep.call_count == 2
+            with pytest.raises(requests.exceptions.Timeout):
+                async for _ in sc.tournaments.iter_archive():
+                    pass
+
+    asyncio.run(run())
+
+
+def test_async_key_scheduler_stop():
+    from scoreganizer_client_lib.aio import AsyncKeyScheduler
+
+    class SlowTournaments:
+        def __init__(self):
+            self.started = asyncio.Event()
+            self.release = asyncio.Event()
+
+        def _cached_key(self, tournament):
+            return None
+
+        def _seconds_until_start(self, tournament):
+            return 0.0
+
+        async def gen_key(self, tournament):
+            self.started.set()
+            await self.release.wait()
+            if tournament == 1:
+                return "k1"
+            raise ScoreganizerWait("too_early", timedelta(seconds=1))
+
+    async def run():
+        tournaments = SlowTournaments()
+        on_key = mock.Mock()
+        scheduler = AsyncKeyScheduler(tournaments, on_key=on_key)
+        with pytest.raises(TypeError):
+            scheduler.start()
+        futures = scheduler.schedule_many([1, 2])
+        task = asyncio.create_task(scheduler.run())
+        await tournaments.started.wait()
+        # while the keys are being fetched
+        scheduler.stop()
+        tournaments.release.set()
+        await asyncio.wait_for(task, 1)
+        assert all(future.cancelled() for future in futures)
+        assert len(scheduler) == 0
+        assert scheduler._heap == []
+        on_key.assert_not_called()
+
+    asyncio.run(run())
+
+
+def test_upload_many(requests_mock, tmp_path):
+    requests_mock.post(
+        api_path("scores/upload"),
+        status_code=201,
+    )
+    requests_mock.post(
+        api_path("scores/upload"),
+        json={"error": "invalid_data"},
+        status_code=403,
+        additional_matcher=lambda request: b"bad replay" in request.body,
+    )
+    paths = []
+    for i in range(10):
+        ext = "rmv" if i % 2 else "avf"
+        path = tmp_path / f"game_{i}.{ext}"
+        path.write_bytes(b"bad replay" if i == 3 else b"good replay")
+        paths.append(path)
+    paths.append(tmp_path / "missing.rmv")
+
+    sc = Scoreganizer()
+    sc.set_auth_str("user:asdf")
+    report = sc.scores.upload_many(paths, concurrency=3)
+
+    assert [result.filename for result in report.results] == [str(p) for p in paths]
+    assert len(report.succeeded) == 9
+    assert [r.filename for r in report.failed] == [str(paths[3]), str(paths[10])]
+    assert isinstance(report.failed[0].error, ScoreganizerInvalidData)
+    assert isinstance(report.failed[1].error, FileNotFoundError)
+    assert report.bytes_sent == 9 * len(b"good replay")
+    assert report.files_per_second > 0
+    assert "uploaded 9/11 files" in str(report)
+    assert requests_mock.call_count == 10
+    for request in requests_mock.request_history:
+        assert request.headers["X-Scoreganizer-Authorization"] == "user:asdf"
+        ext = "rmv" if b'.rmv"' in request.body else "avf"
+        mime_type = {
+            "rmv": b"application/x-viennasweeper",
+            "avf": b"application/x-minesweeper-arbiter",
+        }[ext]
+        assert mime_type in request.body
+
+
+def test_upload_stream(stand_in_server, tmp_path):
+    stand_in_server.routes[("POST", "/api/scores/upload")] = [
+        (403, {"error": "retry"}),
+        (201, None),
+    ]
+    sc = Scoreganizer(**stand_in_kwargs(stand_in_server)).scores
+    replay_content = b"Lorem ipsum dolor sit amet, sus amogus venit impostoram"
+    replay_path = tmp_path / "test.avf"
+    replay_path.write_bytes(replay_content)
+    empty_path = tmp_path / "empty.rmv"
+    empty_path.write_bytes(b"")
+
+    uploads = [
+        (lambda: sc.upload_file(BytesIO(replay_content), "test.rmv", stream=True)),
+        (lambda: sc.upload_file(replay_content, "test.rmv")),
+        (lambda: sc.upload_file(memoryview(replay_content), "test.rmv")),
+        (lambda: sc.upload_filename(replay_path, stream=True)),
+        (lambda: sc.upload_filename(empty_path, stream=True)),
+    ]
+    for upload in uploads:
+        stand_in_server.requests.clear()
+        stand_in_server.routes[("POST", "/api/scores/upload")] = [
+            (403, {"error": "retry"}),
+            (201, None),
+        ]
+        with mock.patch("time.sleep", return_value=None):
+            upload()
+        assert len(stand_in_server.requests) == 2
+        # both tries sent the whole file
+        for _, _, headers, body in stand_in_server.requests:
+            assert int(headers["Content-Length"]) == len(body)
+            assert headers["Content-Type"].startswith("multipart/form-data")
+            assert b'name="video"' in body
+            if b"empty.rmv" in body:
+                assert b"\r\n\r\n\r\n--" in body
+            else:
+                assert replay_content in body
+    _, _, _, body = stand_in_server.requests[-1]
+    assert b'filename="empty.rmv"' in body
+    assert b"application/x-viennasweeper" in body
+
+
+@pytest.mark.parametrize("backend_name", ["PollingBackend", "InotifyBackend"])
+def test_replay_watcher(requests_mock, tmp_path, backend_name):
+    from scoreganizer_client_lib import watcher
+
+    backend = getattr(watcher, backend_name)
+    if backend is watcher.InotifyBackend and not backend.available():
+        pytest.skip("inotify not available")
+    requests_mock.post(api_path("scores/upload"), status_code=201)
+    (tmp_path / "old.rmv").write_bytes(b"uploaded before")
+    uploaded = queue.Queue()
+    sc = Scoreganizer()
+    replay_watcher = watcher.ReplayWatcher(
+        sc.scores,
+        [tmp_path],
+        settle_time=0.2,
+        interval=0.05,
+        backend=backend,
+        on_upload=uploaded.put,
+    )
+    with replay_watcher:
+        (tmp_path / "notes.txt").write_text("not a replay")
+        with (tmp_path / "game.AVF").open("wb") as replay:
+            replay.write(b"first half ")
+            replay.flush()
+            time.sleep(0.1)
+            replay.write(b"second half")
+        assert uploaded.get(timeout=5) == str(tmp_path / "game.AVF")
+        (tmp_path / "tmp").write_bytes(b"renamed")
+        (tmp_path / "tmp").rename(tmp_path / "game2.rmv")
+        assert uploaded.get(timeout=5) == str(tmp_path / "game2.rmv")
+        # overwritten under the same name
+        time.sleep(0.05)
+        (tmp_path / "game2.rmv").write_bytes(b"another game")
+        assert uploaded.get(timeout=5) == str(tmp_path / "game2.rmv")
+        (tmp_path / "unfinished.rmv").write_bytes(b"still being written")
+        deadline = time.monotonic() + 5
+        while str(tmp_path / "unfinished.rmv") not in replay_watcher._pending:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    assert replay_watcher.not_uploaded == [str(tmp_path / "unfinished.rmv")]
+    assert uploaded.empty()
+    assert requests_mock.call_count == 3
+    assert b"first half second half" in requests_mock.request_history[0].body
+    assert b"another game" in requests_mock.request_history[2].body
+
+
+def test_replay_watcher_callback_errors(requests_mock, tmp_path):
+    from scoreganizer_client_lib import watcher
+
+    requests_mock.post(api_path("scores/upload"), status_code=201)
+    errors = queue.Queue()
+
+    def on_upload(path):
+        raise ValueError(path)
+
+    def on_error(path, ex):
+        errors.put(ex)
+        if path.endswith("b.rmv"):
+            raise RuntimeError("on_error is broken, too")
+
+    replay_watcher = watcher.ReplayWatcher(
+        Scoreganizer().scores,
+        [tmp_path],
+        settle_time=0.05,
+        interval=0.02,
+        backend=watcher.PollingBackend,
+        on_upload=on_upload,
+        on_error=on_error,
+    )
+    with mock.patch("sys.excepthook") as excepthook, replay_watcher:
+        (tmp_path / "a.rmv").write_bytes(b"a")
+        assert isinstance(errors.get(timeout=5), ValueError)
+        (tmp_path / "b.rmv").write_bytes(b"b")
+        assert isinstance(errors.get(timeout=5), ValueError)
+        # the uploader is still alive
+        (tmp_path / "c.rmv").write_bytes(b"c")
+        assert isinstance(errors.get(timeout=5), ValueError)
+    assert excepthook.call_count == 1
+    assert excepthook.call_args[0][0] is RuntimeError
+    assert requests_mock.call_count == 3
+
+
+def test_upload_queue(requests_mock, tmp_path):
+    from scoreganizer_client_lib.upload_queue import UploadQueue
+
+    requests_mock.post(api_path("scores/upload"), status_code=201)
+    requests_mock.post(
+        api_path("scores/upload"),
+        exc=requests.exceptions.ConnectionError,
+        additional_matcher=lambda request: b"unreachable" in request.body,
+    )
+    paths = []
+    for name in ("a", "b", "unreachable", "c"):
+        path = tmp_path / f"{name[0]}.rmv"
+        path.write_bytes(name.encode())
+        paths.append(path)
+    journal_path = tmp_path / "uploads.sqlite3"
+    sc = Scoreganizer()
+
+    upload_queue = UploadQueue(journal_path)
+    a_id, b_id, offline_id, c_id = upload_queue.add_many(paths)
+    missing_id = upload_queue.add(tmp_path / "missing.avf")
+    upload_queue.close()
+    # another process dies while a is being uploaded
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "from scoreganizer_client_lib.upload_queue import UploadQueue\n"
+            "assert UploadQueue(sys.argv[1]).claim(int(sys.argv[2]))\n",
+            str(journal_path),
+            str(a_id),
+        ],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        check=True,
+    )
+
+    with UploadQueue(journal_path) as upload_queue:
+        assert [u.id for u in upload_queue.pending()] == [
+            a_id,
+            b_id,
+            offline_id,
+            c_id,
+            missing_id,
+        ]
+        report = sc.scores.drain_queue(upload_queue, concurrency=2)
+        assert len(report.succeeded) == 3
+        assert upload_queue.counts() == {"done": 3, "pending": 1, "failed": 1}
+        assert [u.id for u in upload_queue.pending()] == [offline_id]
+        assert [u.id for u in upload_queue.failed()] == [missing_id]
+        assert "FileNotFoundError" in upload_queue.get(missing_id).error
+        assert upload_queue.get(a_id).attempts == 2
+
+    requests_mock.reset_mock()
+    paths[2].write_bytes(b"reachable again")
+    with UploadQueue(journal_path) as upload_queue:
+        report = sc.scores.drain_queue(upload_queue)
+        # only the unfinished upload was resumed
+        assert requests_mock.call_count == 1
+        assert [r.filename for r in report.succeeded] == [str(paths[2])]
+        upload_queue.purge_done()
+        assert upload_queue.counts() == {"failed": 1}
+
+    # uploads that a live queue is working on aren't taken over, unless the lease ran
+    # out
+    with UploadQueue(journal_path) as first:
+        upload_id = first.add(paths[0])
+        assert first.claim(upload_id)
+        with UploadQueue(journal_path) as second:
+            assert [u.id for u in second.pending()] == []
+            assert not second.claim(upload_id)
+        with UploadQueue(journal_path, lease=0) as second:
+            assert [u.id for u in second.pending()] == [upload_id]
+
+    # errors that go away by themselves keep uploads pending
+    with UploadQueue(journal_path) as upload_queue:
+        upload_queue.retry_failed()
+        upload_queue.purge_done()
+        requests_mock.post(
+            api_path("scores/upload"), json={"error": "not_logged_in"}, status_code=403
+        )
+        sc.scores.drain_queue(upload_queue)
+        requests_mock.post(api_path("scores/upload"), status_code=502)
+        sc.scores.drain_queue(upload_queue)
+        # the missing file fails again
+        assert upload_queue.counts() == {"pending": 1, "failed": 1}
+        requests_mock.post(
+            api_path("scores/upload"), json={"error": "invalid_data"}, status_code=400
+        )
+        sc.scores.drain_queue(upload_queue)
+        assert upload_queue.counts() == {"failed": 2}
+
+
+def test_upload_index(requests_mock, tmp_path):
+    from scoreganizer_client_lib.dedupe import UploadIndex
+
+    requests_mock.post(api_path("scores/upload"), status_code=201)
+    replays = tmp_path / "replays"
+    replays.mkdir()
+    contents = {
+        "a.rmv": b"player: ralokt#1_35_99a8472376717bc7a676876cf0d351e3",
+        "a_copy.rmv": b"player: ralokt#1_35_99a8472376717bc7a676876cf0d351e3",
+        "b.avf": b"player: ralokt#1_36_99a8472376717bc7a676876cf0d351e3",
+        "c.avf": b"no key",
+    }
+    for name, content in contents.items():
+        (replays / name).write_bytes(content)
+    paths = [replays / name for name in contents]
+
+    with UploadIndex(tmp_path / "index.sqlite3") as index:
+        sc = Scoreganizer(upload_index=index)
+        assert sc.scores.upload_filename(paths[0]) is True
+        assert sc.scores.upload_filename(paths[0]) is False
+        report = sc.scores.upload_many(paths)
+        assert [r.skipped for r in report.results] == [True, True, False, False]
+        assert requests_mock.call_count == 3
+        assert len(index) == 3
+
+        hashes = index.hash_many(paths, processes=2)
+        assert hashes[str(paths[0])] == hashes[str(paths[1])]
+        assert hashes[str(paths[0])][1] == 35
+        assert hashes[str(paths[3])][1] is None
+
+        new = tmp_path / "new.avf"
+        new.write_bytes(b"player: ralokt#1_37_99a8472376717bc7a676876cf0d351e3")
+        index.hash(new)
+
+        index.evict_tournaments([35])
+        assert not index.contains(paths[0])
+        assert index.contains(paths[2])
+        index.evict(1)
+        assert len(index) == 1
+        kept = paths[2] if index.contains(paths[2]) else paths[3]
+        assert index.contains(kept)
+        # evicting doesn't forget the hashes of files that weren't uploaded yet
+        with mock.patch("scoreganizer_client_lib.dedupe.hash_file") as hash_file:
+            assert not index.contains(new)
+        hash_file.assert_not_called()
+
+        # changed files are hashed again
+        kept.write_bytes(b"a different replay")
+        assert not index.contains(kept)
+
+
+def test_list_cache(requests_mock, tournaments_json):
+    from scoreganizer_client_lib.cache import ListCache
+
+    now = [0.0]
+    requests_mock.get(
+        api_path("tournaments/active"),
+        [
+            {"json": tournaments_json, "headers": {"ETag": '"v1"'}},
+            {"status_code": 304},
+            {"json": tournaments_json[:1], "headers": {"ETag": '"v2"'}},
+        ],
+    )
+    requests_mock.post(api_path("tournaments/participate/1"), status_code=200)
+    sc = Scoreganizer(list_cache=ListCache(ttls={"active": 5}, clock=lambda: now[0]))
+    ts = sc.tournaments
+
+    assert [t.id for t in ts.active()] == [1, 2]
+    now[0] = 4.9
+    assert [t.id for t in ts.active()] == [1, 2]
+    assert requests_mock.call_count == 1
+    # expired, but not modified
+    now[0] = 5
+    assert [t.id for t in ts.active()] == [1, 2]
+    assert requests_mock.call_count == 2
+    assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+    assert [t.id for t in ts.active()] == [1, 2]
+    assert requests_mock.call_count == 2
+    # what we get are copies
+    ts.active()[0].name = "Changed"
+    assert ts.active()[0].name == "Tournament 1"
+    # participating invalidates the cache
+    ts.participate(1)
+    assert [t.id for t in ts.active()] == [1]
+    assert requests_mock.call_count == 4
+    assert "If-None-Match" not in requests_mock.last_request.headers
+
+    # invalidated while we were asking whether the list changed
+    cache = sc.list_cache
+    entry = cache.get("active")
+    cache.invalidate()
+    assert [t.id for t in cache.refresh("active", entry)] == [1]
+    assert cache.get("active") is None
+
+
+def test_server_clock():
+    from scoreganizer_client_lib.clock import UTC, ServerClock
+
+    clock = ServerClock()
+    assert clock.offset == timedelta(0)
+    received = datetime(2024, 5, 21, 12, 0, 0, tzinfo=UTC)
+    for seconds in (10, 10, 500):
+        clock.observe(
+            f"Tue, 21 May 2024 12:00:{seconds % 60:02} GMT",
+            elapsed=timedelta(seconds=1),
+            received=received + timedelta(seconds=seconds - seconds % 60),
+        )
+    clock.observe("garbage")
+    clock.observe(None)
+    # the outlier doesn't count, 10s + 0.5s resolution correction + 0.5s half rtt
+    assert clock.offset == timedelta(seconds=11)
+    assert clock.rtt == timedelta(seconds=1)
+    assert 18.9 < clock.seconds_until(datetime.now(UTC) + timedelta(seconds=30)) <= 19
+
+    # the server's tournament times are in its own time zone
+    server_tz = timezone(timedelta(hours=3))
+    clock = ServerClock(server_tz=server_tz)
+    in_30s = datetime.now(server_tz).replace(tzinfo=None) + timedelta(seconds=30)
+    assert clock.localize(in_30s).utcoffset() == timedelta(hours=3)
+    assert 29.9 < clock.seconds_until(in_30s) <= 30
+    assert clock.now() - in_30s < timedelta(seconds=-29.9)
+
+
+@pytest.mark.parametrize("mine", [False, True])
+def test_snapshot(requests_mock, mine):
+    from scoreganizer_client_lib.clock import UTC
+
+    def tournament(pk, start, end):
+        return {
+            **tournament_json(pk),
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+        }
+
+    now = datetime(2024, 5, 21, 12, 0)
+    hour = timedelta(hours=1)
+    requests_mock.get(
+        api_path("tournaments/all"),
+        json=[
+            tournament(1, now - 2 * hour, now - hour),
+            tournament(2, now - hour, now + hour),
+            tournament(3, now + hour, now + 2 * hour),
+            tournament(4, now - hour, now),
+        ],
+        headers={"Date": format_datetime(now.astimezone(UTC), usegmt=True)},
+    )
+    requests_mock.get(
+        api_path("tournaments/my_active"),
+        json=[tournament(2, now - hour, now + hour)],
+    )
+    sc = Scoreganizer()
+    snapshot = sc.tournaments.snapshot(mine=mine, now=now)
+    assert [t.id for t in snapshot.archive] == [1, 4]
+    assert [t.id for t in snapshot.in_progress] == [2]
+    assert [t.id for t in snapshot.upcoming] == [3]
+    assert [t.id for t in snapshot.active] == [3, 2]
+    if mine:
+        assert requests_mock.call_count == 2
+        assert [t.id for t in snapshot.my_active] == [2]
+    else:
+        assert requests_mock.call_count == 1
+        assert snapshot.my_active is None
+    # the Date header is used to correct our clock
+    assert sc.clock.offset < -timedelta(days=365)
+    snapshot = sc.tournaments.snapshot()
+    assert [t.id for t in snapshot.in_progress] == [2]
+
+    # 13:00 where the server is
+    sc.clock.server_tz = timezone(hour)
+    snapshot = sc.tournaments.snapshot(now=datetime(2024, 5, 21, 12, 0, tzinfo=UTC))
+    assert [t.id for t in snapshot.in_progress] == [3]
+    assert [t.id for t in snapshot.archive] == [1, 2, 4]
+
+
+@pytest.mark.parametrize("batch_size", [1, 1000])
+def test_tournament_index(batch_size):
+    from scoreganizer_client_lib.tournament_index import TournamentIndex
+
+    base = datetime(2024, 1, 1)
+    day = timedelta(days=1)
+
+    def tournament(pk, start_day, days, mode="sum", status="not_logged_in"):
+        return Tournament.deserialize(
+            {
+                **tournament_json(pk),
+                "mode": mode,
+                "status": status,
+                "start": (base + start_day * day).isoformat(),
+                "end": (base + (start_day + days) * day).isoformat(),
+            }
+        )
+
+    tournaments = [
+        tournament(pk, pk % 100, 1 + pk % 7, mode=("sum", "best")[pk % 2])
+        for pk in range(1000)
+    ]
+    index = TournamentIndex()
+    for i in range(0, len(tournaments), batch_size):
+        index.update(tournaments[i : i + batch_size])
+    assert len(index) == 1000
+    assert index.get(42) is tournaments[42]
+    assert Tournament.deserialize(tournament_json(42)) in index
+
+    def brute_force(condition):
+        return sorted(
+            (t for t in tournaments if condition(t)), key=lambda t: (t.start, t.id)
+        )
+
+    for t in (base - day, base + 3.5 * day, base + 50 * day, base + 103 * day):
+        assert index.active_at(t) == brute_force(lambda x: x.start <= t < x.end)
+        assert index.upcoming_at(t) == brute_force(lambda x: t < x.start)
+        assert sorted(index.ended_at(t), key=lambda x: (x.start, x.id)) == (
+            brute_force(lambda x: x.end <= t)
+        )
+    assert index.starting_between(base + day, base + 3 * day) == brute_force(
+        lambda x: base + day <= x.start < base + 3 * day
+    )
+    assert [t.id for t in index.ending_between(upper=base + 2 * day)] == [0, 700]
+    assert index.by_mode("best") == brute_force(lambda x: x.mode == "best")
+
+    # incremental update: tournament 1 is now ours, and moved
+    index.update([tournament(1, 200, 1, status="participating")])
+    assert [t.id for t in index.by_status("participating")] == [1]
+    assert len(index.by_status("not_logged_in")) == 999
+    assert index.starting_between(base + 200 * day) == [index.get(1)]
+    index.remove(1)
+    assert 1 not in index
+    assert index.by_status("participating") == []
+    assert len(index) == 999
+
+    # changing an instance after it was indexed doesn't confuse the index
+    changed = index.get(2)
+    changed.status = "participating"
+    changed.start = base + 500 * day
+    index.remove(2)
+    assert 2 not in index
+    assert index.by_status("participating") == []
+    assert index.starting_between(base + 500 * day) == []
+    # a very long tournament
+    index.update([tournament(3000, -10, 1000)])
+    tournaments = list(index)
+    for t in (base - day, base + 50 * day, base + 103 * day):
+        assert index.active_at(t) == brute_force(lambda x: x.start <= t < x.end)
+
+
+def test_tournament():
+    data = [tournament_json(1), tournament_json(2)]
+    data[1].update(mode=None, modeparams=None, location=None, status=None)
+    fast = Tournament.deserialize_many(data)
+    # start and end are only parsed when used
+    tournament = fast[0]
+    assert tournament._start == "2024-05-21T15:42:18.932526"
+    assert tournament.start == datetime(2024, 5, 21, 15, 42, 18, 932526)
+    assert isinstance(tournament._start, datetime)
+    assert tournament._end == "2024-05-22T15:42:18.932534"
+    tournament.end = datetime(2024, 6, 1)
+    assert tournament.end == datetime(2024, 6, 1)
+    tournament.start = "2024-05-20T00:00:00"
+    assert tournament.start == datetime(2024, 5, 20)
+
+    fast = Tournament.deserialize_many(data)
+    assert fast == [Tournament.deserialize(entry) for entry in data]
+    assert fast[1].mode is None
+    assert fast[1].location is None
+
+    assert tournament != fast[1]
+    assert tournament != Tournament.deserialize(tournament_json(1))
+    with pytest.raises(TypeError):
+        hash(tournament)
+    assert int(tournament) == 1
+    assert repr(tournament).startswith("Tournament(id=1, mode='sum', ")
+    assert "start=datetime.datetime(2024, 5, 20, 0, 0)" in repr(tournament)
+
+    duplicate = copy(tournament)
+    assert duplicate == tournament
+    assert duplicate is not tournament
+
+    changed = tournament.replace(name="Renamed")
+    assert changed.name == "Renamed"
+    assert tournament.name == "Tournament 1"
+    assert changed == Tournament(**{**tournament._asdict(), "name": "Renamed"})
+    assert list(tournament._asdict()) == list(Tournament.FIELDS)
+
+
+def test_tournament_without_orjson():
+    code = (
+        "import json, sys\n"
+        "sys.modules['orjson'] = None\n"
+        "from scoreganizer_client_lib import tournament\n"
+        "assert tournament.json_loads is json.loads\n"
+        "data = tournament.json_loads(sys.argv[1])\n"
+        "print(tournament.Tournament.deserialize_many(data)[0].name)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code, json.dumps([tournament_json(3)])],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "Tournament 3"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_json_array_parser(chunk_size):
+    from scoreganizer_client_lib.jsonstream import iter_json_array
+
+    data = [{"a": [1, 2, {"b": "ü ,]"}]}, 12345, -1.5e3, "x", None, True, [], {}]
+    body = json.dumps(data, indent=1).encode()
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)]
+    assert list(iter_json_array(chunks)) == data
+    assert list(iter_json_array([b" [ ] "])) == []
+    for empty in (b"[]", b" [ \n ] "):
+        chunks = [empty[i : i + chunk_size] for i in range(0, len(empty), chunk_size)]
+        assert list(iter_json_array(chunks)) == []
+    for invalid in (b"[1, 2", b"{}", b"[1 2]", b"[1] 2", b"[1,]"):
+        with pytest.raises(json.JSONDecodeError):
+            list(iter_json_array([invalid]))
+
+
+def test_iter_and_sync_archive(requests_mock, tmp_path):
+    from scoreganizer_client_lib.archive import ArchiveStore
+
+    requests_mock.get(
+        api_path("tournaments/archive"),
+        [
+            {"json": [tournament_json(1), tournament_json(2)]},
+            {"json": [tournament_json(pk) for pk in (1, 2, 3, 4)]},
+            {"json": [tournament_json(pk) for pk in (1, 2, 3, 4, 5)]},
+        ],
+    )
+    ts = Scoreganizer().tournaments
+    tournaments = ts.iter_archive(chunk_size=16)
+    assert not isinstance(tournaments, list)
+    assert [t.id for t in tournaments] == [1, 2]
+
+    store_path = tmp_path / "archive.jsonl"
+    store = ArchiveStore(store_path)
+    assert [t.id for t in ts.sync_archive(store)] == [1, 2, 3, 4]
+    assert [t.id for t in store] == [1, 2, 3, 4]
+
+    # simulate a crash while writing the next tournament
+    with store_path.open("a") as store_file:
+        store_file.write('{"id": 5, "mo')
+    store = ArchiveStore(store_path)
+    assert len(store) == 4
+    assert 4 in store
+    assert [t.id for t in ts.sync_archive(store)] == [5]
+    assert [t.id for t in ArchiveStore(store_path)] == [1, 2, 3, 4, 5]
+    assert list(store)[2] == Tournament.deserialize(tournament_json(3))
+
+    requests_mock.get(
+        api_path("tournaments/archive"), json={"error": "foo"}, status_code=500
+    )
+    requests_mock.reset_mock()
+    with mock.patch("time.sleep", return_value=None):
+        with pytest.raises(ScoreganizerError):
+            list(ts.iter_archive())
+    # GETs are retried
+    assert requests_mock.call_count == 5
+
+
+def test_mirror(requests_mock, tournaments_json, tmp_path):
+    from scoreganizer_client_lib.mirror import MirrorRefresher, TournamentMirror
+
+    now = [1000.0]
+    path = tmp_path / "mirror.sqlite"
+    requests_mock.get(api_path("tournaments/active"), json=tournaments_json)
+    requests_mock.get(api_path("tournaments/all"), json=tournaments_json)
+    requests_mock.get(api_path("tournaments/get_key/1"), json={"key": "a_key"})
+    requests_mock.post(api_path("tournaments/participate/1"), status_code=200)
+    mirror = TournamentMirror(path, max_age=30, clock=lambda: now[0])
+    sc = Scoreganizer(mirror=mirror)
+
+    assert sc.tournaments.active() == Tournament.deserialize_many(tournaments_json)
+    assert sc.tournaments.get_key(1) == "a_key"
+    assert requests_mock.call_count == 2
+
+    # another process, using the same file
+    other = Scoreganizer(mirror=TournamentMirror(path, clock=lambda: now[0]))
+    assert other.tournaments.active() == Tournament.deserialize_many(tournaments_json)
+    assert other.tournaments.get_key(1) == "a_key"
+    assert requests_mock.call_count == 2
+    start = datetime.fromisoformat(tournament_json(1)["start"])
+    assert [t.id for t in other.mirror.active_at(start)] == [1, 2]
+    assert other.mirror.upcoming_at(start) == []
+    assert other.mirror.get(2) == Tournament.deserialize(tournament_json(2))
+    assert other.mirror.by_status("participating") == []
+
+    # too old
+    now[0] += 30
+    sc.tournaments.active()
+    assert requests_mock.call_count == 3
+    # participating changes the status
+    sc.tournaments.participate(1)
+    sc.tournaments.active()
+    assert requests_mock.call_count == 5
+
+    refresher = MirrorRefresher(sc, lists=["all", "active"], interval=10)
+    refresher.refresh_once()
+    # active was just fetched
+    assert [r.path for r in requests_mock.request_history[5:]] == [
+        "/api/tournaments/all"
+    ]
+    with refresher:
+        pass
+    assert requests_mock.call_count == 6
+    assert mirror.list_age("all") == 0
+
+    # the statuses in the file are for whoever stored the first list
+    assert mirror.account == ""
+    requests_mock.get(api_path("tournaments/get_key/1"), json={"key": "alices_key"})
+    sc.set_auth_str("alice:token")
+    with pytest.raises(ValueError):
+        sc.tournaments.all()
+    # keys are per user
+    assert sc.tournaments.get_key(1) == "alices_key"
+    assert mirror.get_key("alice", 1) == "alices_key"
+    assert mirror.get_key("", 1) == "a_key"
+
+    # the server can send null for some fields
+    mine = [{**tournaments_json[0], "location": None, "status": None}]
+    requests_mock.get(api_path("tournaments/my_active"), json=mine)
+    alices_mirror = TournamentMirror(tmp_path / "alice.sqlite", clock=lambda: now[0])
+    alice = Scoreganizer(mirror=alices_mirror)
+    alice.set_auth_str("alice:token")
+    assert alice.tournaments.my_active()[0].location is None
+    assert alices_mirror.get_list("my_active", username="alice") == (
+        Tournament.deserialize_many(mine)
+    )
+    assert alices_mirror.account == "alice"
+    alices_mirror.close()
+    other.mirror.close()
+    mirror.close()
+
+
+def test_key_scheduler(requests_mock):
+    from scoreganizer_client_lib.scheduler import KeyScheduler
+
+    requests_mock.post(
+        api_path("tournaments/gen_key/1"),
+        [
+            {"json": {"error": "too_early", "wait": "0.2"}, "status_code": 403},
+            {"json": {"key": "k1"}},
+        ],
+    )
+    requests_mock.post(
+        api_path("tournaments/gen_key/2"),
+        json={"error": "too_early", "wait": "0.05"},
+        status_code=403,
+    )
+    requests_mock.post(
+        api_path("tournaments/gen_key/3"),
+        json={"error": "key_exists"},
+        status_code=403,
+    )
+    requests_mock.get(api_path("tournaments/get_key/3"), json={"key": "k3"})
+    requests_mock.post(
+        api_path("tournaments/gen_key/4"),
+        json={"error": "invalid_data"},
+        status_code=403,
+    )
+    keys = []
+    errors = []
+    sc = Scoreganizer()
+    scheduler = KeyScheduler(
+        sc.tournaments,
+        on_key=lambda pk, key: keys.append((pk, key)),
+        on_error=lambda pk, ex: errors.append((pk, ex.error)),
+    )
+    with scheduler:
+        futures = scheduler.schedule_many([1, 2, 3, 4])
+        assert scheduler.schedule(1) is futures[0]
+        assert futures[0].result(timeout=5) == "k1"
+        assert futures[2].result(timeout=5) == "k3"
+        with pytest.raises(ScoreganizerInvalidData):
+            futures[3].result(timeout=5)
+        # 2 is still waiting, and is tried again every 0.05s
+        assert not futures[1].done()
+        assert len(scheduler) == 1
+    assert futures[1].cancelled()
+    assert keys == [(3, "k3"), (1, "k1")]
+    assert errors == [(4, "invalid_data")]
+    assert len(requests_mock.request_history) < 20
+
+    requests_mock.post(api_path("tournaments/gen_key/2"), json={"key": "k2"})
+    assert sc.tournaments.wait_keys(
+        [Tournament.deserialize(tournament_json(2)), 3]
+    ) == {
+        2: "k2",
+        3: "k3",
+    }
+
+
+def test_wait_key_timing(requests_mock):
+    from scoreganizer_client_lib.clock import UTC
+
+    now = datetime.now(UTC)
+    requests_mock.post(
+        api_path("tournaments/gen_key/1"),
+        [
+            {
+                "json": {"error": "too_early", "wait": "2"},
+                "status_code": 403,
+                # the server's clock is 60s ahead of ours
+                "headers": {
+                    "Date": format_datetime(now + timedelta(minutes=1), usegmt=True)
+                },
+            },
+            {"json": {"key": "k1"}},
+        ],
+    )
+    sc = Scoreganizer()
+    for _ in range(3):
+        sc.clock.observe(None, elapsed=timedelta(seconds=0.5))
+    sleeps = []
+    with mock.patch("time.sleep", side_effect=sleeps.append):
+        assert sc.tournaments.wait_key(1, jitter=0.1) == "k1"
+    # the median rtt is subtracted from the wait, instead of the elapsed time of the
+    # single response
+    assert len(sleeps) == 1
+    assert 1.4 < sleeps[0] <= 1.6
+    assert sc.clock.seconds_until(now + timedelta(minutes=2)) == pytest.approx(
+        60, abs=1.5
+    )
+
+    # Tournament instances are waited for until their start, in server time
+    tournament = Tournament.deserialize(
+        {
+            **tournament_json(1),
+            "start": (now + timedelta(minutes=2)).isoformat(),
+        }
+    )
+    sleeps.clear()
+    with mock.patch("time.sleep", side_effect=sleeps.append):
+        assert sc.tournaments.wait_key(tournament) == "k1"
+    assert len(sleeps) == 1
+    assert sleeps[0] == pytest.approx(60, abs=1.5)
+
+
+@pytest.fixture
+def new_york_time(monkeypatch):
+    if not hasattr(time, "tzset"):
+        pytest.skip("can't change the time zone")
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_wait_key_server_time_zone(requests_mock, new_york_time):
+    from scoreganizer_client_lib.clock import UTC
+
+    requests_mock.post(
+        api_path("tournaments/gen_key/1"),
+        [
+            {"json": {"error": "too_early", "wait": "2"}, "status_code": 403},
+            {"json": {"key": "k1"}},
+        ],
+    )
+    # started a minute ago on a server in UTC - hours ago or from now in local time
+    start = datetime.now(UTC).replace(tzinfo=None) - timedelta(minutes=1)
+    tournament = Tournament.deserialize(
+        {**tournament_json(1), "start": start.isoformat()}
+    )
+    sc = Scoreganizer()
+    sleeps = []
+    with mock.patch("time.sleep", side_effect=sleeps.append):
+        assert sc.tournaments.wait_key(tournament) == "k1"
+    # only the server's wait
+    assert len(sleeps) == 1
+    assert sleeps[0] <= 2
+
+    # unless we know the server's time zone
+    sc.clock.server_tz = UTC
+    tournament.start = start + timedelta(minutes=2)
+    sleeps.clear()
+    with mock.patch("time.sleep", side_effect=sleeps.append):
+        assert sc.tournaments.wait_key(tournament) == "k1"
+    assert sleeps[0] == pytest.approx(60, abs=1.5)
+
+
+def test_key_cache(requests_mock, tournaments_json, tmp_path):
+    from scoreganizer_client_lib.cache import KeyCache
+
+    now = [datetime(2024, 5, 22, 12, 0).timestamp()]
+    path = tmp_path / "keys.sqlite"
+    requests_mock.get(api_path("tournaments/get_key/1"), json={"key": "k1"})
+    requests_mock.post(api_path("tournaments/gen_key/2"), json={"key": "k2"})
+    requests_mock.get(api_path("tournaments/get_key/2"), json={"key": "k2"})
+    requests_mock.get(api_path("tournaments/active"), json=tournaments_json)
+    sc = Scoreganizer(key_cache=KeyCache(path, clock=lambda: now[0]))
+    sc.set_auth_str("user:asdf")
+    tournament_2 = Tournament.deserialize(tournaments_json[1])
+
+    assert sc.tournaments.get_key(1) == "k1"
+    assert sc.tournaments.wait_key(tournament_2) == "k2"
+    assert sc.tournaments.get_key(1) == "k1"
+    assert sc.tournaments.wait_key(2) == "k2"
+    assert requests_mock.call_count == 2
+
+    # on disk, per user
+    other = Scoreganizer(key_cache=KeyCache(path, clock=lambda: now[0]))
+    other.set_auth_str("user:qwer")
+    assert other.tournaments.get_key(tournament_2) == "k2"
+    assert requests_mock.call_count == 2
+    other.set_auth_str("someone_else:qwer")
+    assert other.tournaments.get_key(1) == "k1"
+    assert requests_mock.call_count == 3
+    assert len(sc.key_cache) == 3
+
+    # the tournaments have ended - we only learn when 1 ends from the list
+    now[0] = datetime(2024, 5, 23).timestamp()
+    assert sc.tournaments.get_key(tournament_2) == "k2"
+    assert sc.tournaments.get_key(1) == "k1"
+    assert requests_mock.call_count == 4
+    sc.tournaments.active()
+    assert len(sc.key_cache) == 0
+    sc.key_cache.close()
+    other.key_cache.close()
+
+
+def test_retry_policy(requests_mock):
+    from scoreganizer_client_lib.clock import UTC
+    from scoreganizer_client_lib.retry import (
+        RetryBudget,
+        RetryPolicy,
+        parse_retry_after,
+    )
+
+    now = datetime(2024, 5, 21, 12, 0, tzinfo=UTC)
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after("Tue, 21 May 2024 12:00:10 GMT", now=now) == 10
+    assert parse_retry_after("garbage") is None
+
+    policy = RetryPolicy(base_delay=1, max_delay=5)
+    previous = 1
+    for _ in range(100):
+        delay = policy.backoff(previous)
+        assert 1 <= delay <= min(5, previous * 3)
+        previous = delay
+
+    requests_mock.get(
+        api_path("token_status"),
+        [
+            {"status_code": 503, "headers": {"Retry-After": "7"}},
+            {"status_code": 502, "text": "<html>Bad Gateway</html>"},
+            {"json": {"error": "retry", "wait": "2"}, "status_code": 403},
+            {"json": {"status": "ok"}},
+        ],
+    )
+    sc = Scoreganizer(retry_policy=RetryPolicy(tries=4, base_delay=0.5))
+    with mock.patch("time.sleep", return_value=None) as tsp:
+        assert sc.token_status() == "ok"
+    delays = [call.args[0] for call in tsp.call_args_list]
+    assert delays[0] == 7
+    assert 0.5 <= delays[1] <= 1.5
+    assert delays[2] == pytest.approx(2, abs=0.1)
+
+    # errors the server tells us about aren't retried
+    requests_mock.get(
+        api_path("token_status"), json={"error": "not_logged_in"}, status_code=403
+    )
+    with mock.patch("time.sleep", return_value=None) as tsp:
+        with pytest.raises(ScoreganizerNotLoggedIn):
+            sc.token_status()
+    assert tsp.call_count == 0
+
+    # when the budget runs out, calls fail fast
+    budget = RetryBudget(ratio=0.5, initial=2)
+    sc = Scoreganizer(retry_policy=RetryPolicy(budget=budget))
+    requests_mock.reset_mock()
+    requests_mock.get(api_path("token_status"), status_code=503)
+    with mock.patch("time.sleep", return_value=None) as tsp:
+        for _ in range(3):
+            with pytest.raises(ScoreganizerError):
+                sc.token_status()
+    # 2 initial tokens + 0.5 for each call
+    assert tsp.call_count == 3
+    assert requests_mock.call_count == 6
+
+    # but retries the server asks for don't need tokens
+    requests_mock.reset_mock()
+    requests_mock.post(
+        api_path("scores/upload"), json={"error": "retry"}, status_code=403
+    )
+    with mock.patch("time.sleep", return_value=None):
+        for expected in (10, 20, 30):
+            with pytest.raises(ScoreganizerRetry):
+                sc.scores.upload_file(BytesIO(b"replay"), "test.avf", tries=10)
+            assert requests_mock.call_count == expected
+
+    # too long
+    sc = Scoreganizer(retry_policy=RetryPolicy(max_elapsed=5))
+    requests_mock.get(
+        api_path("token_status"), status_code=429, headers={"Retry-After": "60"}
+    )
+    with mock.patch("time.sleep", return_value=None) as tsp:
+        with pytest.raises(ScoreganizerError):
+            sc.token_status()
+    assert tsp.call_count == 0
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_upload_retry_rewinds(requests_mock, stream):
+    requests_mock.post(
+        api_path("scores/upload"),
+        [{"status_code": 503}, {"status_code": 201}],
+    )
+    sc = Scoreganizer()
+    replay = BytesIO(b"header" + b"replay data")
+    replay.read(6)
+    with mock.patch("time.sleep", return_value=None) as tsp:
+        sc.scores.upload_file(replay, "test.rmv", stream=stream)
+    assert tsp.call_count == 1
+    _, second = requests_mock.request_history
+    body = second.body if isinstance(second.body, bytes) else b"".join(second.body)
+    assert b"replay data" in body
+    assert b"headerreplay" not in body
+
+
+@pytest.mark.parametrize("status_code", [500, 502, 504])
+def test_post_not_resent_after_5xx(requests_mock, status_code):
+    # the server may have handled it before the proxy gave up
+    requests_mock.post(
+        api_path("scores/upload"), [{"status_code": status_code}, {"status_code": 201}]
+    )
+    requests_mock.post(
+        api_path("refresh_token"),
+        [{"status_code": status_code}, {"json": {"token": "qwer"}}],
+    )
+    sc = Scoreganizer()
+    sc.set_auth_str("user:asdf")
+    with mock.patch("time.sleep", return_value=None) as tsp:
+        with pytest.raises(ScoreganizerError):
+            sc.scores.upload_file(BytesIO(b"replay data"), "test.rmv")
+        with pytest.raises(ScoreganizerError):
+            sc.refresh_login()
+    assert tsp.call_count == 0
+    assert requests_mock.call_count == 2
+    assert sc._auth_str == "user:asdf"
+
+
+def test_circuit_breaker(requests_mock, tmp_path):
+    from scoreganizer_client_lib.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+    from scoreganizer_client_lib.exceptions import CircuitOpenError, NetworkException
+    from scoreganizer_client_lib.retry import RetryPolicy
+    from scoreganizer_client_lib.upload_queue import PENDING, UploadQueue
+
+    now = [0.0]
+    changes = []
+    breaker = CircuitBreaker(
+        failure_threshold=3,
+        reset_timeout=10,
+        on_state_change=lambda old, new: changes.append(new),
+        clock=lambda: now[0],
+    )
+    sc = Scoreganizer(retry_policy=RetryPolicy(tries=2), circuit_breaker=breaker)
+    requests_mock.get(api_path("token_status"), status_code=503)
+    with mock.patch("time.sleep", return_value=None):
+        with pytest.raises(ScoreganizerError):
+            sc.token_status()
+        assert breaker.state == CLOSED
+        assert breaker.failures == 2
+        # opens on the first try, so there's no use retrying
+        with pytest.raises(ScoreganizerError):
+            sc.token_status()
+    assert breaker.state == OPEN
+    assert requests_mock.call_count == 3
+
+    # fails fast, and counts as a network problem
+    with pytest.raises(CircuitOpenError) as exc_info:
+        sc.token_status()
+    assert isinstance(exc_info.value, NetworkException)
+    assert exc_info.value.retry_after == 10
+    assert requests_mock.call_count == 3
+    assert not breaker.allows_request()
+
+    # uploads from a queue stay queued
+    replay = tmp_path / "a.rmv"
+    replay.write_bytes(b"replay")
+    with UploadQueue(tmp_path / "queue.sqlite3") as upload_queue:
+        upload_queue.add(replay)
+        report = sc.scores.drain_queue(upload_queue)
+        assert len(report.failed) == 1
+        assert [upload.state for upload in upload_queue.pending()] == [PENDING]
+    assert requests_mock.call_count == 3
+
+    # a probe that fails opens it again
+    now[0] = 10
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(ScoreganizerError):
+        sc.token_status()
+    assert requests_mock.call_count == 4
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == 10
+
+    # a probe that succeeds closes it
+    now[0] = 20
+    requests_mock.get(api_path("token_status"), json={"status": "ok"})
+    assert sc.token_status() == "ok"
+    assert breaker.state == CLOSED
+    assert changes == [OPEN, HALF_OPEN, OPEN, HALF_OPEN, CLOSED]
+
+    # errors from a server that's up don't count
+    requests_mock.get(
+        api_path("token_status"), json={"error": "not_logged_in"}, status_code=403
+    )
+    for _ in range(5):
+        with pytest.raises(ScoreganizerNotLoggedIn):
+            sc.token_status()
+    assert breaker.state == CLOSED
+
+
+def test_rate_limiter(requests_mock, tmp_path):
+    from scoreganizer_client_lib.ratelimit import RateLimiter
+
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=3, clock=lambda: now[0])
+    assert [limiter.reserve() for _ in range(5)] == [0, 0, 0, 0.5, 1]
+    now[0] = 10
+    assert limiter.reserve() == 0
+
+    # two processes sharing a bucket
+    path = tmp_path / "bucket.sqlite3"
+    with RateLimiter(2, 1, path, clock=lambda: now[0]) as first:
+        with RateLimiter(2, 1, path, clock=lambda: now[0]) as second:
+            assert first.reserve() == 0
+            assert second.reserve() == 0.5
+            assert first.reserve() == 1
+
+    now[0] = 20
+    sc = Scoreganizer(rate_limiter=RateLimiter(rate=1, burst=1, clock=lambda: now[0]))
+    requests_mock.get(api_path("token_status"), json={"status": "ok"})
+    with mock.patch("time.sleep", return_value=None) as sleep:
+        for _ in range(3):
+            sc.token_status()
+    assert sleep.call_args_list == [mock.call(1), mock.call(2)]
+
+
+def test_adaptive_concurrency(requests_mock):
+    from scoreganizer_client_lib.aio import AsyncAdaptiveConcurrency
+    from scoreganizer_client_lib.ratelimit import AdaptiveConcurrency
+    from scoreganizer_client_lib.retry import RetryPolicy
+
+    limiter = AdaptiveConcurrency(initial=4, minimum=1, maximum=5)
+    slots = [limiter.acquire() for _ in range(4)]
+    assert limiter.in_flight == 4
+    # all of them were sent before the first cut, so only one counts
+    for slot in slots:
+        limiter.release(slot, 429)
+    assert limiter.limit == 2
+    limiter.release(limiter.acquire(), 429)
+    assert limiter.limit == 1
+    limiter.release(limiter.acquire(), None)
+    assert limiter.limit == 1
+    for _ in range(20):
+        limiter.release(limiter.acquire(), 200)
+    assert limiter.limit == 5
+    assert limiter.in_flight == 0
+
+    # blocks until a request is done
+    limiter = AdaptiveConcurrency(initial=1)
+    slot = limiter.acquire()
+    thread = threading.Thread(target=limiter.acquire)
+    with mock.patch.object(limiter._cond, "wait", wraps=limiter._cond.wait) as wait:
+        thread.start()
+        while not wait.called:
+            time.sleep(0.001)
+        limiter.release(slot, 200)
+        thread.join(5)
+    assert not thread.is_alive()
+    assert limiter.in_flight == 1
+
+    sc = Scoreganizer(
+        retry_policy=RetryPolicy(tries=1),
+        concurrency_limiter=AdaptiveConcurrency(initial=8),
+    )
+    requests_mock.get(api_path("token_status"), status_code=429)
+    with pytest.raises(ScoreganizerError):
+        sc.token_status()
+    assert sc.concurrency_limiter.limit == 4
+    assert sc.concurrency_limiter.in_flight == 0
+
+    async def run():
+        limiter = AsyncAdaptiveConcurrency(initial=2)
+
+        async def request():
+            slot = await limiter.acquire()
+            in_flight = limiter.in_flight
+            await asyncio.sleep(0)
+            limiter.release(slot, 200)
+            return in_flight
+
+        in_flight = await asyncio.gather(*(request() for _ in range(6)))
+        assert max(in_flight) == 2
+        assert limiter.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_token_manager(requests_mock, tmp_path):
+    from scoreganizer_client_lib.api_token import TokenRefresher
+
+    now = [1000.0]
+    requests_mock.post(api_path("obtain_token"), json={"token": "asdf"})
+    requests_mock.post(api_path("refresh_token"), json={"token": "qwert"})
+    status = requests_mock.get(api_path("token_status"), json={"status": "ok"})
+    sc = Scoreganizer()
+    sc.tokens._clock = lambda: now[0]
+    sc.login("user", "pass")
+    assert sc.tokens.issued == 1000
+    assert sc.tokens.status() == "ok"
+    assert sc.refresh_login_if_stale() is None
+    assert sc.tokens.status() == "ok"
+    assert status.call_count == 1
+
+    # refreshing proactively, without asking the server
+    now[0] = 1030
+    assert sc.tokens.refresh_if_stale(refresh_after=60) is None
+    now[0] = 1059
+    assert sc.tokens.refresh_if_stale(refresh_after=60) is None
+    assert status.call_count == 1
+    now[0] = 1061
+    assert sc.tokens.refresh_if_stale(refresh_after=60) == "user:qwert"
+    assert sc.tokens.issued == 1061
+    assert sc.tokens.age == 0
+
+    # statuses are asked for again after status_ttl, or when we're not logged in
+    requests_mock.get(api_path("token_status"), json={"status": "ok_stale"})
+    requests_mock.post(
+        api_path("refresh_token"), json={"error": "token_too_recent"}, status_code=429
+    )
+    assert sc.tokens.status() == "ok_stale"
+    assert sc.refresh_login_if_stale() is None
+    assert sc.tokens.status() == "ok"
+    requests_mock.get(
+        api_path("tournaments/my_active"),
+        json={"error": "not_logged_in"},
+        status_code=403,
+    )
+    with pytest.raises(ScoreganizerNotLoggedIn):
+        sc.tournaments.my_active()
+    assert sc.tokens.cached_status() is None
+    requests_mock.get(api_path("token_status"), json={"status": "expired"})
+    assert not sc.token_status_ok()
+    now[0] += 60
+    assert sc.tokens.cached_status() is None
+
+    # worker sessions pick up new credentials
+    sc._init_worker_session()
+    sc.set_auth_str("user:zxcv")
+    assert sc.session.headers["X-Scoreganizer-Authorization"] == "user:zxcv"
+    sc.session.close()
+    sc._local.session = None
+
+    # tokens from the auth file were issued when it was written, at the latest
+    auth_path = tmp_path / "auth.txt"
+    auth_path.write_text("user:asdf")
+    os.utime(auth_path, (500, 500))
+    assert Scoreganizer(auth_filename=auth_path).tokens.issued == 500
+    assert Scoreganizer(auth_filename=tmp_path / "new.txt").tokens.issued is None
+
+    refreshed = []
+    requests_mock.get(api_path("token_status"), json={"status": "ok_stale"})
+    requests_mock.post(api_path("refresh_token"), json={"token": "hjkl"})
+    refresher = TokenRefresher(sc, interval=10, on_refresh=refreshed.append)
+    with refresher:
+        while not refreshed:
+            time.sleep(0.001)
+    assert refreshed == ["user:hjkl"]
+    assert sc.session.headers["X-Scoreganizer-Authorization"] == "user:hjkl"
+    assert refresher._next_check() == 10
+    refresher.refresh_after = 30
+    assert refresher._next_check() == 10
+    now[0] += 25
+    assert refresher._next_check() == 5
+
+
+def test_authfile_shared(requests_mock, tmp_path):
+    authfile_path = tmp_path / "scoreganizer_auth.txt"
+    requests_mock.post(api_path("obtain_token"), json={"token": "asdf"})
+    refresh = requests_mock.post(api_path("refresh_token"), json={"token": "qwert"})
+    requests_mock.get(api_path("token_status"), json={"status": "ok"})
+    first = Scoreganizer(auth_filename=authfile_path)
+    second = Scoreganizer(auth_filename=authfile_path)
+    first.login("user", "pass")
+    # replaced atomically, nothing left over
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "scoreganizer_auth.txt",
+        "scoreganizer_auth.txt.lock",
+    ]
+    assert authfile_path.read_text() == "user:asdf"
+
+    # the other instance picks up the login with its next request
+    second.token_status()
+    assert requests_mock.last_request.headers[AUTH_HEADER] == "user:asdf"
+    assert second.username == "user"
+
+    # ...and only one of them refreshes
+    assert first.refresh_login() == "user:qwert"
+    assert second.refresh_login() == "user:qwert"
+    assert refresh.call_count == 1
+    assert second.tokens.issued == authfile_path.stat().st_mtime
+
+    # our own writes aren't read again
+    with mock.patch.object(first, "_read_auth_file") as read_auth_file:
+        first.set_auth_str("user:zxcv")
+        first.token_status()
+    assert not read_auth_file.called
+
+    fcntl = pytest.importorskip("fcntl")
+    with open(f"{authfile_path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        thread = threading.Thread(target=second.set_auth_str, args=("user:hjkl",))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        assert authfile_path.read_text() == "user:zxcv"
+    thread.join(5)
+    assert authfile_path.read_text() == "user:hjkl"
+
+
+def test_account_pool(requests_mock, tmp_path):
+    from scoreganizer_client_lib.accounts import AccountPool
+    from scoreganizer_client_lib.cache import ListCache
+
+    def obtain_token(request, context):
+        return {"token": f"token-{request.text.split('&')[0].split('=')[1]}"}
+
+    requests_mock.post(api_path("obtain_token"), json=obtain_token)
+    requests_mock.get(
+        api_path("tournaments/my_active"),
+        json=[],
+        headers={"ETag": '"abc"', "Date": "Sat, 17 Oct 2026 12:00:00 GMT"},
+    )
+    with AccountPool(pool_maxsize=4) as pool:
+        alice = pool.add("alice", list_cache=ListCache(ttls={"my_active": 0}))
+        bob = pool.add("bob", auth_filename=tmp_path / "bob.txt")
+        assert pool.add("alice") is alice
+        assert list(pool) == ["alice", "bob"] and len(pool) == 2
+        assert "bob" in pool and pool["bob"] is bob
+        assert alice.session is bob.session is pool.session
+        assert alice.clock is bob.clock is pool.clock
+
+        alice.login("alice", "pass")
+        bob.login("bob", "pass")
+        assert (tmp_path / "bob.txt").read_text() == "bob:token-bob"
+        assert "X-Scoreganizer-Authorization" not in pool.session.headers
+
+        alice.tournaments.my_active()
+        bob.tournaments.my_active()
+        # sent again with If-None-Match, and the credentials
+        alice.tournaments.my_active()
+        headers = [request.headers for request in requests_mock.request_history[2:]]
+        assert [h[AUTH_HEADER] for h in headers] == [
+            "alice:token-alice",
+            "bob:token-bob",
+            "alice:token-alice",
+        ]
+        assert headers[2]["If-None-Match"] == '"abc"'
+        assert pool.clock.offset is not None
+
+        # worker threads share the connections, too
+        assert alice._clone_session().get_adapter(api_path("")) is pool.http_adapter
+        assert pool.remove("alice") is alice
+        assert "alice" not in pool
+
+
+def test_thread_safe(requests_mock):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from requests.adapters import HTTPAdapter
+
+    requests_mock.get(api_path("token_status"), json={"status": "ok"})
+    sc = Scoreganizer(thread_safe=True, pool_maxsize=8)
+    assert sc._http_adapter._pool_maxsize == 8
+    sc.set_auth_str("user:asdf")
+    barrier = threading.Barrier(4)
+
+    def check(_):
+        # all threads at once, so that each one gets its own session
+        barrier.wait(5)
+        assert sc.token_status() == "ok"
+        return sc.session
+
+    with ThreadPoolExecutor(4) as executor:
+        sessions = list(executor.map(check, range(4)))
+        assert len({id(session) for session in sessions}) == 4
+        assert sc.session not in sessions
+        assert len(sc._thread_sessions) == 4
+        # credentials are shared
+        sc.set_auth_str("user:qwert")
+        assert set(executor.map(check, range(4))) == set(sessions)
+    assert {
+        request.headers[AUTH_HEADER] for request in requests_mock.request_history
+    } == {
+        "user:asdf",
+        "user:qwert",
+    }
+    assert requests_mock.last_request.headers[AUTH_HEADER] == "user:qwert"
+    with sc:
+        pass
+    assert not sc._thread_sessions
+
+    # not in thread safe mode, all threads use the same session
+    sc = Scoreganizer()
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(lambda: sc.session).result() is sc.session
+    with pytest.raises(ValueError):
+        Scoreganizer(http_adapter=HTTPAdapter(), pool_maxsize=8)
+
+
+def test_httpx_transport(stand_in_server, tournaments_json, tmp_path):
+    pytest.importorskip("httpx")
+    from scoreganizer_client_lib.exceptions import NetworkException
+    from scoreganizer_client_lib.transport import HTTPXTransport
+
+    stand_in_server.routes.update(
+        {
+            ("POST", "/api/obtain_token"): [(200, {"token": "asdf"})],
+            ("GET", "/api/token_status"): [
+                (503, {"error": "unavailable"}),
+                (200, {"status": "ok"}),
+            ],
+            ("GET", "/api/tournaments/archive"): [(200, tournaments_json)],
+            ("POST", "/api/scores/upload"): [(403, {"error": "retry"}), (201, None)],
+            ("POST", "/api/tournaments/gen_key/2"): [
+                (403, {"error": "key_exists"}),
+            ],
+        }
+    )
+    sc = Scoreganizer(
+        **stand_in_kwargs(stand_in_server), transport=HTTPXTransport(), thread_safe=True
+    )
+    with sc:
+        sc.login("user", "pass")
+        with mock.patch("time.sleep", return_value=None):
+            assert sc.token_status() == "ok"
+        assert sc.clock.rtt is not None
+        assert [t.id for t in sc.tournaments.iter_archive(chunk_size=7)] == [
+            t["id"] for t in tournaments_json
+        ]
+        with pytest.raises(ScoreganizerKeyExists):
+            sc.tournaments.gen_key(2)
+
+        replay_path = tmp_path / "test.avf"
+        replay_path.write_bytes(b"replay")
+        for stream in (False, True):
+            stand_in_server.routes[("POST", "/api/scores/upload")] = [
+                (403, {"error": "retry"}),
+                (201, None),
+            ]
+            with mock.patch("time.sleep", return_value=None):
+                sc.scores.upload_filename(replay_path, stream=stream)
+        for _, path, headers, body in stand_in_server.requests:
+            assert headers[AUTH_HEADER] == "user:asdf" or path == "/api/obtain_token"
+            if path == "/api/scores/upload":
+                assert int(headers["Content-Length"]) == len(body)
+                assert b"replay" in body
+
+    sc = Scoreganizer(
+        host="127.0.0.1", port=1, https=False, transport=HTTPXTransport(retries=0)
+    )
+    with mock.patch("time.sleep", return_value=None) as sleep:
+        with pytest.raises(NetworkException):
+            sc.token_status()
+    # connection problems are retried, like with requests
+    assert sleep.call_count == 4
+    with pytest.raises(ValueError):
+        Scoreganizer(transport=HTTPXTransport(), pool_maxsize=8)
+
+
+def test_lazy_import():
+    # importing the package, or making a client, neither imports requests nor asks
+    # git for the version - see benchmarks/bench_import.py
+    code = (
+        "import sys\n"
+        "import scoreganizer_client_lib\n"
+        "from scoreganizer_client_lib.exceptions import ScoreganizerError\n"
+        "scoreganizer_client_lib.Scoreganizer()\n"
+        "print(sorted({'requests', 'httpx', 'setuptools_scm'} & set(sys.modules)))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"
+
+    import scoreganizer_client_lib
+    from scoreganizer_client_lib.exceptions import CircuitOpenError, NetworkException
+
+    assert scoreganizer_client_lib.Scoreganizer is Scoreganizer
+    assert isinstance(scoreganizer_client_lib.__version__, str)
+    assert NetworkException is requests.exceptions.RequestException
+    assert issubclass(CircuitOpenError, NetworkException)
+    with pytest.raises(AttributeError):
+        scoreganizer_client_lib.nonexistent
+
+
+def test_metrics(requests_mock):
+    from scoreganizer_client_lib.metrics import Histogram, Metrics, endpoint_name
+
+    assert endpoint_name("GET", api_path("tournaments/get_key/42")) == (
+        "GET tournaments/get_key/{pk}"
+    )
+    histogram = Histogram(buckets=(1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == 10
+    assert histogram.snapshot()["buckets"] == [(1, 1), (2, 2), (4, 1), (None, 1)]
+
+    assert Scoreganizer().stats() is None
+    events = []
+    sc = Scoreganizer(metrics=Metrics(sinks=[lambda *event: events.append(event)]))
+    requests_mock.get(api_path("token_status"), json={"status": "ok"})
+    requests_mock.post(
+        api_path("tournaments/gen_key/1"),
+        [
+            {"json": {"error": "retry"}, "status_code": 403},
+            {"json": {"error": "too_early", "wait": "3"}, "status_code": 403},
+            {"json": {"key": "asdf"}, "status_code": 201},
+        ],
+    )
+    requests_mock.get(
+        api_path("tournaments/get_key/2"),
+        json={"error": "not_logged_in"},
+        status_code=403,
+    )
+    with mock.patch("time.sleep", return_value=None):
+        sc.token_status()
+        assert sc.tournaments.wait_key(1) == "asdf"
+        with pytest.raises(ScoreganizerNotLoggedIn):
+            sc.tournaments.get_key(2)
+
+    stats = sc.stats()
+    assert stats["requests"] == 5
+    assert stats["errors"] == {"retry": 1, "too_early": 1, "not_logged_in": 1}
+    assert stats["retries"] == 1
+    assert stats["waits"] == 1
+    assert 2.5 < stats["wait_time"] <= 3
+    gen_key = stats["endpoints"]["POST tournaments/gen_key/{pk}"]
+    assert gen_key["latency"]["count"] == 3
+    assert gen_key["errors"] == 2
+    assert gen_key["retries"] == 1
+    assert gen_key["backoff"] == stats["backoff"] > 0
+    assert stats["endpoints"]["GET token_status"]["bytes_received"] > 0
+    assert [name for name, _, _ in events].count("request.seconds") == 5
+    assert ("error", 1) in [(name, value) for name, value, _ in events]
+    assert events[-1][2] == {
+        "endpoint": "GET tournaments/get_key/{pk}",
+        "status": 403,
+        "error": "not_logged_in",
+    }
+
+    sc.metrics.reset()
+    assert sc.stats()["requests"] == 0